@@ -0,0 +1,501 @@
+# JSON API blueprint for browsing expense history
+
+import re
+import json
+import base64
+import logging
+from datetime import datetime, timedelta
+from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app
+from flask_login import login_required, current_user
+from sqlalchemy import tuple_
+from models import db, Expense, Category, Budget, BudgetAlert, CategorySpend
+from categorizer import visible_categories_query, invalidate_user_categories, get_user_categories
+from expense_search import parse_search_terms, search_expenses
+from budgets import budget_status, check_budget
+from expense_export import EXPORT_FORMATS, export_filename, parquet_available, stream_export
+from archive import archive_files, archived_expense_rows, archive_uses_category
+import uploads
+from uploads import UploadError, DuplicateReceiptError
+
+logger = logging.getLogger(__name__)
+
+api = Blueprint("api", __name__, url_prefix="/api")
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Rows fetched from the cursor at a time while streaming a page
+STREAM_BATCH_SIZE = 200
+
+MAX_CATEGORY_NAME_LENGTH = 64
+MAX_CATEGORY_KEYWORDS = 500
+
+
+def encode_cursor(date, expense_id):
+    """Encode the (date, id) of the last row on a page as an opaque cursor."""
+    payload = json.dumps([date.isoformat(), expense_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor into a (date, id) tuple."""
+    try:
+        date_str, expense_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(date_str), int(expense_id)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def _parse_date(value, name):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"Invalid {name}, expected YYYY-MM-DD: {value}")
+
+
+def _parse_float(value, name):
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"Invalid {name}: {value}")
+
+
+def parse_expense_filters(args):
+    """Parse the history filters in args into {'date_from', 'date_before', 'category_id', 'min_amount',
+    'max_amount', 'q'}, leaving out the ones not given. date_before is the day after date_to.
+    """
+    filters = {}
+    if args.get('date_from'):
+        filters['date_from'] = _parse_date(args['date_from'], 'date_from')
+    if args.get('date_to'):
+        # Inclusive of the whole end day
+        filters['date_before'] = _parse_date(args['date_to'], 'date_to') + timedelta(days=1)
+    if args.get('category_id'):
+        try:
+            filters['category_id'] = int(args['category_id'])
+        except ValueError:
+            raise ValueError(f"Invalid category_id: {args['category_id']}")
+    if args.get('min_amount'):
+        filters['min_amount'] = _parse_float(args['min_amount'], 'min_amount')
+    if args.get('max_amount'):
+        filters['max_amount'] = _parse_float(args['max_amount'], 'max_amount')
+    if args.get('q'):
+        filters['q'] = args['q']
+    return filters
+
+
+def build_expense_query(user_id, args):
+    """Build the filtered, keyset-ordered query for a user's expense history.
+
+    Supported filters (all optional): date_from, date_to (YYYY-MM-DD, inclusive),
+    category_id, min_amount, max_amount, q (case-insensitive substring match on
+    the description) and cursor (from a previous page's next_cursor).
+
+    Rows are ordered newest first by (date, id) so that every page is an index
+    range scan on ix_expense_user_date_id no matter how deep the cursor is.
+    """
+    query = db.session.query(
+        Expense.id,
+        Expense.description,
+        Expense.amount,
+        Expense.date,
+        Expense.category_id,
+        Category.name,
+    ).join(Category, Expense.category_id == Category.id).filter(Expense.user_id == user_id)
+
+    filters = parse_expense_filters(args)
+    if 'date_from' in filters:
+        query = query.filter(Expense.date >= filters['date_from'])
+    if 'date_before' in filters:
+        query = query.filter(Expense.date < filters['date_before'])
+    if 'category_id' in filters:
+        query = query.filter(Expense.category_id == filters['category_id'])
+    if 'min_amount' in filters:
+        query = query.filter(Expense.amount >= filters['min_amount'])
+    if 'max_amount' in filters:
+        query = query.filter(Expense.amount <= filters['max_amount'])
+    if 'q' in filters:
+        # Escape LIKE wildcards so the search text is matched literally
+        term = filters['q'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(Expense.description.ilike(f"%{term}%", escape='\\'))
+
+    if args.get('cursor'):
+        cursor_date, cursor_id = decode_cursor(args['cursor'])
+        # Seek past the last row of the previous page instead of using OFFSET
+        query = query.filter(tuple_(Expense.date, Expense.id) < tuple_(cursor_date, cursor_id))
+
+    return query.order_by(Expense.date.desc(), Expense.id.desc())
+
+
+def close_session_after(query, chunks):
+    """Yield chunks of a streamed response, then close the session query reads from.
+
+    Flask removes db.session when the view returns, before the body is sent,
+    so without this the session the query was built on would hold its
+    connection until it is garbage collected.
+    """
+    try:
+        yield from chunks
+    finally:
+        query.session.close()
+
+
+def stream_expense_page(query, limit):
+    """Yield one page of expenses as a JSON document, row by row."""
+    yield '{"expenses": ['
+    count = 0
+    last_row = None
+    has_more = False
+    # Fetch one extra row to find out whether another page exists
+    for row in query.limit(limit + 1).yield_per(STREAM_BATCH_SIZE):
+        if count == limit:
+            has_more = True
+            break
+        expense_id, description, amount, date, category_id, category_name = row
+        item = {
+            'id': expense_id,
+            'description': description,
+            'amount': amount,
+            'date': date.strftime('%Y-%m-%d') if date else None,
+            'category_id': category_id,
+            'category': category_name,
+        }
+        yield (',' if count else '') + json.dumps(item)
+        count += 1
+        last_row = row
+
+    next_cursor = encode_cursor(last_row[3], last_row[0]) if has_more else None
+    yield '], "count": %d, "next_cursor": %s}' % (count, json.dumps(next_cursor))
+
+
+@api.route("/expenses")
+@login_required
+def list_expenses():
+    """Return a page of the current user's expense history as streamed JSON."""
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid limit.'}), 400
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    try:
+        query = build_expense_query(current_user.id, request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    return Response(stream_with_context(close_session_after(query, stream_expense_page(query, limit))),
+                    mimetype='application/json')
+
+
+@api.route("/expenses/export")
+@login_required
+def export_expenses():
+    """Download the current user's expenses as format=csv (default), jsonl or parquet.
+
+    Takes the filters of /api/expenses. Rows are streamed from the database
+    in batches and sent as they are written, so memory doesn't grow with the
+    size of the account. Archived expenses follow the ones in the table.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'message': 'format must be csv, jsonl or parquet.'}), 400
+    if export_format == 'parquet' and not parquet_available():
+        return jsonify({'success': False, 'message': 'Parquet export needs pyarrow to be installed.'}), 400
+    try:
+        query = build_expense_query(current_user.id, request.args)
+        filters = parse_expense_filters(request.args)
+        if request.args.get('cursor'):
+            # A resumed export skips the archived rows already sent too
+            filters['cursor'] = decode_cursor(request.args['cursor'])
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    archived = archived_expense_rows(current_user.id, **filters) if archive_files(current_user.id) else ()
+    return Response(stream_with_context(close_session_after(query, stream_export(query, export_format, archived))),
+                    mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename="{export_filename(export_format)}"'})
+
+
+@api.route("/expenses/search")
+@login_required
+def search_expense_history():
+    """Full-text search of the current user's expense descriptions.
+
+    q is required; all its words must match and the last one may be
+    incomplete (prefix=0 turns that off, a trailing * makes any word a
+    prefix). order is 'rank' (best match first, the default) or 'date'.
+    """
+    terms = parse_search_terms(request.args.get('q', ''), request.args.get('prefix', '1') != '0')
+    if not terms:
+        return jsonify({'success': False, 'message': 'A search query is required.'}), 400
+    order = request.args.get('order', 'rank')
+    if order not in ('rank', 'date'):
+        return jsonify({'success': False, 'message': 'order must be rank or date.'}), 400
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid limit.'}), 400
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    expenses = [{
+        'id': expense_id,
+        'description': description,
+        'amount': amount,
+        'date': date.strftime('%Y-%m-%d') if date else None,
+        'category_id': category_id,
+        'category': category_name,
+        'score': round(score, 4) if score is not None else None,
+    } for expense_id, description, amount, date, category_id, category_name, score
+        in search_expenses(current_user.id, terms, limit, order)]
+    return jsonify({'expenses': expenses, 'count': len(expenses)})
+
+
+@api.route("/expenses/recurring")
+@login_required
+def list_recurring_expenses():
+    """Return the current user's recurring charges (subscriptions, bills) and their monthly cost.
+
+    Cancelled ones, whose next charge is well overdue, are included with inactive=1.
+    """
+    # Imported here: the detector needs NumPy, which web workers don't load at startup
+    from recurring import find_recurring_expenses
+    recurring = find_recurring_expenses(current_user.id, request.args.get('inactive') == '1')
+    monthly_total = sum(item['monthly_amount'] for item in recurring if item['active'])
+    return jsonify({'success': True, 'recurring': recurring, 'count': len(recurring),
+                    'monthly_total': round(monthly_total, 2)})
+
+
+def _category_to_dict(category):
+    return {
+        'id': category.id,
+        'name': category.name,
+        'keywords': json.loads(category.keywords) if category.keywords else [],
+        'custom': category.user_id is not None,
+    }
+
+
+def _parse_category_payload(data, partial=False):
+    """Validate a category JSON body. Returns the fields to set; raises ValueError."""
+    fields = {}
+    if 'name' in data or not partial:
+        name = (data.get('name') or '').strip()
+        if not name or len(name) > MAX_CATEGORY_NAME_LENGTH:
+            raise ValueError(f"Category name must be 1-{MAX_CATEGORY_NAME_LENGTH} characters.")
+        fields['name'] = name
+    if 'keywords' in data or not partial:
+        keywords = data.get('keywords') or []
+        if not isinstance(keywords, list) or not all(isinstance(keyword, str) for keyword in keywords):
+            raise ValueError("Keywords must be a list of strings.")
+        keywords = list(dict.fromkeys(keyword.strip().lower() for keyword in keywords if keyword.strip()))
+        if len(keywords) > MAX_CATEGORY_KEYWORDS:
+            raise ValueError(f"At most {MAX_CATEGORY_KEYWORDS} keywords are allowed.")
+        fields['keywords'] = json.dumps(keywords)
+    return fields
+
+
+def _get_own_category(category_id):
+    return Category.query.filter_by(id=category_id, user_id=current_user.id).first()
+
+
+@api.route("/categories")
+@login_required
+def list_categories():
+    """Return the shared categories and the current user's own categories."""
+    categories = visible_categories_query(current_user.id).order_by(Category.name).all()
+    return jsonify({'success': True, 'categories': [_category_to_dict(category) for category in categories]})
+
+
+@api.route("/categories", methods=["POST"])
+@login_required
+def create_category():
+    """Create a custom category. A custom category named like a shared one replaces it for this user."""
+    try:
+        fields = _parse_category_payload(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    if Category.query.filter_by(user_id=current_user.id, name=fields['name']).first():
+        return jsonify({'success': False, 'message': 'You already have a category with this name.'}), 400
+
+    category = Category(user_id=current_user.id, **fields)
+    db.session.add(category)
+    invalidate_user_categories(current_user.id)
+    db.session.commit()
+    return jsonify({'success': True, 'category': _category_to_dict(category)}), 201
+
+
+@api.route("/categories/<int:category_id>", methods=["PATCH"])
+@login_required
+def update_category(category_id):
+    """Rename a custom category or replace its keywords."""
+    category = _get_own_category(category_id)
+    if category is None:
+        return jsonify({'success': False, 'message': 'Category not found.'}), 404
+    try:
+        fields = _parse_category_payload(request.get_json(silent=True) or {}, partial=True)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    if 'name' in fields and fields['name'] != category.name and Category.query.filter_by(
+            user_id=current_user.id, name=fields['name']).first():
+        return jsonify({'success': False, 'message': 'You already have a category with this name.'}), 400
+
+    for key, value in fields.items():
+        setattr(category, key, value)
+    invalidate_user_categories(current_user.id)
+    db.session.commit()
+    return jsonify({'success': True, 'category': _category_to_dict(category)})
+
+
+@api.route("/categories/<int:category_id>", methods=["DELETE"])
+@login_required
+def delete_category(category_id):
+    """Delete a custom category that no expenses use."""
+    category = _get_own_category(category_id)
+    if category is None:
+        return jsonify({'success': False, 'message': 'Category not found.'}), 404
+    if db.session.query(Expense.id).filter(Expense.category_id == category_id).first() or \
+            archive_uses_category(current_user.id, category_id):
+        return jsonify({'success': False, 'message': 'Category is used by existing expenses.'}), 400
+
+    # Its budget, alerts and (all zero) spending counters go with it
+    for model in (Budget, BudgetAlert, CategorySpend):
+        db.session.execute(db.delete(model).where(model.user_id == current_user.id, model.category_id == category_id))
+    db.session.delete(category)
+    invalidate_user_categories(current_user.id)
+    db.session.commit()
+    return jsonify({'success': True})
+
+
+_MONTH = re.compile(r'\d{4}-(0[1-9]|1[0-2])$')
+
+
+@api.route("/budgets")
+@login_required
+def list_budgets():
+    """Return the current user's budgets with this month's spending (or month=YYYY-MM) and the alerts raised."""
+    month = request.args.get('month')
+    if month and not _MONTH.match(month):
+        return jsonify({'success': False, 'message': 'Invalid month, expected YYYY-MM.'}), 400
+    budgets, alerts = budget_status(current_user.id, month)
+    return jsonify({'success': True, 'budgets': budgets, 'alerts': alerts})
+
+
+@api.route("/budgets/<int:category_id>", methods=["PUT"])
+@login_required
+def set_budget(category_id):
+    """Set the monthly limit of a category: {"limit": amount}."""
+    categories, _ = get_user_categories(current_user.id)
+    if category_id not in categories:
+        return jsonify({'success': False, 'message': 'Category not found.'}), 404
+    try:
+        limit = float((request.get_json(silent=True) or {}).get('limit'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid limit.'}), 400
+    if not limit > 0:
+        return jsonify({'success': False, 'message': 'The limit must be greater than zero.'}), 400
+
+    budget = Budget.query.filter_by(user_id=current_user.id, category_id=category_id).first()
+    if budget is None:
+        budget = Budget(user_id=current_user.id, category_id=category_id, monthly_limit=limit)
+        db.session.add(budget)
+    budget.monthly_limit = limit
+    db.session.flush()
+    alerts = check_budget(current_user.id, category_id)
+    db.session.commit()
+    return jsonify({'success': True, 'category_id': category_id, 'limit': limit, 'new_alerts': len(alerts)})
+
+
+@api.route("/budgets/<int:category_id>", methods=["DELETE"])
+@login_required
+def delete_budget(category_id):
+    budget = Budget.query.filter_by(user_id=current_user.id, category_id=category_id).first()
+    if budget is None:
+        return jsonify({'success': False, 'message': 'Budget not found.'}), 404
+    db.session.delete(budget)
+    db.session.commit()
+    return jsonify({'success': True})
+
+
+_CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)$')
+
+
+def _upload_status(metadata):
+    return {'success': True, 'upload_id': metadata['id'], 'offset': metadata['offset'], 'size': metadata['size'],
+            'complete': metadata['offset'] == metadata['size']}
+
+
+@api.route("/uploads", methods=["POST"])
+@login_required
+def create_upload():
+    """Start a resumable upload for files larger than a single request allows.
+
+    Body: {"filename": ..., "size": bytes, "sha256": optional hex digest,
+    "allow_duplicate": optional, to process a receipt that looks already uploaded}.
+    Send the file with PUT /api/uploads/<upload_id> requests carrying a
+    Content-Range header; after an interruption GET the upload to find the
+    offset to resume from.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid size.'}), 400
+    try:
+        metadata = uploads.create_chunked_upload(current_app.config['CHUNKED_UPLOAD_FOLDER'], current_user.id,
+                                                 data.get('filename') or '', size, data.get('sha256'),
+                                                 bool(data.get('allow_duplicate')))
+    except UploadError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({**_upload_status(metadata), 'chunk_size': current_app.config['MAX_CONTENT_LENGTH']}), 201
+
+
+@api.route("/uploads/<upload_id>")
+@login_required
+def upload_status(upload_id):
+    metadata = uploads.load_chunked_upload(current_app.config['CHUNKED_UPLOAD_FOLDER'], upload_id, current_user.id)
+    if metadata is None:
+        return jsonify({'success': False, 'message': 'Upload not found.'}), 404
+    return jsonify(_upload_status(metadata))
+
+
+@api.route("/uploads/<upload_id>", methods=["PUT"])
+@login_required
+def upload_chunk(upload_id):
+    """Append one chunk; the request that completes the upload also processes the file."""
+    folder = current_app.config['CHUNKED_UPLOAD_FOLDER']
+    metadata = uploads.load_chunked_upload(folder, upload_id, current_user.id)
+    if metadata is None:
+        return jsonify({'success': False, 'message': 'Upload not found.'}), 404
+
+    match = _CONTENT_RANGE.match(request.headers.get('Content-Range', ''))
+    if not match or int(match.group(3)) != metadata['size']:
+        return jsonify({'success': False, 'message': 'A Content-Range header matching the upload size is required.'}), 400
+    offset = int(match.group(1))
+    if offset != metadata['offset']:
+        return jsonify({**_upload_status(metadata), 'success': False,
+                        'message': f"Expected a chunk at offset {metadata['offset']}."}), 409
+
+    try:
+        metadata = uploads.append_chunk(folder, metadata, offset, request.stream,
+                                        max_other_size=current_app.config['MAX_CONTENT_LENGTH'])
+    except UploadError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    if metadata['offset'] < metadata['size']:
+        return jsonify(_upload_status(metadata))
+
+    try:
+        logger.info(f"Chunked upload {upload_id} complete: {metadata['size']} bytes, "
+                    f"type {metadata['kind']}, sha256 {metadata['received_sha256']}")
+        with uploads.open_chunked_upload(folder, upload_id) as f:
+            result = uploads.ingest_upload(f, metadata['kind'], current_user.id, sha256=metadata['received_sha256'],
+                                           allow_duplicate=metadata.get('allow_duplicate', False))
+    except DuplicateReceiptError as e:
+        return jsonify({'success': False, 'message': str(e), 'duplicate': True,
+                        'uploaded_at': e.uploaded_at.isoformat()}), 409
+    except (UploadError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 400
+    finally:
+        uploads.discard_chunked_upload(folder, upload_id)
+    if result['type'] == 'receipt':
+        result = {**result, 'items': [item.to_dict() for item in result['items']]}
+    return jsonify({**_upload_status(metadata), **result, 'sha256': metadata['received_sha256']})
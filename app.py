@@ -1,27 +1,35 @@
 import os
 import json
 import logging
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+import click
+from datetime import datetime, timedelta
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, abort
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, Session
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+# Set up logging (LOG_LEVEL=DEBUG for verbose OCR and categorization output)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 
 # Import models and db
-from models import db, User, Expense, Category
-# Import custom modules
-from categorizer import categorize_expense_items, get_open_food_facts_category
-from ocr_processor import process_uploaded_file
+from models import db, User, Expense, Category, upgrade_schema
+from metrics import METRICS_ENABLED, instrument_commits, render_metrics
+# Import custom modules (the OCR stack is imported lazily where files are OCR'd)
+from categorizer import get_user_categories, visible_categories_query
 from utils import allowed_file, create_default_categories
+from uploads import SpoolingRequest, UploadError, ingest_upload, cleanup_stale_uploads_in_background
+from normalizer import normalize_description
+from receipt_parser import ExpenseItem, parse_item_dates
+from expense_search import create_search_index
+from partitions import ensure_partitions, maintain_partitions_in_background
+from budgets import record_spending, record_recategorization, budget_status
 
 # Create the app
 app = Flask(__name__)
+app.request_class = SpoolingRequest
 app.secret_key = os.environ.get("SESSION_SECRET")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)  # needed for url_for to generate with https
 
@@ -37,11 +45,16 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,
 }
 app.config["UPLOAD_FOLDER"] = "uploads"
-app.config["ALLOWED_EXTENSIONS"] = {"pdf", "png", "jpg", "jpeg"}
+app.config["CHUNKED_UPLOAD_FOLDER"] = os.path.join("uploads", "chunked")
+app.config["ALLOWED_EXTENSIONS"] = {"pdf", "png", "jpg", "jpeg", "csv", "ofx", "qfx"}
 app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # Limit file size to 16MB
 
+# Ids bound per IN (...) query by bulk endpoints; one query covers any normal request
+BULK_QUERY_BATCH_SIZE = 10000
+
 # Initialize the database
 db.init_app(app)
+instrument_commits(Session)
 
 # Initialize Flask-Login
 login_manager = LoginManager()
@@ -49,34 +62,115 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 # Make sure the upload folder exists
-os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+os.makedirs(app.config["CHUNKED_UPLOAD_FOLDER"], exist_ok=True)
 
-# Import necessary modules after app initialization to avoid circular imports
-with app.app_context():
-    # Import models
-    from models import User, Expense, Category
-    
-    # Import custom modules
-    from ocr_processor import process_uploaded_file
-    from categorizer import categorize_expense_items, get_open_food_facts_category
-    from utils import allowed_file, create_default_categories
-    
-    # Import Google Auth blueprint
-    from google_auth import google_auth
-    
-    # Register blueprints
-    app.register_blueprint(google_auth)
-    
-    # Create database tables
+# Import blueprints after app initialization to avoid circular imports
+from google_auth import google_auth, print_setup_instructions
+from api import api
+
+# Register blueprints
+app.register_blueprint(google_auth)
+app.register_blueprint(api)
+
+def init_database():
+    """Create the database tables and default categories, upgrading an older schema. Needs an app context."""
     db.create_all()
-    
-    # Create default categories if they don't exist
+    upgrade_schema(db.engine)
+    ensure_partitions(db.engine)
+    create_search_index(db.engine)
     create_default_categories()
 
+@app.cli.command("init-db")
+def init_db_command():
+    """One-time schema setup, run before starting the web workers."""
+    init_database()
+    print("Database initialized.")
+    print_setup_instructions()
+
+@app.cli.command("build-category-index")
+def build_category_index_command():
+    """Compile categories and learned items into the index file shared by all worker processes."""
+    from category_index import build_category_index, CATEGORY_INDEX_PATH
+    stats = build_category_index()
+    print(f"Wrote {stats['sets']} category sets ({stats['compiled']} compiled) for {stats['users']} users "
+          f"and {stats['learned_items']} learned items to {CATEGORY_INDEX_PATH} ({stats['bytes'] / 1024:.0f} KB).")
+
+@app.cli.command("train-classifier")
+@click.option("--full", is_flag=True, help="Retrain from scratch instead of updating the saved model.")
+def train_classifier_command(full):
+    """Train the category classifier on learned corrections and saved expenses."""
+    from text_classifier import train_from_history, MODEL_PATH
+    classifier = train_from_history(full=full)
+    print(f"Saved classifier with {len(classifier.classes)} categories to {MODEL_PATH}.")
+
+@app.cli.command("backfill-normalized-descriptions")
+def backfill_normalized_descriptions_command():
+    """Fill in normalized descriptions of expenses saved before the column was added."""
+    from recategorizer import backfill_normalized_descriptions
+    # Adds the column and its index first on databases that predate them
+    upgrade_schema(db.engine)
+    print(f"Filled in {backfill_normalized_descriptions()} normalized descriptions.")
+
+@app.cli.command("rebuild-budget-counters")
+def rebuild_budget_counters_command():
+    """Recompute the monthly per-category spending totals that budgets are checked against."""
+    from budgets import rebuild_counters
+    print(f"Wrote {rebuild_counters()} monthly category totals.")
+
+@app.cli.command("partition-expenses")
+def partition_expenses_command():
+    """Postgres: partition the expense table by month of date. Stop the app while it runs."""
+    from partitions import partition_expense_table
+    if db.engine.dialect.name != 'postgresql':
+        print("Partitioning needs Postgres; the expense table is left as it is.")
+    elif partition_expense_table(db.engine):
+        print("Partitioned the expense table by month.")
+    else:
+        print("The expense table is already partitioned.")
+    print(f"Created partitions: {', '.join(ensure_partitions(db.engine)) or 'none needed'}.")
+
+@app.cli.command("archive-expenses")
+@click.option("--before", help="Archive expenses dated before this day (YYYY-MM-DD). "
+                               "Defaults to ARCHIVE_AFTER_DAYS days ago.")
+@click.option("--user-id", type=int, help="Only archive this user's expenses.")
+def archive_expenses_command(before, user_id):
+    """Move old expenses out of the expense table into per-user, per-year Parquet files."""
+    from archive import archive_expenses, ARCHIVE_AFTER_DAYS, ARCHIVE_DIR
+    cutoff = datetime.strptime(before, '%Y-%m-%d') if before else \
+        datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    print(f"Archived {archive_expenses(cutoff, user_id)} expenses dated before {cutoff:%Y-%m-%d} to {ARCHIVE_DIR}.")
+
+@app.cli.command("cleanup-uploads")
+@click.option("--max-age", type=int, default=None, help="Delete chunked uploads idle for this many seconds. "
+                                                          "Defaults to CHUNKED_UPLOAD_MAX_AGE.")
+def cleanup_uploads_command(max_age):
+    """Delete the spooled files of chunked uploads that were abandoned."""
+    from uploads import cleanup_stale_uploads, CHUNKED_UPLOAD_MAX_AGE
+    folder = app.config["CHUNKED_UPLOAD_FOLDER"]
+    removed = cleanup_stale_uploads(folder, CHUNKED_UPLOAD_MAX_AGE if max_age is None else max_age)
+    print(f"Removed {removed} abandoned chunked upload files from {folder}.")
+
+@app.before_request
+def create_upcoming_partitions():
+    # On partitioned Postgres, keeps monthly partitions created ahead of the dates being saved
+    maintain_partitions_in_background(app)
+
+@app.before_request
+def remove_abandoned_uploads():
+    # Chunked uploads that stopped arriving are deleted even if no new ones are started
+    cleanup_stale_uploads_in_background(app.config["CHUNKED_UPLOAD_FOLDER"])
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+@app.route('/metrics')
+def metrics():
+    """Expose pipeline stage timings in the Prometheus text format."""
+    if not METRICS_ENABLED:
+        abort(404)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     if current_user.is_authenticated:
@@ -176,78 +270,37 @@ def upload():
         
         # Check if file is allowed
         if file and allowed_file(file.filename, app.config["ALLOWED_EXTENSIONS"]):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            
+            # The upload was hashed and sniffed while it was received (see SpoolingRequest);
+            # route it by its content rather than its extension
+            spool = file.stream
+            logging.info(f"Received {secure_filename(file.filename)}: {spool.size} bytes, "
+                         f"type {spool.kind}, sha256 {spool.sha256}")
             try:
-                # Check if Tesseract is installed
-                from ocr_processor import check_tesseract
-                if not check_tesseract():
-                    flash('Tesseract OCR is not installed or not configured properly. Please install Tesseract OCR to process images and PDFs.', 'danger')
-                    return redirect(request.url)
-                
-                # Process the file with OCR
-                from ocr_processor import process_uploaded_file
-                extracted_text = process_uploaded_file(file_path)
-                
-                if not extracted_text or not extracted_text.strip():
-                    flash('No text could be extracted from the file. Please try another file or ensure the image has clear text.', 'warning')
-                    return redirect(request.url)
-                
-                if extracted_text.startswith("ERROR:"):
-                    flash(f'OCR Error: {extracted_text[7:]}', 'danger')
-                    return redirect(request.url)
-                
-                # Log a sample of the extracted text for debugging
-                logging.debug(f"Extracted text sample: {extracted_text[:200]}...")
-                
-                # Save the extracted text to a debug file (temporary for troubleshooting)
-                debug_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{filename}_debug.txt")
-                with open(debug_path, 'w') as f:
-                    f.write(extracted_text)
-                
-                # Categorize the expenses
-                categorized_items = categorize_expense_items(extracted_text, current_user.id)
-                
-                if not categorized_items:
-                    flash('No expense items were found in the extracted text. Please upload a receipt or invoice.', 'warning')
-                    return redirect(request.url)
-                
-                # Store in session for results page
-                session['categorized_items'] = categorized_items
-                
-                # Save expenses to database
-                for item in categorized_items:
-                    expense = Expense(
-                        user_id=current_user.id,
-                        description=item['description'],
-                        amount=item['amount'],
-                        category_id=item['category_id'],
-                        date=datetime.strptime(item['date'], '%Y-%m-%d') if item.get('date') else datetime.now()
-                    )
-                    db.session.add(expense)
-                
-                db.session.commit()
-                
-                # Redirect to results page
-                return redirect(url_for('results'))
-            
+                result = ingest_upload(spool.file, spool.kind, current_user.id, sha256=spool.sha256,
+                                       allow_duplicate=bool(request.form.get('allow_duplicate')))
+            except UploadError as e:
+                db.session.rollback()
+                flash(str(e), 'warning')
+                return redirect(request.url)
             except Exception as e:
+                db.session.rollback()
                 logging.error(f"Error processing file: {str(e)}", exc_info=True)
                 flash(f'Error processing file: {str(e)}', 'danger')
                 return redirect(request.url)
-            finally:
-                # Clean up the files
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                
-                # Remove debug file if it exists
-                debug_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{filename}_debug.txt")
-                if os.path.exists(debug_path):
-                    os.remove(debug_path)
+
+            if result['type'] == 'statement':
+                summary = result['summary']
+                flash(f"Imported {summary['imported']} transactions "
+                      f"({summary['duplicates']} duplicates and {summary['skipped']} non-expense rows skipped).", 'success')
+                return redirect(request.url)
+
+            # Store in session for results page
+            session['categorized_items'] = [item.to_dict() for item in result['items']]
+            # The upload already saved the items; Apply Changes edits these rows
+            session['receipt_expense_ids'] = result['expense_ids']
+            return redirect(url_for('results'))
         else:
-            flash('File type not allowed. Please upload a PDF or image file.', 'danger')
+            flash('File type not allowed. Please upload a PDF, image, CSV or OFX file.', 'danger')
             return redirect(request.url)
     
     return render_template('upload.html')
@@ -271,13 +324,18 @@ def results():
         else:
             category_totals[category] = amount
     
-    # Get all available categories for the dropdown
-    categories = Category.query.all()
+    # Get the shared and the user's own categories for the dropdown
+    categories = visible_categories_query(current_user.id).order_by(Category.name).all()
+
+    # This month's budgets, read from the running counters
+    budgets, budget_alerts = budget_status(current_user.id)
     
     return render_template('results.html', 
                           expenses=categorized_items, 
                           category_totals=category_totals,
-                          categories=categories)
+                          categories=categories,
+                          budgets=budgets,
+                          budget_alerts=budget_alerts)
 
 @app.route('/update_category', methods=['POST'])
 @login_required
@@ -289,15 +347,22 @@ def update_category():
     if expense_id and new_category_id:
         # Update the expense category in the database
         expense = Expense.query.get(expense_id)
-        if expense and expense.user_id == current_user.id:
-            expense.category_id = new_category_id
+        category = visible_categories_query(current_user.id).filter(Category.id == new_category_id).first()
+        if expense and expense.user_id == current_user.id and category:
+            record_recategorization(current_user.id, [(expense.category_id, category.id, expense.date, expense.amount)])
+            expense.category_id = category.id
             db.session.commit()
             
             # Learn this categorization for future use
             from utils import save_learned_item
             save_learned_item(current_user.id, item_description, new_category_id)
+
+            # Fix the same item everywhere else in the user's history
+            from recategorizer import schedule_recategorization
+            normalized = expense.normalized_description or normalize_description(expense.description)
+            schedule_recategorization(app, current_user.id, {normalized: category.id})
             
-            flash('Category updated successfully!', 'success')
+            flash('Category updated successfully! Matching items in your history are being updated too.', 'success')
         else:
             flash('Expense not found or not authorized', 'danger')
     else:
@@ -314,40 +379,53 @@ def update_multiple_categories():
         corrections = data.get('corrections', [])
         
         if corrections:
-            success_count = 0
-            
-            # Update each expense in the database
+            # Category names from the user's cached category map; only the
+            # shared categories and the user's own may be assigned
+            categories, _ = get_user_categories(current_user.id)
+            requested = {}
+            descriptions = {}
             for correction in corrections:
-                expense_id = correction.get('expense_id')
-                new_category_id = correction.get('new_category_id')
-                
-                if expense_id and new_category_id:
-                    expense = Expense.query.get(expense_id)
-                    if expense and expense.user_id == current_user.id:
-                        expense.category_id = new_category_id
-                        success_count += 1
+                try:
+                    expense_id = int(correction.get('expense_id'))
+                    new_category_id = int(correction.get('new_category_id'))
+                except (TypeError, ValueError):
+                    continue
+                if new_category_id in categories:
+                    requested[expense_id] = new_category_id
+                    if correction.get('description'):
+                        descriptions[expense_id] = correction['description']
+
+            # One ownership check for the whole batch, then one executemany UPDATE by primary key
+            owned = {}
+            moves = []
+            expense_ids = list(requested)
+            for start in range(0, len(expense_ids), BULK_QUERY_BATCH_SIZE):
+                for expense_id, normalized, description, category_id, date, amount in db.session.query(
+                        Expense.id, Expense.normalized_description, Expense.description,
+                        Expense.category_id, Expense.date, Expense.amount).filter(
+                        Expense.user_id == current_user.id,
+                        Expense.id.in_(expense_ids[start:start + BULK_QUERY_BATCH_SIZE])):
+                    owned[expense_id] = normalized or normalize_description(description)
+                    moves.append((category_id, requested[expense_id], date, amount))
+            success_count = len(owned)
             
             if success_count > 0:
+                db.session.execute(db.update(Expense), [
+                    {'id': expense_id, 'category_id': requested[expense_id]} for expense_id in owned])
+                record_recategorization(current_user.id, moves)
                 db.session.commit()
                 
-                # Process corrections for learning
+                # Learn every correction in one rewrite of the learned items
                 from utils import save_batch_learned_items
-                
-                # Convert category IDs to names for the learned items
-                learned_corrections = []
-                for correction in corrections:
-                    description = correction.get('description')
-                    category_id = correction.get('new_category_id')
-                    
-                    if description and category_id:
-                        category = Category.query.get(category_id)
-                        if category:
-                            learned_corrections.append({
-                                'description': description,
-                                'category_name': category.name
-                            })
-                
-                save_batch_learned_items(learned_corrections)
+                save_batch_learned_items([
+                    {'description': descriptions[expense_id],
+                     'category_name': categories[requested[expense_id]]['name']}
+                    for expense_id in owned if expense_id in descriptions])
+
+                # Fix the same items everywhere else in the user's history
+                from recategorizer import schedule_recategorization
+                schedule_recategorization(app, current_user.id, {
+                    normalized: requested[expense_id] for expense_id, normalized in owned.items()})
                 
                 return jsonify({
                     'success': True,
@@ -372,10 +450,28 @@ def update_multiple_categories():
 @app.route('/apply_changes', methods=['POST'])
 @login_required
 def apply_changes():
+    """Save the edits made on the results page to the expenses the upload saved.
+
+    Deleted items delete their expense. Spending counters get only the
+    difference between the saved and the edited rows, so an applied receipt
+    is counted once.
+    """
+    from utils import save_learned_item
+
     categorized_items = session.get('categorized_items', [])
+    expense_ids = session.get('receipt_expense_ids', [])
+    expenses = {expense.id: expense for expense in Expense.query.filter(
+        Expense.user_id == current_user.id, Expense.id.in_(expense_ids))} if expense_ids else {}
+    categories = {category.id: category for category in visible_categories_query(current_user.id)}
     updated_items = []
+    updated_expenses = []
+    changes = []
 
-    for i, item in enumerate(categorized_items):
+    for i in range(len(categorized_items)):
+        expense = expenses.get(expense_ids[i]) if i < len(expense_ids) else None
+        if expense is None:
+            logging.warning(f"Skipping item {i}: its expense no longer exists")
+            continue
         description = request.form.get(f'description_{i}')
         amount = float(request.form.get(f'amount_{i}', 0))
         category_id = int(request.form.get(f'category_{i}'))
@@ -383,35 +479,41 @@ def apply_changes():
         delete_flag = request.form.get(f'delete_{i}')
 
         if delete_flag:
-            continue  # Skip deleted items
-
-        from utils import save_learned_item
-        category = Category.query.get(category_id)
-        if category:
-            save_learned_item(current_user.id, description, category.name)
-
-        updated_items.append({
-            'description': description,
-            'amount': amount,
-            'category_id': category_id,
-            'category': category.name,
-            'date': date
-        })
-
-        expense = Expense(
-            user_id=current_user.id,
-            description=description,
-            amount=amount,
-            category_id=category_id,
-            date=datetime.strptime(date, '%Y-%m-%d') if date else datetime.now()
-        )
-        db.session.add(expense)
+            changes.append((expense.category_id, expense.date, -expense.amount))
+            db.session.delete(expense)
+            continue
+
+        category = categories.get(category_id)
+        if not category:
+            logging.warning(f"Keeping item {i} as saved: category {category_id} is not visible to user "
+                            f"{current_user.id}")
+            updated_items.append(ExpenseItem(**categorized_items[i]))
+            updated_expenses.append(expense)
+            continue
+
+        save_learned_item(current_user.id, description, category.name)
+        updated_items.append(ExpenseItem(description, amount, category_id, category.name, date))
+        updated_expenses.append(expense)
 
+    dates = parse_item_dates(updated_items)
+    for item, expense in zip(updated_items, updated_expenses):
+        changes.append((expense.category_id, expense.date, -expense.amount))
+        expense.description = item.description
+        expense.normalized_description = normalize_description(item.description)
+        expense.amount = item.amount
+        expense.category_id = item.category_id
+        if item.date:
+            expense.date = dates[item.date]
+        changes.append((expense.category_id, expense.date, expense.amount))
+    record_spending(current_user.id, changes)
     db.session.commit()
-    session['categorized_items'] = updated_items
+    session['categorized_items'] = [item.to_dict() for item in updated_items]
+    session['receipt_expense_ids'] = [expense.id for expense in updated_expenses]
     flash('Changes applied successfully!', 'success')
     return redirect(url_for('results'))
 
 
 if __name__ == '__main__':
+    with app.app_context():
+        init_database()
     app.run(host='0.0.0.0', port=8501, debug=True)
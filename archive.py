@@ -0,0 +1,306 @@
+import os
+import re
+import logging
+from datetime import datetime, timedelta
+from metrics import count_event
+from expense_search import optimize_search_index
+
+logger = logging.getLogger(__name__)
+
+# Archived expenses live here, in one directory per user holding one Parquet file per year
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+
+# `flask archive-expenses` moves expenses dated more than this many days ago
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", 730))
+
+# Rows per Parquet row group; reads skip whole row groups outside a date range
+ARCHIVE_ROW_GROUP_SIZE = 10000
+
+# Rows read from the table or from an archive file at a time
+ARCHIVE_BATCH_SIZE = 10000
+
+# Ids per DELETE once a year is safely written
+DELETE_BATCH_SIZE = 5000
+
+ARCHIVE_COLUMNS = ['id', 'date', 'description', 'normalized_description', 'amount', 'category_id', 'created_at']
+
+_YEAR_FILE = re.compile(r'(\d{4})\.parquet$')
+
+
+def _schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('id', pa.int64()),
+        ('date', pa.timestamp('us')),
+        ('description', pa.string()),
+        ('normalized_description', pa.string()),
+        ('amount', pa.float64()),
+        ('category_id', pa.int64()),
+        ('created_at', pa.timestamp('us')),
+    ])
+
+
+def user_archive_dir(user_id):
+    return os.path.join(ARCHIVE_DIR, str(int(user_id)))
+
+
+def archive_files(user_id):
+    """Return [(year, path)] of a user's archive files, newest year first."""
+    directory = user_archive_dir(user_id)
+    if not os.path.isdir(directory):
+        return []
+    files = []
+    for name in os.listdir(directory):
+        match = _YEAR_FILE.match(name)
+        if match:
+            files.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(files, reverse=True)
+
+
+def archived_user_ids():
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    return sorted(int(name) for name in os.listdir(ARCHIVE_DIR) if name.isdigit() and archive_files(name))
+
+
+def _write_year(path, batches):
+    """Replace path with the rows of batches, lists of tuples in ARCHIVE_COLUMNS order, one row group at a time.
+
+    Readers see either the old or the new file and never half of one.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _schema()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        with pq.ParquetWriter(f, schema, compression='zstd') as writer:
+            for rows in batches:
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)], schema=schema),
+                    row_group_size=ARCHIVE_ROW_GROUP_SIZE)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def _in_batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _archive_year(user_id, year, cutoff):
+    """Move one user's expenses of one year dated before cutoff to the year's file. Returns the count.
+
+    Rows are read from the table newest first and merged with the year's
+    existing file, which is sorted the same way, so only a row group's worth
+    of the year is in memory at a time.
+    """
+    import heapq
+    import pyarrow.parquet as pq
+    from models import db, Expense
+
+    start = datetime(year, 1, 1)
+    end = min(datetime(year + 1, 1, 1), cutoff)
+    in_year = (Expense.user_id == user_id, Expense.date >= start, Expense.date < end)
+    table_ids = {row[0] for row in db.session.query(Expense.id).filter(*in_year).yield_per(ARCHIVE_BATCH_SIZE)}
+    if not table_ids:
+        return 0
+
+    written_ids = []
+
+    def table_rows():
+        for row in db.session.query(Expense.id, Expense.date, Expense.description, Expense.normalized_description,
+                                    Expense.amount, Expense.category_id, Expense.created_at).filter(
+                *in_year).order_by(Expense.date.desc(), Expense.id.desc()).yield_per(ARCHIVE_BATCH_SIZE):
+            written_ids.append(row[0])
+            yield tuple(row)
+
+    def file_rows(path):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=ARCHIVE_BATCH_SIZE, columns=ARCHIVE_COLUMNS):
+            for row in zip(*(column.to_pylist() for column in batch.columns)):
+                # Rows archived by a run that stopped before its DELETE are replaced, not duplicated
+                if row[0] not in table_ids:
+                    yield row
+
+    path = os.path.join(user_archive_dir(user_id), f"{year}.parquet")
+    rows = table_rows()
+    if os.path.exists(path):
+        rows = heapq.merge(rows, file_rows(path), key=lambda row: (row[1], row[0]), reverse=True)
+    _write_year(path, _in_batches(rows, ARCHIVE_ROW_GROUP_SIZE))
+
+    # Delete only the rows that were written, whatever arrived in the meantime
+    for offset in range(0, len(written_ids), DELETE_BATCH_SIZE):
+        # The date range limits the delete to the year's partitions on partitioned Postgres
+        db.session.execute(db.delete(Expense).where(Expense.id.in_(written_ids[offset:offset + DELETE_BATCH_SIZE]),
+                                                    *in_year[1:]))
+    db.session.commit()
+    return len(written_ids)
+
+
+def archive_expenses(cutoff, user_id=None):
+    """Move expenses dated before cutoff from the expense table to the archive. Needs an app context.
+
+    Each user's rows go to one compressed Parquet file per year, merged with
+    what an earlier run archived, and are deleted from the table once their
+    file is on disk, one year at a time. Monthly budget counters keep the
+    archived spending, and the search index is merged afterwards to give
+    back the space of the deleted rows. Returns the number of expenses archived.
+    """
+    from models import db, Expense, User
+
+    user_ids = [user_id] if user_id is not None else [row[0] for row in db.session.query(User.id).order_by(User.id)]
+    year = db.extract('year', Expense.date)
+    archived = 0
+    for user in user_ids:
+        years = [row[0] for row in db.session.query(year).filter(
+            Expense.user_id == user, Expense.date < cutoff).group_by(year)]
+        for expense_year in sorted(int(value) for value in years):
+            count = _archive_year(user, expense_year, cutoff)
+            if count:
+                logger.info(f"Archived {count} expenses of user {user} from {expense_year}")
+            archived += count
+    if archived:
+        optimize_search_index(db.engine)
+    count_event("expenses_archived", archived)
+    return archived
+
+
+def _row_groups(metadata, date_index, date_from, date_before):
+    """Indexes of the row groups whose date statistics overlap [date_from, date_before)."""
+    groups = []
+    for index in range(metadata.num_row_groups):
+        statistics = metadata.row_group(index).column(date_index).statistics
+        if statistics is not None and statistics.has_min_max:
+            if date_from is not None and statistics.max < date_from:
+                continue
+            if date_before is not None and statistics.min >= date_before:
+                continue
+        groups.append(index)
+    return groups
+
+
+def iter_archive_batches(user_id, columns, date_from=None, date_before=None, category_id=None, min_amount=None,
+                         max_amount=None, q=None, cursor=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """Yield Arrow record batches of columns of a user's archived expenses that match the filters.
+
+    The filters are those of the expense history (date_before is exclusive,
+    q a case-insensitive substring of the description, cursor the (date, id)
+    of the last row already seen, so only rows ordered after it). Files are
+    memory-mapped, newest year first and newest expense first within a year;
+    years and row groups outside the date range are not read.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    if cursor is not None:
+        # Nothing dated after the cursor's row can follow it
+        cursor_before = cursor[0] + timedelta(microseconds=1)
+        date_before = cursor_before if date_before is None else min(date_before, cursor_before)
+    filter_columns = [name for name, value in (('date', date_from or date_before), ('id', cursor),
+                                               ('category_id', category_id),
+                                               ('amount', min_amount is not None or max_amount is not None),
+                                               ('description', q)) if value and name not in columns]
+    for year, path in archive_files(user_id):
+        if (date_from is not None and year < date_from.year) or (date_before is not None and
+                                                                 datetime(year, 1, 1) >= date_before):
+            continue
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        row_groups = _row_groups(parquet_file.metadata, ARCHIVE_COLUMNS.index('date'), date_from, date_before)
+        if not row_groups:
+            continue
+        for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups,
+                                               columns=list(columns) + filter_columns):
+            mask = None
+            conditions = []
+            if date_from is not None:
+                conditions.append(pc.greater_equal(batch['date'], pa.scalar(date_from, pa.timestamp('us'))))
+            if date_before is not None:
+                conditions.append(pc.less(batch['date'], pa.scalar(date_before, pa.timestamp('us'))))
+            if cursor is not None:
+                cursor_date = pa.scalar(cursor[0], pa.timestamp('us'))
+                conditions.append(pc.or_(pc.less(batch['date'], cursor_date),
+                                         pc.and_(pc.equal(batch['date'], cursor_date),
+                                                 pc.less(batch['id'], cursor[1]))))
+            if category_id is not None:
+                conditions.append(pc.equal(batch['category_id'], category_id))
+            if min_amount is not None:
+                conditions.append(pc.greater_equal(batch['amount'], min_amount))
+            if max_amount is not None:
+                conditions.append(pc.less_equal(batch['amount'], max_amount))
+            if q:
+                conditions.append(pc.match_substring(batch['description'], q, ignore_case=True))
+            for condition in conditions:
+                mask = condition if mask is None else pc.and_(mask, condition)
+            if mask is not None:
+                batch = batch.filter(mask)
+            if batch.num_rows:
+                yield batch.select(list(columns))
+
+
+def iter_archived_rows(user_id, columns, **filters):
+    """iter_archive_batches as lists of row tuples."""
+    for batch in iter_archive_batches(user_id, columns, **filters):
+        yield list(zip(*(batch.column(index).to_pylist() for index in range(batch.num_columns))))
+
+
+def archived_expense_rows(user_id, **filters):
+    """Yield lists of (id, description, amount, date, category_id, category name) rows, as the history query returns."""
+    from models import db, Category
+
+    names = {}
+    for rows in iter_archived_rows(user_id, ['id', 'description', 'amount', 'date', 'category_id'], **filters):
+        missing = {row[4] for row in rows} - names.keys()
+        if missing:
+            names.update(db.session.query(Category.id, Category.name).filter(Category.id.in_(missing)))
+        yield [row + (names.get(row[4]),) for row in rows]
+
+
+def archive_uses_category(user_id, category_id):
+    return any(True for _ in iter_archive_batches(user_id, ['id'], category_id=category_id))
+
+
+def archived_monthly_totals(user_id):
+    """Return {(category_id, "YYYY-MM"): total} of a user's archived expenses."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    totals = {}
+    for batch in iter_archive_batches(user_id, ['category_id', 'date', 'amount']):
+        table = pa.table({'category_id': batch['category_id'], 'year': pc.year(batch['date']),
+                          'month': pc.month(batch['date']), 'amount': batch['amount']})
+        grouped = table.group_by(['category_id', 'year', 'month']).aggregate([('amount', 'sum')])
+        for category_id, year, month, amount in zip(*(grouped[name].to_pylist() for name in
+                                                       ('category_id', 'year', 'month', 'amount_sum'))):
+            key = (category_id, f"{year:04d}-{month:02d}")
+            totals[key] = totals.get(key, 0.0) + amount
+    return totals
+
+
+def archived_daily_charges(user_id):
+    """Yield (normalized description, day, largest amount) per description and day of a user's archive."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    # A description's charges of one day can be split across batches; each pair is yielded once
+    largest = {}
+    for batch in iter_archive_batches(user_id, ['normalized_description', 'date', 'amount']):
+        table = pa.table({'key': batch['normalized_description'], 'day': pc.cast(batch['date'], pa.date32()),
+                          'amount': batch['amount']}).filter(pc.is_valid(batch['normalized_description']))
+        grouped = table.group_by(['key', 'day']).aggregate([('amount', 'max')])
+        for key, day, amount in zip(grouped['key'].to_pylist(), grouped['day'].to_pylist(),
+                                    grouped['amount_max'].to_pylist()):
+            pair = (key, day)
+            if amount > largest.get(pair, float('-inf')):
+                largest[pair] = amount
+    for (key, day), amount in largest.items():
+        yield key, day, amount
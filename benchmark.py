@@ -0,0 +1,1959 @@
+#!/usr/bin/env python3
+"""
+Benchmark script for the expense pipeline.
+Run `python benchmark.py <benchmark> --help` to see the options of each benchmark.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+SAMPLE_MERCHANTS = [
+    "WHOLE FOODS MARKET", "STARBUCKS COFFEE", "SHELL OIL", "NETFLIX.COM", "AMAZON MKTPLACE",
+    "TRADER JOE'S", "UBER TRIP", "CVS PHARMACY", "TARGET", "CHIPOTLE", "SPOTIFY USA",
+    "HOME DEPOT", "COSTCO WHOLESALE", "WALGREENS", "DELTA AIR LINES", "MCDONALD'S",
+]
+
+# Fraction of each category's keywords kept from the categorizer by the accuracy
+# benchmarks. The corpus is made from the same keywords, so without this every
+# item contains a keyword the categorizer was given.
+DEFAULT_HOLDOUT = 0.2
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_app(database_path):
+    """Import the Flask app against a scratch SQLite database and create its schema."""
+    os.environ["DATABASE_URL"] = f"sqlite:///{database_path}"
+    from app import app, init_database
+    with app.app_context():
+        init_database()
+    return app
+
+
+def create_benchmark_user(username="benchmark"):
+    """Create (or fetch) the user that benchmark data is attached to."""
+    from models import db, User
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        user = User(username=username, email=f"{username}@example.com")
+        user.set_password(username)
+        db.session.add(user)
+        db.session.commit()
+    return user
+
+
+def write_statement_csv(path, rows, seed=0):
+    """Write a synthetic bank CSV export row by row."""
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1)
+    with open(path, "w") as f:
+        f.write("Date,Description,Amount\n")
+        for i in range(rows):
+            date = start + timedelta(minutes=i)
+            merchant = rng.choice(SAMPLE_MERCHANTS)
+            f.write(f"{date:%Y-%m-%d},{merchant} #{rng.randint(1, 999)},-{rng.uniform(1, 250):.2f}\n")
+
+
+def bench_import(args):
+    """Time a streaming CSV statement import end to end."""
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "statement.csv")
+        write_statement_csv(csv_path, args.rows, seed=args.seed)
+        app = load_app(os.path.join(tmp, "bench.db"))
+
+        from statement_importer import import_statement
+        with app.app_context():
+            user = create_benchmark_user()
+            rss_before = peak_rss_mb()
+            start = time.perf_counter()
+            with open(csv_path, "rb") as f:
+                summary = import_statement(f, "csv", user.id, batch_size=args.batch_size)
+            elapsed = time.perf_counter() - start
+
+    print(f"Rows: {summary['rows']}  imported: {summary['imported']}  "
+          f"duplicates: {summary['duplicates']}  skipped: {summary['skipped']}")
+    print(f"Elapsed: {elapsed:.2f}s  throughput: {summary['rows'] / elapsed:,.0f} rows/s")
+    print(f"Peak RSS: {peak_rss_mb():.1f} MB (before import: {rss_before:.1f} MB)")
+
+
+class StageTimings:
+    """Collect wall-clock durations per pipeline stage."""
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def summary(self):
+        result = {}
+        for stage, values in self.samples.items():
+            ordered = sorted(values)
+            result[stage] = {
+                'count': len(values),
+                'total_s': round(sum(values), 4),
+                'mean_ms': round(1000 * sum(values) / len(values), 3),
+                'p50_ms': round(1000 * ordered[len(ordered) // 2], 3),
+                'p95_ms': round(1000 * ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 3),
+            }
+        return result
+
+
+def score_items(truth_items, predicted_items, held_out=frozenset()):
+    """Match predicted ExpenseItems to ground-truth item dicts by amount.
+
+    Returns (matched, correctly categorized) counts for all items and for the
+    items made from a keyword in held_out.
+    """
+    remaining = {}
+    for item in truth_items:
+        remaining.setdefault(round(item['amount'] * 100), []).append(item)
+    matched = correct = held_out_matched = held_out_correct = 0
+    for item in predicted_items:
+        candidates = remaining.get(round(item.amount * 100))
+        if not candidates:
+            continue
+        truth = next((candidate for candidate in candidates if candidate['category'] == item.category),
+                     candidates[-1])
+        candidates.remove(truth)
+        is_correct = truth['category'] == item.category
+        matched += 1
+        correct += is_correct
+        if truth['keyword'] in held_out:
+            held_out_matched += 1
+            held_out_correct += is_correct
+    return matched, correct, held_out_matched, held_out_correct
+
+
+def compare_to_baseline(results, baseline, tolerance, accuracy_tolerance=0.02):
+    """Return a list of regressions of results against a baseline run."""
+    regressions = []
+    for stage, stats in results['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if previous and stats['mean_ms'] > previous['mean_ms'] * (1 + tolerance):
+            regressions.append(f"{stage}: {stats['mean_ms']:.3f} ms vs baseline {previous['mean_ms']:.3f} ms")
+    for metric, value in results['accuracy'].items():
+        previous = baseline.get('accuracy', {}).get(metric)
+        if previous is not None and value < previous - accuracy_tolerance:
+            regressions.append(f"{metric}: {value:.4f} vs baseline {previous:.4f}")
+    return regressions
+
+
+def bench_suite(args):
+    """Time every pipeline stage on a synthetic corpus and score accuracy."""
+    from corpus_generator import generate_documents, render_document
+
+    timings = StageTimings()
+    truth_total = matched_total = correct_total = held_out_matched_total = held_out_correct_total = 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = load_app(os.path.join(tmp, "bench.db"))
+
+        from sqlalchemy import insert
+        from models import db, Expense
+        from categorizer import load_categories, load_user_learned_items, categorize_item
+        from receipt_parser import extract_date, extract_items
+        if args.ocr:
+            from ocr_processor import decode_image, ocr_layout, layout_text
+
+        with app.app_context():
+            user = create_benchmark_user()
+            known, held_out = split_keywords(args.holdout, args.seed)
+            # The categorizer only gets the known keywords
+            categories = {category_id: dict(category_data, keywords=known.get(category_data['name'],
+                                                                              category_data['keywords']))
+                          for category_id, category_data in load_categories().items()}
+            user_learned_items = load_user_learned_items(user.id)
+
+            for document in generate_documents(args.count, seed=args.seed, noisy=not args.clean):
+                if args.ocr:
+                    with timings('render'):
+                        paths = render_document(document, tmp, {'png'})
+                    with open(paths['png'], 'rb') as f:
+                        data = f.read()
+                    for path in paths.values():
+                        os.remove(path)
+                    # Same in-memory path as uploads: decode, preprocess and OCR without temp files
+                    with timings('decode'):
+                        image = decode_image(data)
+                    with timings('ocr'):
+                        lines = ocr_layout([image])
+                        text = layout_text(lines)
+                else:
+                    text = document['text']
+                    lines = None
+
+                with timings('parse'):
+                    date = extract_date(text)
+                    items = extract_items(text, lines)
+
+                with timings('categorize'):
+                    predicted = []
+                    for item in items:
+                        category_id = categorize_item(item.description, categories, user_learned_items,
+                                                      use_open_food_facts=args.open_food_facts)
+                        if category_id is not None:
+                            item.category_id = category_id
+                            item.category = categories[category_id]['name']
+                            predicted.append(item)
+
+                with timings('persist'):
+                    rows = [{'user_id': user.id, 'description': item.description[:256],
+                             'amount': item.amount, 'category_id': item.category_id,
+                             'date': datetime.strptime(date, '%Y-%m-%d')} for item in predicted]
+                    if rows:
+                        db.session.execute(insert(Expense), rows)
+                    db.session.commit()
+
+                matched, correct, held_out_matched, held_out_correct = score_items(
+                    document['items'], predicted, held_out)
+                truth_total += len(document['items'])
+                matched_total += matched
+                correct_total += correct
+                held_out_matched_total += held_out_matched
+                held_out_correct_total += held_out_correct
+
+    results = {
+        'config': {'count': args.count, 'seed': args.seed, 'ocr': args.ocr, 'clean': args.clean,
+                   'open_food_facts': args.open_food_facts, 'holdout': args.holdout},
+        'stages': timings.summary(),
+        'accuracy': {
+            'extraction_recall': round(matched_total / truth_total, 4) if truth_total else 0.0,
+            'category_accuracy': round(correct_total / matched_total, 4) if matched_total else 0.0,
+            # Items whose keyword the categorizer wasn't given
+            'held_out_category_accuracy': (round(held_out_correct_total / held_out_matched_total, 4)
+                                           if held_out_matched_total else 0.0),
+        },
+    }
+
+    print(f"{'stage':<12}{'count':>8}{'mean ms':>12}{'p50 ms':>12}{'p95 ms':>12}{'total s':>12}")
+    for stage, stats in results['stages'].items():
+        print(f"{stage:<12}{stats['count']:>8}{stats['mean_ms']:>12.3f}{stats['p50_ms']:>12.3f}"
+              f"{stats['p95_ms']:>12.3f}{stats['total_s']:>12.3f}")
+    for metric, value in results['accuracy'].items():
+        print(f"{metric}: {value:.4f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print("REGRESSIONS:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+    return 0
+
+
+def load_category_dict(category_keywords=None):
+    """Build the categorizer's {id: {'name', 'keywords'}} map straight from categories.json, or category_keywords."""
+    if category_keywords is None:
+        with open("categories.json", "r") as f:
+            category_keywords = json.load(f)
+    return {index: {"name": name, "keywords": keywords}
+            for index, (name, keywords) in enumerate(category_keywords.items(), start=1)}
+
+
+def split_keywords(holdout, seed):
+    """Return ({category name: known keywords}, held-out keywords) for the accuracy benchmarks."""
+    from corpus_generator import load_category_keywords, split_category_keywords
+    known, held_out = split_category_keywords(load_category_keywords(), holdout, seed)
+    known_keywords = {keyword for keywords in known.values() for keyword in keywords}
+    # A keyword held out of one category but known in another has been seen
+    return known, {keyword for keywords in held_out.values() for keyword in keywords} - known_keywords
+
+
+def corpus_items(count, seed, noisy=True, keywords=None):
+    """Return (descriptions, category names) for the items of a synthetic corpus.
+
+    With keywords, only items made from one of those keywords are returned.
+    """
+    from corpus_generator import generate_documents
+    descriptions, labels = [], []
+    for document in generate_documents(count, seed=seed, noisy=noisy):
+        for item in document["items"]:
+            if keywords is not None and item["keyword"] not in keywords:
+                continue
+            descriptions.append(item["description"])
+            labels.append(item["category"])
+    return descriptions, labels
+
+
+def bench_classifier(args):
+    """Compare the trained classifier with the fuzzy keyword path on seen and held-out keywords."""
+    from categorizer import categorize_item
+    from text_classifier import TextClassifier
+
+    known, held_out = split_keywords(args.holdout, args.seed)
+    known_keywords = {keyword for keywords in known.values() for keyword in keywords}
+    # Neither engine sees the held-out keywords: the classifier isn't trained on them
+    # and the fuzzy path doesn't have them in its category lists
+    train_descriptions, train_labels = corpus_items(args.train_count, args.seed, keywords=known_keywords)
+    test_sets = [("seen", corpus_items(args.test_count, args.seed + 1, keywords=known_keywords)),
+                 ("held-out", corpus_items(args.test_count, args.seed + 1, keywords=held_out))]
+    categories = load_category_dict(known)
+
+    classifier = TextClassifier()
+    start = time.perf_counter()
+    classifier.partial_fit(train_descriptions, train_labels)
+    train_s = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = os.path.join(tmp, "model.npz")
+        classifier.save(model_path)
+        model_kb = os.path.getsize(model_path) / 1024
+        start = time.perf_counter()
+        classifier = TextClassifier.load(model_path)
+        load_ms = (time.perf_counter() - start) * 1000
+
+    results = []
+    for name, (test_descriptions, test_labels) in test_sets:
+        start = time.perf_counter()
+        predictions = classifier.predict(test_descriptions)
+        classifier_s = time.perf_counter() - start
+        classifier_correct = sum(1 for (predicted, _), label in zip(predictions, test_labels) if predicted == label)
+
+        start = time.perf_counter()
+        fuzzy_correct = 0
+        for description, label in zip(test_descriptions, test_labels):
+            category_id = categorize_item(description, categories, {}, use_open_food_facts=False)
+            if category_id is not None and categories[category_id]["name"] == label:
+                fuzzy_correct += 1
+        fuzzy_s = time.perf_counter() - start
+
+        total = len(test_descriptions)
+        results.append((name, total, "classifier", classifier_correct / total, total / classifier_s))
+        results.append((name, total, "fuzzy", fuzzy_correct / total, total / fuzzy_s))
+
+    print(f"Trained on {len(train_descriptions)} items in {train_s:.2f}s; "
+          f"model {model_kb:.0f} KB, loads in {load_ms:.1f} ms; {args.holdout:.0%} of keywords held out")
+    print(f"{'keywords':<10}{'items':>7}  {'engine':<12}{'accuracy':>10}{'items/s':>14}")
+    for name, total, engine, accuracy, rate in results:
+        print(f"{name:<10}{total:>7}  {engine:<12}{accuracy:>10.4f}{rate:>14,.0f}")
+
+
+def bench_keywords(args):
+    """Measure how many lines the exact keyword pass resolves and the speedup over fuzzy-only.
+
+    Lines made from keywords the matcher was given and from held-out ones are
+    reported apart; the held-out lines can only be resolved by fuzzy matching.
+    """
+    from categorizer import fuzzy_match
+    from keyword_matcher import get_keyword_automaton
+
+    known, held_out = split_keywords(args.holdout, args.seed)
+    known_keywords = {keyword for keywords in known.values() for keyword in keywords}
+    categories = load_category_dict(known)
+    automaton = get_keyword_automaton(categories)
+
+    print(f"{'keywords':<10}{'lines':>7}{'exact pass':>12}{'disagree':>10}{'accuracy':>10}"
+          f"{'fuzzy lines/s':>15}{'combined lines/s':>18}{'speedup':>9}")
+    for name, keywords in (("seen", known_keywords), ("held-out", held_out)):
+        descriptions, labels = corpus_items(args.count, args.seed, noisy=not args.clean, keywords=keywords)
+        descriptions = [description.lower().strip() for description in descriptions]
+
+        start = time.perf_counter()
+        fuzzy_results = [fuzzy_match(description, categories) for description in descriptions]
+        fuzzy_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        exact_hits = disagreements = correct = 0
+        for description, label, (fuzzy_id, fuzzy_score) in zip(descriptions, labels, fuzzy_results):
+            exact_id = automaton.best_match(description)
+            if exact_id is None:
+                category_id, _ = fuzzy_match(description, categories)
+            else:
+                category_id = exact_id
+                exact_hits += 1
+                if fuzzy_score == 100 and exact_id != fuzzy_id:
+                    disagreements += 1
+            if category_id is not None and categories[category_id]["name"] == label:
+                correct += 1
+        combined_s = time.perf_counter() - start
+
+        total = len(descriptions)
+        print(f"{name:<10}{total:>7}{exact_hits / total:>12.1%}{disagreements:>10}{correct / total:>10.4f}"
+              f"{total / fuzzy_s:>15,.0f}{total / combined_s:>18,.0f}{fuzzy_s / combined_s:>8.1f}x")
+
+
+def cache_hit_rate(keys, cache_size):
+    """Hit rate of an LRU cache of cache_size entries over a stream of keys."""
+    from collections import OrderedDict
+    cache = OrderedDict()
+    hits = 0
+    for key in keys:
+        if key in cache:
+            hits += 1
+            cache.move_to_end(key)
+        else:
+            cache[key] = True
+            if len(cache) > cache_size:
+                cache.popitem(last=False)
+    return hits / len(keys) if keys else 0.0
+
+
+def bench_normalizer(args):
+    """Compare cache and learned-item hit rates keyed by raw vs normalized descriptions."""
+    from normalizer import normalize_description, normalization_cache_info
+
+    descriptions, labels = corpus_items(args.count, args.seed)
+    raw_keys = [description.lower() for description in descriptions]
+    start = time.perf_counter()
+    normalized_keys = [normalize_description(description) for description in descriptions]
+    normalize_s = time.perf_counter() - start
+
+    # Learn corrections from the first half, look up the second half
+    half = len(descriptions) // 2
+    raw_learned = dict(zip(raw_keys[:half], labels[:half]))
+    normalized_learned = dict(zip(normalized_keys[:half], labels[:half]))
+    raw_learned_hits = sum(1 for key in raw_keys[half:] if key in raw_learned)
+    normalized_learned_hits = sum(1 for key in normalized_keys[half:] if key in normalized_learned)
+
+    total = len(descriptions)
+    info = normalization_cache_info()
+    print(f"Items: {total}  distinct raw keys: {len(set(raw_keys))}  "
+          f"distinct normalized keys: {len(set(normalized_keys))}")
+    print(f"{'key':<12}{'LRU hit rate':>14}{'learned hit rate':>18}")
+    print(f"{'raw':<12}{cache_hit_rate(raw_keys, args.cache_size):>14.1%}"
+          f"{raw_learned_hits / (total - half):>18.1%}")
+    print(f"{'normalized':<12}{cache_hit_rate(normalized_keys, args.cache_size):>14.1%}"
+          f"{normalized_learned_hits / (total - half):>18.1%}")
+    print(f"Normalizer: {total / normalize_s:,.0f} items/s, memo hits {info.hits}, misses {info.misses}")
+
+
+def bench_categories(args):
+    """Per-user category lookups for many users: cached matcher indexes vs rebuilding per upload."""
+    with tempfile.TemporaryDirectory() as tmp:
+        app = load_app(os.path.join(tmp, "bench.db"))
+
+        import categorizer
+        from models import db, User, Category
+        from keyword_matcher import KeywordAutomaton, automaton_cache_stats
+
+        rng = random.Random(args.seed)
+        with app.app_context():
+            users = [{'username': f"user{i}", 'email': f"user{i}@example.com", 'password_hash': 'x',
+                      'categories_version': 0} for i in range(args.users)]
+            db.session.execute(db.insert(User), users)
+            user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+            # A share of the users define a few categories of their own
+            custom = []
+            for user_id in rng.sample(user_ids, int(len(user_ids) * args.custom_ratio)):
+                for i in range(rng.randint(1, 5)):
+                    keywords = [f"custom{user_id}x{i}x{k}" for k in range(rng.randint(3, 30))]
+                    custom.append({'user_id': user_id, 'name': f"Custom {i}", 'keywords': json.dumps(keywords)})
+            db.session.execute(db.insert(Category), custom)
+            db.session.commit()
+
+            # Uploads are skewed towards a minority of active users
+            weights = [1 / (rank + 1) for rank in range(len(user_ids))]
+            uploads = rng.choices(user_ids, weights=weights, k=args.uploads)
+
+            start = time.perf_counter()
+            for user_id in uploads[:args.cold_uploads]:
+                KeywordAutomaton(categorizer.load_categories(user_id))
+            rebuild_ms = (time.perf_counter() - start) * 1000 / args.cold_uploads
+
+            edits = 0
+            start = time.perf_counter()
+            for i, user_id in enumerate(uploads):
+                categorizer.get_user_categories(user_id)
+                if args.edit_every and i % args.edit_every == 0:
+                    categorizer.invalidate_user_categories(user_id)
+                    db.session.commit()
+                    edits += 1
+            cached_ms = (time.perf_counter() - start) * 1000 / len(uploads)
+
+    user_stats = categorizer.user_category_cache_stats()
+    automaton_stats = automaton_cache_stats()
+    lookups = user_stats['hits'] + user_stats['misses']
+    print(f"Users: {args.users}  custom categories: {len(custom)}  uploads: {len(uploads)}  edits: {edits}")
+    print(f"rebuild per upload: {rebuild_ms:.2f} ms  cached lookup: {cached_ms:.2f} ms  "
+          f"speedup: {rebuild_ms / cached_ms:.1f}x")
+    print(f"user cache: {user_stats['entries']} entries, {user_stats['bytes'] / 1024:.0f} KB, "
+          f"hit rate {user_stats['hits'] / lookups:.1%}, {user_stats['evictions']} evictions")
+    print(f"automaton cache: {automaton_stats['entries']} automata, {automaton_stats['bytes'] / 1024 / 1024:.1f} MB "
+          f"of {automaton_stats['max_bytes'] / 1024 / 1024:.0f} MB, {automaton_stats['evictions']} evictions")
+    print(f"Peak RSS: {peak_rss_mb():.0f} MB")
+
+
+def bench_corrections(args):
+    """One update_multiple_categories request with many corrections: set-based vs per-row queries."""
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["LEARNED_ITEMS_PATH"] = os.path.join(tmp, "learned.json")
+        app = load_app(os.path.join(tmp, "bench.db"))
+        app.secret_key = app.secret_key or "benchmark"
+
+        from sqlalchemy import event
+        from models import db, Expense, Category
+        from categorizer import visible_categories_query
+        from utils import save_batch_learned_items
+
+        rng = random.Random(args.seed)
+        with app.app_context():
+            user = create_benchmark_user()
+            user_id = user.id
+            category_ids = [category_id for (category_id,) in db.session.query(Category.id)]
+            db.session.execute(db.insert(Expense), [
+                {'user_id': user_id, 'category_id': rng.choice(category_ids), 'description': f"ITEM {i}",
+                 'amount': 1.0, 'date': datetime(2024, 1, 1)} for i in range(args.corrections)])
+            db.session.commit()
+            expense_ids = [expense_id for (expense_id,) in db.session.query(Expense.id)]
+            corrections = [{'expense_id': expense_id, 'new_category_id': rng.choice(category_ids),
+                            'description': f"ITEM {expense_id}"} for expense_id in expense_ids]
+
+            statements = []
+            event.listen(db.engine, "before_cursor_execute", lambda *_: statements.append(1))
+
+            # The per-row path: two lookups per correction, then one learned-items rewrite
+            start = time.perf_counter()
+            for correction in corrections:
+                expense = db.session.get(Expense, correction['expense_id'])
+                if expense and expense.user_id == user_id:
+                    expense.category_id = correction['new_category_id']
+            db.session.commit()
+            learned = []
+            for correction in corrections:
+                category = visible_categories_query(user_id).filter(
+                    Category.id == correction['new_category_id']).first()
+                learned.append({'description': correction['description'], 'category_name': category.name})
+            save_batch_learned_items(learned)
+            per_row_ms = (time.perf_counter() - start) * 1000
+            per_row_statements = len(statements)
+            db.session.remove()
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        for correction in corrections:
+            correction['new_category_id'] = rng.choice(category_ids)
+        del statements[:]
+        start = time.perf_counter()
+        response = client.post('/update_multiple_categories', json={'corrections': corrections})
+        bulk_ms = (time.perf_counter() - start) * 1000
+        updated = response.get_json()['updated_count']
+
+    print(f"Corrections in one request: {len(corrections)}  updated: {updated}")
+    print(f"per-row:    {per_row_ms:8.1f} ms  {per_row_statements} statements")
+    print(f"set-based:  {bulk_ms:8.1f} ms  {len(statements)} statements  speedup: {per_row_ms / bulk_ms:.1f}x")
+
+
+def bench_recategorize(args):
+    """Background re-categorization of one description across a large expense table."""
+    with tempfile.TemporaryDirectory() as tmp:
+        app = load_app(os.path.join(tmp, "bench.db"))
+
+        from models import db, Expense, Category
+        from metrics import get_stage_histogram
+        from recategorizer import recategorize_history
+        from normalizer import normalize_description
+
+        rng = random.Random(args.seed)
+        with app.app_context():
+            user_id = create_benchmark_user().id
+            other_id = create_benchmark_user("other").id
+            old_category, new_category = [category_id for (category_id,) in db.session.query(Category.id).limit(2)]
+            target = "CORNER BAKERY"
+            start = time.perf_counter()
+            for offset in range(0, args.rows, 50000):
+                db.session.execute(db.insert(Expense), [
+                    {'user_id': user_id if rng.random() < 0.5 else other_id, 'category_id': old_category,
+                     'description': f"{target} #{rng.randint(1, 999)}" if rng.random() < args.match_ratio
+                     else f"{rng.choice(SAMPLE_MERCHANTS)} #{rng.randint(1, 999)}",
+                     'amount': 1.0, 'date': datetime(2024, 1, 1)} for _ in range(min(50000, args.rows - offset))])
+                db.session.commit()
+            load_s = time.perf_counter() - start
+
+            normalized = normalize_description(target)
+            histogram = get_stage_histogram("recategorize_chunk")
+            start = time.perf_counter()
+            changed = recategorize_history(user_id, {normalized: new_category}, args.chunk_size)
+            chunked_s = time.perf_counter() - start
+            _, chunk_total, chunks = histogram.snapshot()
+
+            # The same change as one statement holds the write lock for all of it
+            start = time.perf_counter()
+            db.session.execute(db.update(Expense).where(
+                Expense.user_id == user_id, Expense.normalized_description == normalized).values(
+                category_id=old_category))
+            db.session.commit()
+            single_s = time.perf_counter() - start
+
+    print(f"Rows: {args.rows} (loaded in {load_s:.1f}s)  matching rows changed: {changed}  "
+          f"chunk size: {args.chunk_size}")
+    print(f"chunked:        {chunked_s:.2f}s  {changed / chunked_s:,.0f} rows/s  {chunks} chunks, "
+          f"mean {chunk_total * 1000 / max(chunks, 1):.1f} ms per locked chunk")
+    print(f"one statement:  {single_s:.2f}s  {changed / single_s:,.0f} rows/s  write lock held {single_s * 1000:.0f} ms")
+
+
+def bench_search(args):
+    """Full-text expense search vs a LIKE scan on a large seeded table."""
+    from corpus_generator import load_category_keywords, make_description
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = load_app(os.path.join(tmp, "bench.db"))
+
+        from models import db, Expense, Category
+        from expense_search import search_backend, parse_search_terms, search_expenses
+        from api import build_expense_query
+
+        rng = random.Random(args.seed)
+        keywords = [keyword for words in load_category_keywords().values() for keyword in words]
+        with app.app_context():
+            user_ids = [create_benchmark_user(f"user{i}").id for i in range(args.users)]
+            category_id = db.session.query(Category.id).first()[0]
+            start = time.perf_counter()
+            for offset in range(0, args.rows, 50000):
+                db.session.execute(db.insert(Expense), [
+                    {'user_id': rng.choice(user_ids), 'category_id': category_id,
+                     'description': (f"{rng.choice(SAMPLE_MERCHANTS)} #{rng.randint(1, 9999)}" if rng.random() < 0.3
+                                     else make_description(rng, rng.choice(keywords), True)),
+                     'amount': 1.0, 'date': datetime(2024, 1, 1) + timedelta(minutes=offset + i)}
+                    for i in range(min(50000, args.rows - offset))])
+                db.session.commit()
+            load_s = time.perf_counter() - start
+
+            queries = ["coffee", "starb", "whole foods", "milk", "organic ban", "netflix", "toothpaste"]
+            user_id = user_ids[0]
+            results = {}
+            for name, run in (
+                    ("fts rank", lambda q: search_expenses(user_id, parse_search_terms(q), 50, 'rank')),
+                    ("fts date", lambda q: search_expenses(user_id, parse_search_terms(q), 50, 'date')),
+                    ("like scan", lambda q: build_expense_query(user_id, {'q': q}).limit(50).all())):
+                durations = []
+                for _ in range(args.repeat):
+                    for query in queries:
+                        start = time.perf_counter()
+                        run(query)
+                        durations.append((time.perf_counter() - start) * 1000)
+                durations.sort()
+                results[name] = durations
+            backend = search_backend(db.engine)
+
+    print(f"Rows: {args.rows} over {args.users} users (loaded in {load_s:.1f}s, {args.rows / load_s:,.0f} rows/s "
+          f"with the index maintained)  backend: {backend}")
+    print(f"{'method':<12}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name, durations in results.items():
+        print(f"{name:<12}{durations[len(durations) // 2]:>10.2f}"
+              f"{durations[int(0.95 * (len(durations) - 1))]:>10.2f}{durations[-1]:>10.2f}")
+
+
+def bench_recurring(args):
+    """Recurring-charge detection over one user's large history: cold load, incremental refresh, accuracy."""
+    with tempfile.TemporaryDirectory() as tmp:
+        app = load_app(os.path.join(tmp, "bench.db"))
+
+        from models import db, Expense, Category
+        from recurring import RecurringIndex, detect_patterns, find_recurring_expenses
+        from normalizer import normalize_description
+
+        rng = random.Random(args.seed)
+        end = datetime(2025, 1, 1)
+        start_date = end - timedelta(days=365 * args.years)
+        # Planted subscriptions: (description, period days, amount); some drift in price or day
+        periods = [7, 14, 30, 30, 30, 91, 365]
+        planted = [(f"SUBSCRIPTION SERVICE {chr(65 + i // 26)}{chr(65 + i % 26)}", rng.choice(periods),
+                    round(rng.uniform(3, 120), 2)) for i in range(args.subscriptions)]
+        rows = []
+        for description, period, amount in planted:
+            day = start_date + timedelta(days=rng.randrange(period))
+            while day < end:
+                rows.append((description, round(amount, 2), day))
+                # Occasional price rises and a day or two of slack
+                if rng.random() < 0.05:
+                    amount *= 1.1
+                day += timedelta(days=(30.44 if period == 30 else period) + rng.choice([-1, 0, 0, 0, 1]))
+        # Regular visits with irregular amounts are not subscriptions
+        day = start_date
+        while day < end:
+            rows.append(("CORNER GROCERY", round(rng.uniform(20, 150), 2), day))
+            day += timedelta(days=rng.randint(5, 9))
+        span = (end - start_date).total_seconds()
+        while len(rows) < args.rows:
+            rows.append((f"{rng.choice(SAMPLE_MERCHANTS)} #{rng.randint(1, 999)}", round(rng.uniform(1, 200), 2),
+                         start_date + timedelta(seconds=rng.random() * span)))
+        rng.shuffle(rows)
+
+        with app.app_context():
+            user_id = create_benchmark_user().id
+            category_id = db.session.query(Category.id).first()[0]
+            # Saved well before the index is loaded, as a real history is
+            created_at = datetime.utcnow() - timedelta(days=1)
+            start = time.perf_counter()
+            for offset in range(0, len(rows), 50000):
+                db.session.execute(db.insert(Expense), [
+                    {'user_id': user_id, 'category_id': category_id, 'description': description,
+                     'amount': amount, 'date': date, 'created_at': created_at}
+                    for description, amount, date in rows[offset:offset + 50000]])
+                db.session.commit()
+            load_s = time.perf_counter() - start
+
+            index = RecurringIndex()
+            start = time.perf_counter()
+            index.refresh(user_id)
+            cold_s = time.perf_counter() - start
+            start = time.perf_counter()
+            detect_patterns(index.codes, index.days, index.amounts)
+            detect_s = time.perf_counter() - start
+
+            # A day of new expenses; a subscription's next charge takes the lowest id but commits last,
+            # as a slow concurrent transaction would
+            description, _, amount = planted[0]
+            late_id = index.last_id + 1
+            db.session.execute(db.insert(Expense), [
+                {'id': late_id + 1 + i, 'user_id': user_id, 'category_id': category_id, 'amount': 5.0, 'date': end,
+                 'description': f"{rng.choice(SAMPLE_MERCHANTS)} #{rng.randint(1, 999)}"} for i in range(99)])
+            db.session.commit()
+            start = time.perf_counter()
+            added = index.refresh(user_id)
+            refresh_s = time.perf_counter() - start
+            db.session.add(Expense(id=late_id, user_id=user_id, category_id=category_id, description=description,
+                                   amount=amount, date=end))
+            db.session.commit()
+            added += index.refresh(user_id)
+            late_code = index.keys[normalize_description(description)]
+            late_found = late_code in index.patterns and index.patterns[late_code]['last_day'] == end.toordinal()
+
+            found = {index.descriptions[code] for code in index.patterns}
+            expected = {description for description, _, _ in planted}
+            active = find_recurring_expenses(user_id, today=end.date())
+            groups = len(index.normalized)
+
+    true_positives = len(found & expected)
+    print(f"Rows: {len(rows)} for one user over {args.years} years, {groups} distinct descriptions "
+          f"(loaded in {load_s:.1f}s)")
+    print(f"cold load + detect:   {cold_s:.2f}s  (detection alone {detect_s * 1000:.0f} ms)")
+    print(f"incremental refresh:  {refresh_s * 1000:.1f} ms for 100 new expenses ({added} new description-days)")
+    print(f"charge committed below the last id read: {'picked up' if late_found else 'MISSED'}")
+    print(f"planted {len(expected)}  found {len(found)}  recall {true_positives / len(expected):.3f}  "
+          f"false positives {len(found - expected)}  active {len(active)}")
+
+
+def bench_budgets(args):
+    """Budget status from the running counters vs summing the month's expenses on every view."""
+    with tempfile.TemporaryDirectory() as tmp:
+        app = load_app(os.path.join(tmp, "bench.db"))
+
+        from models import db, Expense, Category, Budget
+        from budgets import record_expenses, budget_status, month_of
+
+        rng = random.Random(args.seed)
+        with app.app_context():
+            user_id = create_benchmark_user().id
+            category_ids = [category_id for (category_id,) in db.session.query(Category.id)]
+            db.session.add_all(Budget(user_id=user_id, category_id=category_id, monthly_limit=1000.0)
+                               for category_id in category_ids[:args.budgets])
+            db.session.commit()
+
+            # Inserted like a statement import: 1000-row batches, counters updated in the same transaction
+            end = datetime(2025, 1, 1)
+            counter_s = 0.0
+            start = time.perf_counter()
+            for offset in range(0, args.rows, 1000):
+                rows = [{'user_id': user_id, 'category_id': rng.choice(category_ids), 'amount': round(rng.uniform(1, 200), 2),
+                         'description': f"{rng.choice(SAMPLE_MERCHANTS)} #{rng.randint(1, 999)}",
+                         'date': end - timedelta(days=rng.randrange(365 * args.years))}
+                        for _ in range(min(1000, args.rows - offset))]
+                db.session.execute(db.insert(Expense), rows)
+                counter_start = time.perf_counter()
+                record_expenses(user_id, rows)
+                counter_s += time.perf_counter() - counter_start
+                db.session.commit()
+            load_s = time.perf_counter() - start
+
+            month = month_of(end - timedelta(days=1))
+            month_start = datetime(end.year - 1, 12, 1)
+            results = {}
+            for name, run in (
+                    ("counters", lambda: budget_status(user_id, month)),
+                    ("sum scan", lambda: db.session.query(Expense.category_id, db.func.sum(Expense.amount)).filter(
+                        Expense.user_id == user_id, Expense.date >= month_start, Expense.date < end,
+                        Expense.category_id.in_(category_ids[:args.budgets])).group_by(Expense.category_id).all()),
+                    ("sum all months", lambda: db.session.query(Expense.category_id, db.func.sum(Expense.amount)).filter(
+                        Expense.user_id == user_id).group_by(Expense.category_id).all())):
+                durations = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    run()
+                    durations.append((time.perf_counter() - start) * 1000)
+                durations.sort()
+                results[name] = durations
+
+    print(f"Rows: {args.rows} over {args.years} years, {args.budgets} budgets (loaded in {load_s:.1f}s; "
+          f"counter updates {counter_s * 1000 / (args.rows / 1000):.1f} ms per 1000-row batch)")
+    print(f"{'status from':<16}{'p50 ms':>10}{'max ms':>10}")
+    for name, durations in results.items():
+        print(f"{name:<16}{durations[len(durations) // 2]:>10.2f}{durations[-1]:>10.2f}")
+
+
+def current_rss_mb():
+    """Resident set size of this process right now in MB (Linux)."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def bench_export(args):
+    """Streaming /api/expenses/export of a small and a large account: throughput and memory growth."""
+    import threading
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = load_app(os.path.join(tmp, "bench.db"))
+
+        from models import db, Expense, Category
+
+        rng = random.Random(args.seed)
+        with app.app_context():
+            category_id = db.session.query(Category.id).first()[0]
+            accounts = {"small": (create_benchmark_user("small").id, args.rows // 10),
+                        "large": (create_benchmark_user("large").id, args.rows)}
+            start = time.perf_counter()
+            for user_id, rows in accounts.values():
+                for offset in range(0, rows, 50000):
+                    db.session.execute(db.insert(Expense), [
+                        {'user_id': user_id, 'category_id': category_id, 'amount': round(rng.uniform(1, 200), 2),
+                         'description': f"{rng.choice(SAMPLE_MERCHANTS)} #{rng.randint(1, 9999)}",
+                         'date': datetime(2024, 1, 1) + timedelta(minutes=offset + i)}
+                        for i in range(min(50000, rows - offset))])
+                    db.session.commit()
+            load_s = time.perf_counter() - start
+
+        client = app.test_client()
+        results = []
+        for export_format in args.formats.split(','):
+            for name, (user_id, rows) in accounts.items():
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(user_id)
+                    session['_fresh'] = True
+                baseline = current_rss_mb()
+                peak = [baseline]
+                done = threading.Event()
+
+                def sample():
+                    while not done.wait(0.01):
+                        peak[0] = max(peak[0], current_rss_mb())
+
+                sampler = threading.Thread(target=sample)
+                sampler.start()
+                start = time.perf_counter()
+                response = client.get(f"/api/expenses/export?format={export_format}", buffered=False)
+                size = sum(len(chunk) for chunk in response.response)
+                response.close()
+                elapsed = time.perf_counter() - start
+                done.set()
+                sampler.join()
+                results.append((export_format, name, rows, elapsed, size, peak[0] - baseline))
+
+    print(f"Accounts: small {args.rows // 10} rows, large {args.rows} rows (loaded in {load_s:.1f}s)")
+    print(f"{'format':<9}{'account':<9}{'rows':>9}{'seconds':>9}{'rows/s':>10}{'MB out':>9}{'RSS growth MB':>15}")
+    for export_format, name, rows, elapsed, size, growth in results:
+        print(f"{export_format:<9}{name:<9}{rows:>9}{elapsed:>9.2f}{rows / elapsed:>10,.0f}"
+              f"{size / 1024 / 1024:>9.1f}{growth:>15.1f}")
+
+
+def bench_history(args):
+    """Walk /api/expenses page by page: keyset pages must be stable, complete and non-overlapping, in bounded memory."""
+    import threading
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = load_app(os.path.join(tmp, "bench.db"))
+
+        from models import db, Expense, Category
+
+        rng = random.Random(args.seed)
+        with app.app_context():
+            user_id = create_benchmark_user().id
+            category_ids = [row[0] for row in db.session.query(Category.id).limit(3)]
+            start = time.perf_counter()
+            for offset in range(0, args.rows, 50000):
+                # Several expenses share each timestamp, so pages often split a tie on date
+                db.session.execute(db.insert(Expense), [
+                    {'user_id': user_id, 'category_id': rng.choice(category_ids), 'amount': round(rng.uniform(1, 200), 2),
+                     'description': f"{rng.choice(SAMPLE_MERCHANTS)} #{rng.randint(1, 9999)}",
+                     'date': datetime(2024, 1, 1) + timedelta(hours=(offset + i) // 7)}
+                    for i in range(min(50000, args.rows - offset))])
+                db.session.commit()
+            load_s = time.perf_counter() - start
+            expected = {}
+            for name, extra in (("all", {}), ("category", {'category_id': category_ids[0]})):
+                query = db.session.query(Expense.id).filter(Expense.user_id == user_id, *[
+                    getattr(Expense, column) == value for column, value in extra.items()])
+                expected[name] = (extra, [row[0] for row in query.order_by(Expense.date.desc(), Expense.id.desc())])
+
+        # A real server, so pages stream over HTTP as they would to a browser
+        import requests
+        from werkzeug.serving import make_server
+        import logging
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        http = requests.Session()
+        http.post(f"{base_url}/login", data={'email': "benchmark@example.com", 'password': "benchmark"},
+                  allow_redirects=False)
+
+        def get_page(params):
+            with http.get(f"{base_url}/api/expenses", params=params, stream=True) as response:
+                response.raise_for_status()
+                return json.loads(b"".join(response.iter_content(64 * 1024)))
+
+        failures = []
+        results = []
+        for name, (extra, expected_ids) in expected.items():
+            baseline = current_rss_mb()
+            peak = [baseline]
+            done = threading.Event()
+
+            def sample():
+                while not done.wait(0.01):
+                    peak[0] = max(peak[0], current_rss_mb())
+
+            sampler = threading.Thread(target=sample)
+            sampler.start()
+            seen = []
+            page_ms = []
+            cursor = None
+            start = time.perf_counter()
+            while True:
+                params = dict(extra, limit=args.page_size)
+                if cursor:
+                    params['cursor'] = cursor
+                page_start = time.perf_counter()
+                page = get_page(params)
+                page_ms.append((time.perf_counter() - page_start) * 1000)
+                ids = [expense['id'] for expense in page['expenses']]
+                if cursor and get_page(params)['expenses'] != page['expenses']:
+                    failures.append(f"{name}: the page after cursor {cursor} changed between two requests")
+                if len(page_ms) == 2:
+                    # Expenses saved mid-walk are newer than the cursor and must not shift later pages
+                    with app.app_context():
+                        db.session.execute(db.insert(Expense), [
+                            {'user_id': user_id, 'category_id': category_ids[0], 'amount': 1.0,
+                             'description': "ADDED WHILE PAGING", 'date': datetime(2100, 1, 1)}
+                            for _ in range(args.page_size)])
+                        db.session.commit()
+                seen.extend(ids)
+                cursor = page['next_cursor']
+                if not cursor:
+                    break
+            elapsed = time.perf_counter() - start
+            done.set()
+            sampler.join()
+
+            with app.app_context():
+                db.session.query(Expense).filter(Expense.description == "ADDED WHILE PAGING").delete()
+                db.session.commit()
+
+            if len(set(seen)) != len(seen):
+                failures.append(f"{name}: {len(seen) - len(set(seen))} expenses were returned on more than one page")
+            if seen != expected_ids:
+                missing = len(set(expected_ids) - set(seen))
+                failures.append(f"{name}: pages differ from the (date, id) order of the table "
+                                f"({len(seen)} returned, {len(expected_ids)} expected, {missing} missing)")
+            growth = peak[0] - baseline
+            if growth > args.max_growth_mb:
+                failures.append(f"{name}: RSS grew {growth:.1f} MB while paging (limit {args.max_growth_mb:.0f} MB)")
+            results.append((name, len(expected_ids), len(page_ms), elapsed, page_ms, growth))
+        server.shutdown()
+
+    print(f"Rows: {args.rows}, {args.page_size} per page (loaded in {load_s:.1f}s)")
+    print(f"{'filter':<10}{'rows':>9}{'pages':>7}{'seconds':>9}{'first ms':>10}{'p50 ms':>8}{'last ms':>9}"
+          f"{'RSS growth MB':>15}")
+    for name, rows, pages, elapsed, page_ms, growth in results:
+        print(f"{name:<10}{rows:>9}{pages:>7}{elapsed:>9.2f}{page_ms[0]:>10.2f}{sorted(page_ms)[len(page_ms) // 2]:>8.2f}"
+              f"{page_ms[-1]:>9.2f}{growth:>15.1f}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+def bench_archive(args):
+    """Table size, index size and query latency before and after archiving all but the last year of expenses."""
+    with tempfile.TemporaryDirectory() as tmp:
+        app = load_app(os.path.join(tmp, "bench.db"))
+
+        import archive
+        from models import db, Expense, Category
+        from sqlalchemy import text
+        from api import build_expense_query
+        from expense_search import parse_search_terms, search_expenses
+        from budgets import rebuild_counters
+
+        archive.ARCHIVE_DIR = os.path.join(tmp, "archive")
+        rng = random.Random(args.seed)
+        years = args.years
+        first_day = datetime(2025 - years, 1, 1)
+        minutes = years * 365 * 24 * 60
+        with app.app_context():
+            user_ids = [create_benchmark_user(f"user{i}").id for i in range(args.users)]
+            category_ids = [row[0] for row in db.session.query(Category.id).limit(8)]
+            start = time.perf_counter()
+            for offset in range(0, args.rows, 50000):
+                db.session.execute(db.insert(Expense), [
+                    {'user_id': rng.choice(user_ids), 'category_id': rng.choice(category_ids),
+                     'description': f"{rng.choice(SAMPLE_MERCHANTS)} #{rng.randint(1, 9999)}",
+                     'amount': round(rng.uniform(1, 200), 2),
+                     'date': first_day + timedelta(minutes=rng.randrange(minutes))}
+                    for _ in range(min(50000, args.rows - offset))])
+                db.session.commit()
+            load_s = time.perf_counter() - start
+
+            user_id = user_ids[0]
+            recent = {'date_from': '2024-12-01', 'date_to': '2024-12-31'}
+            new_rows = [{'user_id': user_id, 'category_id': category_ids[0], 'description': "Bench insert",
+                         'amount': 1.0, 'date': datetime(2024, 12, 31)} for _ in range(5000)]
+
+            def insert_batch():
+                db.session.execute(db.insert(Expense), new_rows)
+                db.session.rollback()
+
+            probes = [
+                ("history page", lambda: build_expense_query(user_id, {}).limit(50).all()),
+                ("last month", lambda: build_expense_query(user_id, recent).all()),
+                ("like scan", lambda: build_expense_query(user_id, {'q': 'zzz'}).limit(50).all()),
+                ("fts search", lambda: search_expenses(user_id, parse_search_terms("coffee"), 50)),
+                ("count user", lambda: db.session.query(db.func.count(Expense.id)).filter(
+                    Expense.user_id == user_id).scalar()),
+                ("insert 5k", insert_batch),
+            ]
+
+            def measure():
+                sizes = {}
+                for name, size in db.session.execute(text(
+                        "SELECT name, SUM(pgsize) FROM dbstat WHERE name LIKE '%expense%' GROUP BY name")):
+                    group = "fts" if name.startswith("expense_fts") else "indexes" if name.startswith("ix_") else name
+                    sizes[group] = sizes.get(group, 0) + size
+                latencies = {}
+                for name, probe in probes:
+                    probe()
+                    durations = []
+                    for _ in range(args.repeat):
+                        start = time.perf_counter()
+                        probe()
+                        durations.append((time.perf_counter() - start) * 1000)
+                    latencies[name] = sorted(durations)[len(durations) // 2]
+                rows = db.session.query(db.func.count(Expense.id)).scalar()
+                return rows, sizes, latencies
+
+            before = measure()
+            cutoff = datetime(2024, 1, 1)
+            start = time.perf_counter()
+            archived = archive.archive_expenses(cutoff)
+            archive_s = time.perf_counter() - start
+            db.session.close()
+            with db.engine.connect() as connection:
+                connection.execute(text("VACUUM"))
+            after = measure()
+            archive_bytes = sum(os.path.getsize(path) for user in user_ids for _, path in archive.archive_files(user))
+
+            start = time.perf_counter()
+            rebuild_counters()
+            rebuild_s = time.perf_counter() - start
+
+    print(f"Rows: {args.rows} over {args.users} users and {years} years (loaded in {load_s:.1f}s); "
+          f"archived {archived} dated before {cutoff:%Y-%m-%d} in {archive_s:.1f}s "
+          f"({archived / archive_s:,.0f} rows/s)")
+    print(f"Archive files: {archive_bytes / 1024 / 1024:.1f} MB; rebuilding counters from table and archive: "
+          f"{rebuild_s:.2f}s")
+    print(f"{'':<16}{'before':>12}{'after':>12}")
+    print(f"{'rows':<16}{before[0]:>12}{after[0]:>12}")
+    for name in before[1]:
+        print(f"{name + ' MB':<16}{before[1][name] / 1024 / 1024:>12.1f}{after[1].get(name, 0) / 1024 / 1024:>12.1f}")
+    for name in before[2]:
+        print(f"{name + ' ms':<16}{before[2][name]:>12.2f}{after[2][name]:>12.2f}")
+
+
+def bench_partitions(args):
+    """Postgres: partition pruning and latency of date-filtered queries before and after partitioning by month."""
+    if not args.database_url.startswith("postgresql"):
+        sys.exit("partitions needs --database-url of an empty scratch Postgres database")
+    os.environ["DATABASE_URL"] = args.database_url
+    from app import app, init_database
+    from models import db, Expense, Category
+    from api import build_expense_query
+    from partitions import partition_expense_table, scanned_partitions, partition_name
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        init_database()
+        if db.session.query(Expense.id).first():
+            sys.exit("The database already has expenses; use an empty scratch database")
+        try:
+            user_ids = [create_benchmark_user(f"user{i}").id for i in range(args.users)]
+            category_ids = [row[0] for row in db.session.query(Category.id).limit(8)]
+            today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            first_day = today - timedelta(days=30 * args.months)
+            span = int((today - first_day).total_seconds())
+            start = time.perf_counter()
+            for offset in range(0, args.rows, 50000):
+                db.session.execute(db.insert(Expense), [
+                    {'user_id': rng.choice(user_ids), 'category_id': rng.choice(category_ids),
+                     'description': f"{rng.choice(SAMPLE_MERCHANTS)} #{rng.randint(1, 9999)}",
+                     'amount': round(rng.uniform(1, 200), 2),
+                     'date': first_day + timedelta(seconds=rng.randrange(span))}
+                    for _ in range(min(50000, args.rows - offset))])
+                db.session.commit()
+            load_s = time.perf_counter() - start
+            db.session.execute(db.text("ANALYZE expense"))
+            db.session.commit()
+
+            user_id = user_ids[0]
+            month_start = today.replace(day=1)
+            previous_month = (month_start - timedelta(days=1)).replace(day=1)
+            quarter_start = (previous_month - timedelta(days=62)).replace(day=1)
+            # (name, filters, months whose partitions the query may read)
+            probes = [
+                ("last month", {'date_from': f"{previous_month:%Y-%m-%d}",
+                                'date_to': f"{month_start - timedelta(days=1):%Y-%m-%d}"}, [previous_month]),
+                ("one day", {'date_from': f"{previous_month:%Y-%m-%d}", 'date_to': f"{previous_month:%Y-%m-%d}"},
+                 [previous_month]),
+                ("quarter, category", {'date_from': f"{quarter_start:%Y-%m-%d}",
+                                       'date_to': f"{month_start - timedelta(days=1):%Y-%m-%d}",
+                                       'category_id': str(category_ids[0])},
+                 [quarter_start, (quarter_start + timedelta(days=32)).replace(day=1), previous_month]),
+                ("since month start", {'date_from': f"{month_start:%Y-%m-%d}"}, None),
+                ("no date filter", {}, None),
+            ]
+
+            def measure():
+                latencies = {}
+                for name, filters, _ in probes:
+                    query = build_expense_query(user_id, filters)
+                    query.all()
+                    durations = []
+                    for _ in range(args.repeat):
+                        start = time.perf_counter()
+                        query.all()
+                        durations.append((time.perf_counter() - start) * 1000)
+                    latencies[name] = sorted(durations)[len(durations) // 2]
+                return latencies
+
+            before = measure()
+            db.session.commit()
+            db.session.close()
+            start = time.perf_counter()
+            partition_expense_table(db.engine)
+            partition_s = time.perf_counter() - start
+            after = measure()
+            total = db.session.execute(db.text(
+                "SELECT count(*) FROM pg_inherits WHERE inhparent = 'expense'::regclass")).scalar()
+            scanned = {name: scanned_partitions(build_expense_query(user_id, filters)) for name, filters, _ in probes}
+            # Sanity check that nothing was lost in the copy
+            copied = db.session.query(db.func.count(Expense.id)).scalar()
+        finally:
+            db.session.rollback()
+            db.drop_all()
+
+    print(f"Rows: {args.rows} over {args.months} months (loaded in {load_s:.1f}s); partitioned in {partition_s:.1f}s "
+          f"into {total} partitions; {copied} rows after the copy")
+    print(f"{'query':<20}{'before ms':>11}{'after ms':>10}{'partitions read':>17}  pruned as expected")
+    failed = False
+    for name, _, months in probes:
+        expected = {partition_name(month) for month in months} if months else None
+        ok = expected is None or set(scanned[name]) <= expected
+        failed |= not ok
+        print(f"{name:<20}{before[name]:>11.2f}{after[name]:>10.2f}{len(scanned[name]):>12} of {total:<3}"
+              f"  {'-' if expected is None else 'yes' if ok else 'NO: ' + ', '.join(scanned[name])}")
+    if failed or copied != args.rows:
+        sys.exit(1)
+
+
+def memory_rollup_kb(pid):
+    """Rss, Pss and unique (private) kB of a process, from /proc/<pid>/smaps_rollup (Linux)."""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                fields[name] = int(value.split()[0])
+    return {'rss': fields['Rss'], 'pss': fields['Pss'],
+            'uss': fields['Private_Clean'] + fields['Private_Dirty']}
+
+
+def category_index_worker(args):
+    """One worker of bench_category_index: serve uploads, report a checksum of the results, wait for stdin."""
+    import hashlib
+    from app import app
+    from models import db, User
+    from categorizer import get_user_categories, load_user_learned_items, categorize_item
+
+    rng = random.Random(args.seed)
+    digest = hashlib.sha256()
+    with app.app_context():
+        user_ids = [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+        # A long-running worker ends up with every active user's categories
+        for user_id in user_ids:
+            get_user_categories(user_id)
+        with open(os.environ["LEARNED_ITEMS_PATH"]) as f:
+            learned_keys = list(json.load(f))
+        for _ in range(args.uploads):
+            user_id = rng.choice(user_ids)
+            categories, automaton = get_user_categories(user_id)
+            learned_items = load_user_learned_items(user_id)
+            items = [rng.choice(learned_keys) if rng.random() < 0.2 else
+                     f"{rng.choice(SAMPLE_MERCHANTS)} {rng.randint(1, 999)}" for _ in range(args.items)]
+            for item in items:
+                digest.update(repr(categorize_item(item, categories, learned_items, use_open_food_facts=False,
+                                                   automaton=automaton)).encode())
+            digest.update(repr(sorted(categories)).encode())
+    print(json.dumps({'checksum': digest.hexdigest()}), flush=True)
+    sys.stdin.read()
+
+
+def bench_category_index(args):
+    """Memory of many worker processes with private category caches vs the shared, memory-mapped index."""
+    if args.worker:
+        return category_index_worker(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["LEARNED_ITEMS_PATH"] = os.path.join(tmp, "learned.json")
+        app = load_app(os.path.join(tmp, "bench.db"))
+
+        import category_index
+        import categorizer
+        from models import db, User, Category
+
+        rng = random.Random(args.seed)
+        with app.app_context():
+            db.session.execute(db.insert(User), [
+                {'username': f"user{i}", 'email': f"user{i}@example.com", 'password_hash': 'x',
+                 'categories_version': 0} for i in range(args.users)])
+            user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+            custom_users = rng.sample(user_ids, int(len(user_ids) * args.custom_ratio))
+            custom = []
+            for user_id in custom_users:
+                for i in range(rng.randint(1, 5)):
+                    keywords = [f"custom{user_id}x{i}x{k}" for k in range(rng.randint(3, 30))]
+                    custom.append({'user_id': user_id, 'name': f"Custom {i}", 'keywords': json.dumps(keywords)})
+            db.session.execute(db.insert(Category), custom)
+            db.session.query(User).filter(User.id.in_(custom_users)).update(
+                {User.categories_version: 1}, synchronize_session=False)
+            db.session.commit()
+            category_names = [data['name'] for data in categorizer.load_categories(None).values()]
+            with open(os.environ["LEARNED_ITEMS_PATH"], "w") as f:
+                json.dump({f"{rng.choice(SAMPLE_MERCHANTS).lower()} item {i}": rng.choice(category_names)
+                           for i in range(args.learned_items)}, f)
+
+            index_path = os.path.join(tmp, "category_index.bin")
+            start = time.perf_counter()
+            stats = category_index.build_category_index(index_path)
+            build_s = time.perf_counter() - start
+            start = time.perf_counter()
+            category_index.build_category_index(index_path)
+            rebuild_s = time.perf_counter() - start
+
+        results = {}
+        for mode, path in (("in-process", os.path.join(tmp, "missing.bin")), ("mapped", index_path)):
+            env = dict(os.environ, CATEGORY_INDEX_PATH=path)
+            command = [sys.executable, os.path.abspath(__file__), "category-index", "--worker",
+                       "--uploads", str(args.uploads), "--items", str(args.items), "--seed", str(args.seed)]
+            workers = [subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, env=env)
+                       for _ in range(args.workers)]
+            try:
+                checksums = {json.loads(worker.stdout.readline())['checksum'] for worker in workers}
+                # Every worker is alive and warm: measure them side by side, as a server would run them
+                memory = [memory_rollup_kb(worker.pid) for worker in workers]
+            finally:
+                for worker in workers:
+                    worker.stdin.close()
+                    worker.wait()
+            results[mode] = (memory, checksums)
+
+    print(f"Users: {args.users}  with custom categories: {len(custom_users)}  learned items: {args.learned_items}  "
+          f"workers: {args.workers}")
+    print(f"Index: {stats['bytes'] / 1024 / 1024:.1f} MB, {stats['sets']} category sets, built in {build_s:.2f} s, "
+          f"rebuilt in {rebuild_s:.2f} s reusing unchanged sets")
+    print(f"{'mode':<12}{'RSS/worker':>12}{'PSS/worker':>12}{'USS/worker':>12}{'PSS total':>12}  (MB)")
+    for mode, (memory, _) in results.items():
+        rss, pss, uss = (sum(sample[key] for sample in memory) / 1024 for key in ('rss', 'pss', 'uss'))
+        print(f"{mode:<12}{rss / len(memory):>12.1f}{pss / len(memory):>12.1f}{uss / len(memory):>12.1f}{pss:>12.1f}")
+    checksums = set.union(*(checksums for _, checksums in results.values()))
+    if len(checksums) != 1:
+        print("FAIL: workers categorized items differently")
+        return 1
+    print("All workers categorized every item the same way.")
+    return 0
+
+
+def dict_categorize_text(text, categories, user_learned_items, automaton):
+    """categorize_text as it was before ExpenseItem: a dict per extracted item, copied into a new dict per result."""
+    from categorizer import categorize_item, get_category_classifier
+    from circuit_breaker import LookupBudget
+    from normalizer import normalize_description
+    from receipt_parser import extract_date, extract_items
+
+    date = extract_date(text)
+    items = [{'description': item.description, 'amount': item.amount} for item in extract_items(text)]
+    classifier = get_category_classifier()
+    if classifier:
+        predictions = classifier.predict([normalize_description(item['description']) for item in items])
+    else:
+        predictions = [None] * len(items)
+    lookup_budget = LookupBudget(0)
+    categorized_items = []
+    for item, prediction in zip(items, predictions):
+        if any(skip in item['description'].lower() for skip in ['total', 'subtotal', 'tax', 'amount due', 'change due']):
+            continue
+        category_id = categorize_item(item['description'], categories, user_learned_items,
+                                      predicted_category=prediction, automaton=automaton,
+                                      lookup_budget=lookup_budget)
+        if category_id is None:
+            continue
+        categorized_items.append({
+            'description': item['description'],
+            'amount': item['amount'],
+            'category_id': category_id,
+            'category': categories[category_id]['name'],
+            'date': date
+        })
+    return categorized_items
+
+
+def bench_items(args):
+    """Memory and time of a large statement's items as ExpenseItem records vs the dicts they replaced."""
+    import gc
+    import tracemalloc
+    from categorizer import categorize_text
+    from keyword_matcher import get_keyword_automaton
+    from receipt_parser import parse_item_dates
+
+    rng = random.Random(args.seed)
+    categories = load_category_dict()
+    automaton = get_keyword_automaton(categories)
+    # Every description contains a keyword, so no item falls through to Open Food Facts
+    keywords = [keyword for data in categories.values() for keyword in data['keywords']
+                if not any(skip in keyword for skip in ('total', 'tax', 'amount due', 'change due'))]
+    lines = ["STATEMENT DATE 03/15/2024"] + [
+        f"{rng.choice(keywords).upper()} #{rng.randint(1, 99999)}   {rng.uniform(1, 500):.2f}"
+        for _ in range(args.items)]
+    text = "\n".join(lines)
+
+    def dict_rows(items):
+        return [{'description': item['description'][:256], 'amount': item['amount'],
+                 'category_id': item['category_id'],
+                 'date': datetime.strptime(item['date'], '%Y-%m-%d') if item.get('date') else datetime.now()}
+                for item in items]
+
+    def record_rows(items):
+        dates = parse_item_dates(items)
+        now = datetime.now()
+        return [{'description': item.description[:256], 'amount': item.amount, 'category_id': item.category_id,
+                 'date': dates[item.date] if item.date else now} for item in items]
+
+    runs = {
+        'dicts': (lambda: dict_categorize_text(text, categories, {}, automaton), dict_rows),
+        'records': (lambda: categorize_text(text, categories, {}, automaton), record_rows),
+    }
+    results = {}
+    for name, (categorize, rows) in runs.items():
+        gc.collect()
+        tracemalloc.start()
+        items = categorize()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del items
+        gc.collect()
+
+        categorize_s, rows_s = [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            items = categorize()
+            categorize_s.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            rows(items)
+            rows_s.append(time.perf_counter() - start)
+        results[name] = (len(items), retained, peak, min(categorize_s), min(rows_s))
+        del items
+
+    per_100k = 100_000 / args.items
+    print(f"Statement lines: {args.items:,}  (memory and times scaled to 100k items)")
+    print(f"{'items as':<10}{'kept':>9}{'retained MB':>13}{'peak MB':>10}{'categorize s':>14}{'to rows s':>11}")
+    for name, (count, retained, peak, categorize_s, rows_s) in results.items():
+        print(f"{name:<10}{count:>9,}{retained * per_100k / 1024 / 1024:>13.1f}{peak * per_100k / 1024 / 1024:>10.1f}"
+              f"{categorize_s * per_100k:>14.2f}{rows_s * per_100k:>11.2f}")
+    dicts, records = results['dicts'], results['records']
+    print(f"Records: {records[1] / records[0]:.0f} bytes per kept item vs {dicts[1] / dicts[0]:.0f}, "
+          f"{(dicts[3] + dicts[4]) - (records[3] + records[4]):.2f} s saved per {args.items:,} items")
+    if dicts[0] != records[0]:
+        print("FAIL: the two pipelines kept a different number of items")
+        return 1
+    return 0
+
+
+def start_identity_provider_stub():
+    """Serve a fake OpenID provider (discovery, token and userinfo endpoints) on localhost.
+
+    Returns (server, counts); counts holds the requests per path and the
+    client ports of the connections they arrived on.
+    """
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    counts = {'paths': {}, 'connections': set()}
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, so a pooled client can reuse its connection
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, document, headers=()):
+            path = self.path.split('?')[0]
+            counts['paths'][path] = counts['paths'].get(path, 0) + 1
+            counts['connections'].add(self.client_address[1])
+            body = json.dumps(document).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith('/.well-known/openid-configuration'):
+                base = f"http://127.0.0.1:{self.server.server_address[1]}"
+                self._reply({'authorization_endpoint': f"{base}/authorize", 'token_endpoint': f"{base}/token",
+                             'userinfo_endpoint': f"{base}/userinfo"}, [('Cache-Control', 'public, max-age=3600')])
+            else:
+                self._reply({'email': 'stub@example.com', 'email_verified': True, 'given_name': 'stub'})
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self._reply({'access_token': 'stub-token', 'token_type': 'Bearer', 'expires_in': 3600})
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, counts
+
+
+def bench_google_login(args):
+    """Google sign-ins against a stub provider: one discovery fetch and one pooled connection for all of them."""
+    import logging
+
+    server, counts = start_identity_provider_stub()
+    with tempfile.TemporaryDirectory() as tmp:
+        app = load_app(os.path.join(tmp, "bench.db"))
+        # The sign-in routes log every request at INFO
+        logging.getLogger().setLevel(logging.WARNING)
+
+        import google_auth
+        google_auth.GOOGLE_CLIENT_ID = "stub-client"
+        google_auth.GOOGLE_CLIENT_SECRET = "stub-secret"
+        google_auth.discovery_cache = google_auth.DiscoveryCache(
+            f"http://127.0.0.1:{server.server_address[1]}/.well-known/openid-configuration", google_auth.http_session)
+
+        failures = []
+        durations = []
+        for _ in range(args.logins):
+            client = app.test_client()
+            start = time.perf_counter()
+            redirect = client.get("/google_login")
+            callback = client.get("/google_login/callback?code=stub-code")
+            durations.append((time.perf_counter() - start) * 1000)
+            if not redirect.location.startswith(f"http://127.0.0.1:{server.server_address[1]}/authorize?"):
+                failures.append(f"/google_login redirected to {redirect.location}")
+                break
+            if not callback.location.endswith("/upload"):
+                failures.append(f"the callback redirected to {callback.location}, not /upload")
+                break
+    server.shutdown()
+
+    durations.sort()
+    requests_made = sum(counts['paths'].values())
+    print(f"Logins: {args.logins}  p50 {durations[len(durations) // 2]:.2f} ms  max {durations[-1]:.2f} ms")
+    print(f"Provider requests: {requests_made} ({', '.join(f'{path} {n}' for path, n in sorted(counts['paths'].items()))})"
+          f"  connections: {len(counts['connections'])}")
+
+    discovery_fetches = counts['paths'].get('/.well-known/openid-configuration', 0)
+    if discovery_fetches != 1:
+        failures.append(f"the discovery document was fetched {discovery_fetches} times, expected once")
+    # Logins run one at a time, so the pooled session should never need a second connection
+    if len(counts['connections']) != 1:
+        failures.append(f"{requests_made} provider requests used {len(counts['connections'])} connections, "
+                        f"expected one reused connection")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+def start_open_food_facts_stub():
+    """Serve a fake Open Food Facts search API on localhost with switchable faults.
+
+    Returns (server, fault); set fault['mode'] to 'ok', 'slow' (sleep
+    fault['delay'] seconds before answering) or 'error' (HTTP 503).
+    """
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    fault = {'mode': 'ok', 'delay': 1.0, 'requests': 0}
+    body = json.dumps({'products': [{'categories': 'Snacks, Chips'}]}).encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            fault['requests'] += 1
+            if fault['mode'] == 'slow':
+                time.sleep(fault['delay'])
+            if fault['mode'] == 'error':
+                self.send_response(503)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except OSError:
+                pass  # The client gave up waiting
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, fault
+
+
+def bench_open_food_facts(args):
+    """Upload latency while a stub Open Food Facts server is healthy, slow, failing and recovered."""
+    import categorizer
+    from circuit_breaker import CircuitBreaker, LookupBudget
+
+    server, fault = start_open_food_facts_stub()
+    categorizer.OPEN_FOOD_FACTS_URL = f"http://127.0.0.1:{server.server_address[1]}/cgi/search.pl"
+    categorizer.OPEN_FOOD_FACTS_TIMEOUT = args.timeout
+    fault['delay'] = args.timeout * 2
+    phases = [('ok', args.uploads), ('slow', args.uploads), ('error', args.uploads),
+              ('recovered', args.uploads)]
+
+    print(f"{'breaker':<9}{'phase':<11}{'mean upload s':>14}{'max upload s':>14}{'requests':>10}{'state':>11}")
+    for use_breaker in (False, True):
+        # Without the breaker it never sees enough failures to trip
+        categorizer.open_food_facts_breaker = CircuitBreaker(
+            "open_food_facts", min_calls=5 if use_breaker else 10 ** 9,
+            slow_call_seconds=args.timeout / 2, reset_timeout=args.reset_timeout)
+        upload_number = 0
+        for phase, uploads in phases:
+            fault['mode'] = 'ok' if phase == 'recovered' else phase
+            fault['requests'] = 0
+            if phase == 'recovered':
+                # Let the breaker half-open so the first lookup probes the recovered server
+                time.sleep(args.reset_timeout)
+            durations = []
+            for _ in range(uploads):
+                upload_number += 1
+                budget = LookupBudget(args.budget)
+                start = time.perf_counter()
+                for item in range(args.items):
+                    # Unique letter-only names (digits are normalized away) so every lookup misses the cache
+                    name = ''.join(chr(ord('a') + int(digit)) for digit in f"{use_breaker:d}{upload_number}{item:03d}")
+                    categorizer.get_open_food_facts_category(f"stub product {name}", budget)
+                durations.append(time.perf_counter() - start)
+            print(f"{'on' if use_breaker else 'off':<9}{phase:<11}{sum(durations) / len(durations):>14.2f}"
+                  f"{max(durations):>14.2f}{fault['requests']:>10}"
+                  f"{categorizer.open_food_facts_breaker.state:>11}")
+    server.shutdown()
+
+
+def render_text_image(text, width=600, align_prices=False):
+    """Draw receipt text onto a white grayscale image with OpenCV (no Poppler needed).
+
+    With align_prices, an amount ending a line is right-aligned as on a printed receipt.
+    """
+    import cv2
+    import numpy as np
+    lines = text.splitlines()
+    image = np.full((40 + 22 * len(lines), width), 255, np.uint8)
+    for i, line in enumerate(lines):
+        y = 30 + 22 * i
+        match = re.search(r'\s(-?\d+\.\d{2})$', line) if align_prices else None
+        if match:
+            (price_width, _), _ = cv2.getTextSize(match.group(1), cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+            cv2.putText(image, match.group(1), (width - 10 - price_width, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, 0, 1)
+            line = line[:match.start()].rstrip()
+        cv2.putText(image, line, (10, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, 0, 1)
+    return image
+
+
+def rephotograph(image, rng):
+    """Simulate another photo of the same receipt: small rotation, zoom, shift, exposure and blur."""
+    import cv2
+    height, width = image.shape
+    transform = cv2.getRotationMatrix2D((width / 2, height / 2), rng.uniform(-4, 4), rng.uniform(0.9, 1.1))
+    transform[:, 2] += [rng.uniform(-15, 15), rng.uniform(-15, 15)]
+    photo = cv2.warpAffine(image, transform, (width, height), borderValue=255)
+    photo = cv2.convertScaleAbs(photo, alpha=rng.uniform(0.8, 1.1), beta=rng.uniform(-20, 20))
+    return cv2.GaussianBlur(photo, (3, 3), 0)
+
+
+def bench_duplicates(args):
+    """Near-duplicate receipt detection: hash cost, accuracy and indexed vs linear lookup time."""
+    from corpus_generator import generate_documents
+    from ocr_processor import perceptual_hash
+    from receipt_index import MultiIndexHash, DUPLICATE_HASH_DISTANCE, DUPLICATE_ASPECT_TOLERANCE
+
+    rng = random.Random(args.seed)
+    images = [render_text_image(document['text']) for document in generate_documents(args.count, seed=args.seed)]
+
+    start = time.perf_counter()
+    hashes = [perceptual_hash(image) for image in images]
+    hash_ms = (time.perf_counter() - start) * 1000 / len(images)
+    retakes = [perceptual_hash(rephotograph(image, rng)) for image in images]
+
+    def is_duplicate(a, b):
+        return ((a[0] ^ b[0]).bit_count() <= args.distance
+                and abs(a[1] - b[1]) <= DUPLICATE_ASPECT_TOLERANCE)
+
+    recall = sum(is_duplicate(a, b) for a, b in zip(hashes, retakes)) / len(images)
+    pairs = false_matches = 0
+    for i in range(len(hashes)):
+        for j in range(i + 1, len(hashes)):
+            pairs += 1
+            false_matches += is_duplicate(hashes[i], hashes[j])
+
+    # Lookup cost for a user with many stored receipts: random 64-bit hashes plus the real ones
+    stored = [(rng.getrandbits(64), 0.0) for _ in range(args.index_size)] + hashes
+    index = MultiIndexHash()
+    for image_hash, aspect in stored:
+        index.add(image_hash, aspect)
+    start = time.perf_counter()
+    for image_hash, _ in retakes:
+        index.search(image_hash, args.distance)
+    index_us = (time.perf_counter() - start) * 1e6 / len(retakes)
+    start = time.perf_counter()
+    for image_hash, _ in retakes:
+        [stored_hash for stored_hash, _ in stored if (stored_hash ^ image_hash).bit_count() <= args.distance]
+    linear_us = (time.perf_counter() - start) * 1e6 / len(retakes)
+
+    print(f"Receipts: {len(images)}  max distance: {args.distance} (default {DUPLICATE_HASH_DISTANCE})  "
+          f"hash: {hash_ms:.2f} ms/image")
+    print(f"re-photographed receipts flagged: {recall:.1%}  false matches: {false_matches} of {pairs} pairs "
+          f"({false_matches / pairs:.3%})")
+    print(f"lookup in {len(stored)} hashes: multi-index {index_us:.0f} us  linear scan {linear_us:.0f} us")
+
+
+def score_item_text(truth_items, predicted_items):
+    """Count predicted items whose normalized description and amount match a ground-truth item."""
+    from normalizer import normalize_description
+    # Receipts print the first 30 characters of each description
+    remaining = [(normalize_description(item['description'][:30]), round(item['amount'], 2)) for item in truth_items]
+    correct = 0
+    for item in predicted_items:
+        key = (normalize_description(item.description), round(item.amount, 2))
+        if key in remaining:
+            remaining.remove(key)
+            correct += 1
+    return correct
+
+
+def bench_ocr(args):
+    """Item accuracy and OCR time of page-level text vs word boxes vs low-confidence line re-OCR."""
+    import numpy as np
+    import pytesseract
+    from corpus_generator import generate_documents
+    from ocr_processor import check_tesseract, preprocess_array, ocr_layout, layout_text, OCR_RECHECK_CONFIDENCE
+    from receipt_parser import extract_items
+
+    if not check_tesseract():
+        print("Tesseract is not installed")
+        return 1
+
+    rng = random.Random(args.seed)
+    noise = np.random.default_rng(args.seed)
+    documents = list(generate_documents(args.count, seed=args.seed, statement_ratio=0))
+    photos = []
+    for document in documents:
+        photo = rephotograph(render_text_image(document['text'], align_prices=True), rng).astype(np.float32)
+        photo += noise.normal(0, args.noise, photo.shape)
+        photos.append(np.clip(photo, 0, 255).astype(np.uint8))
+
+    def page_text(photo):
+        text = pytesseract.image_to_string(preprocess_array(photo), config='--psm 6 --oem 3')
+        return extract_items(text)
+
+    def word_boxes(photo):
+        lines = ocr_layout([photo], recheck=False)
+        return extract_items(layout_text(lines), lines)
+
+    def line_recheck(photo):
+        lines = ocr_layout([photo])
+        return extract_items(layout_text(lines), lines)
+
+    truth_total = sum(len(document['items']) for document in documents)
+    print(f"Receipts: {len(documents)}  items: {truth_total}  noise sigma: {args.noise}  "
+          f"recheck below confidence {OCR_RECHECK_CONFIDENCE:.0f}")
+    print(f"{'variant':<18}{'accuracy':>10}{'ms/receipt':>12}{'points per extra ms':>22}")
+    previous = None
+    for name, run in (("page text", page_text), ("word boxes", word_boxes), ("+ line re-OCR", line_recheck)):
+        correct = 0
+        start = time.perf_counter()
+        for document, photo in zip(documents, photos):
+            correct += score_item_text(document['items'], run(photo))
+        ms = (time.perf_counter() - start) * 1000 / len(documents)
+        accuracy = correct / truth_total
+        gain = "-"
+        if previous:
+            extra_ms = ms - previous[1]
+            points = (accuracy - previous[0]) * 100
+            gain = f"{points / extra_ms:+.4f}" if extra_ms > 0 else f"{points:+.2f} pts, no extra time"
+        print(f"{name:<18}{accuracy:>10.2%}{ms:>12.1f}{gain:>22}")
+        previous = accuracy, ms
+    return 0
+
+
+# Modules that must not be imported when a web worker loads the app
+HEAVY_STARTUP_MODULES = ("cv2", "numpy", "pytesseract", "pdf2image", "PIL")
+
+
+def parse_importtime(stderr):
+    """Parse `python -X importtime` output into {module: cumulative microseconds}."""
+    cumulative = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        cumulative[name.strip()] = int(cumulative_us)
+    return cumulative
+
+
+def bench_startup(args):
+    """Check the cold import time of the web app against a budget."""
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'startup.db')}")
+        samples = []
+        for _ in range(args.runs):
+            result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {args.module}"],
+                                    capture_output=True, text=True, env=env,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            if result.returncode != 0:
+                print(result.stderr)
+                return 1
+            samples.append(parse_importtime(result.stderr))
+
+    import_ms = sorted(sample[args.module] / 1000 for sample in samples)[len(samples) // 2]
+    heavy = sorted({module for sample in samples for module in sample
+                    if module.split(".")[0] in HEAVY_STARTUP_MODULES})
+    slowest = sorted((item for item in samples[0].items() if item[0] != args.module),
+                     key=lambda item: item[1], reverse=True)[:10]
+
+    print(f"import {args.module}: {import_ms:.1f} ms (median of {args.runs}, budget {args.budget_ms:.0f} ms)")
+    print("Slowest imports:")
+    for module, microseconds in slowest:
+        print(f"  {microseconds / 1000:8.1f} ms  {module}")
+
+    failed = False
+    if heavy:
+        print(f"FAIL: heavy OCR modules imported at startup: {', '.join(heavy)}")
+        failed = True
+    if import_ms > args.budget_ms:
+        print(f"FAIL: import time {import_ms:.1f} ms exceeds budget {args.budget_ms:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    import_parser = subparsers.add_parser("import", help="CSV statement import throughput")
+    import_parser.add_argument("--rows", type=int, default=1_000_000)
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+    import_parser.add_argument("--seed", type=int, default=0)
+    import_parser.set_defaults(func=bench_import)
+
+    suite_parser = subparsers.add_parser("suite", help="Per-stage timings and accuracy on a synthetic corpus")
+    suite_parser.add_argument("--count", type=int, default=200)
+    suite_parser.add_argument("--seed", type=int, default=0)
+    suite_parser.add_argument("--ocr", action="store_true",
+                              help="Render, preprocess and OCR documents (needs Tesseract and poppler)")
+    suite_parser.add_argument("--clean", action="store_true", help="Generate descriptions without SKU/quantity noise")
+    suite_parser.add_argument("--holdout", type=float, default=DEFAULT_HOLDOUT,
+                              help="Fraction of each category's keywords kept from the categorizer")
+    suite_parser.add_argument("--open-food-facts", action="store_true",
+                              help="Allow the Open Food Facts lookup for unmatched items")
+    suite_parser.add_argument("--output", help="Write results as JSON to this file")
+    suite_parser.add_argument("--baseline", help="Fail if slower or less accurate than this results file")
+    suite_parser.add_argument("--tolerance", type=float, default=0.2,
+                              help="Allowed fractional slowdown per stage against the baseline")
+    suite_parser.set_defaults(func=bench_suite)
+
+    startup_parser = subparsers.add_parser("startup", help="Cold import time budget for web workers")
+    startup_parser.add_argument("--module", default="main")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.add_argument("--budget-ms", type=float, default=800.0)
+    startup_parser.set_defaults(func=bench_startup)
+
+    classifier_parser = subparsers.add_parser("classifier", help="Classifier vs fuzzy keyword accuracy and speed")
+    classifier_parser.add_argument("--train-count", type=int, default=2000)
+    classifier_parser.add_argument("--test-count", type=int, default=500)
+    classifier_parser.add_argument("--seed", type=int, default=0)
+    classifier_parser.add_argument("--holdout", type=float, default=DEFAULT_HOLDOUT,
+                                   help="Fraction of each category's keywords neither engine is given")
+    classifier_parser.set_defaults(func=bench_classifier)
+
+    keywords_parser = subparsers.add_parser("keywords", help="Exact keyword pass hit rate and speedup")
+    keywords_parser.add_argument("--count", type=int, default=1000)
+    keywords_parser.add_argument("--seed", type=int, default=0)
+    keywords_parser.add_argument("--clean", action="store_true")
+    keywords_parser.add_argument("--holdout", type=float, default=DEFAULT_HOLDOUT,
+                                 help="Fraction of each category's keywords the matcher is not given")
+    keywords_parser.set_defaults(func=bench_keywords)
+
+    normalizer_parser = subparsers.add_parser("normalizer", help="Cache hit rates before and after normalization")
+    normalizer_parser.add_argument("--count", type=int, default=2000)
+    normalizer_parser.add_argument("--seed", type=int, default=0)
+    normalizer_parser.add_argument("--cache-size", type=int, default=1000)
+    normalizer_parser.set_defaults(func=bench_normalizer)
+
+    categories_parser = subparsers.add_parser("categories", help="Per-user category cache under many users")
+    categories_parser.add_argument("--users", type=int, default=2000)
+    categories_parser.add_argument("--custom-ratio", type=float, default=0.3)
+    categories_parser.add_argument("--uploads", type=int, default=20000)
+    categories_parser.add_argument("--cold-uploads", type=int, default=200,
+                                   help="Uploads timed without the cache")
+    categories_parser.add_argument("--edit-every", type=int, default=500,
+                                   help="Invalidate the uploading user's categories every N uploads (0 = never)")
+    categories_parser.add_argument("--seed", type=int, default=0)
+    categories_parser.set_defaults(func=bench_categories)
+
+    corrections_parser = subparsers.add_parser("corrections", help="Bulk category corrections in one request")
+    corrections_parser.add_argument("--corrections", type=int, default=5000)
+    corrections_parser.add_argument("--seed", type=int, default=0)
+    corrections_parser.set_defaults(func=bench_corrections)
+
+    recategorize_parser = subparsers.add_parser("recategorize", help="Re-categorizing a user's history after a correction")
+    recategorize_parser.add_argument("--rows", type=int, default=1_000_000)
+    recategorize_parser.add_argument("--match-ratio", type=float, default=0.05,
+                                     help="Share of rows with the corrected description")
+    recategorize_parser.add_argument("--chunk-size", type=int, default=2000)
+    recategorize_parser.add_argument("--seed", type=int, default=0)
+    recategorize_parser.set_defaults(func=bench_recategorize)
+
+    search_parser = subparsers.add_parser("search", help="Full-text expense search latency on seeded data")
+    search_parser.add_argument("--rows", type=int, default=1_000_000)
+    search_parser.add_argument("--users", type=int, default=10)
+    search_parser.add_argument("--repeat", type=int, default=5)
+    search_parser.add_argument("--seed", type=int, default=0)
+    search_parser.set_defaults(func=bench_search)
+
+    recurring_parser = subparsers.add_parser("recurring", help="Recurring-charge detection over a large history")
+    recurring_parser.add_argument("--rows", type=int, default=1_000_000)
+    recurring_parser.add_argument("--years", type=int, default=5)
+    recurring_parser.add_argument("--subscriptions", type=int, default=50)
+    recurring_parser.add_argument("--seed", type=int, default=0)
+    recurring_parser.set_defaults(func=bench_recurring)
+
+    budgets_parser = subparsers.add_parser("budgets", help="Budget status from running counters vs summing expenses")
+    budgets_parser.add_argument("--rows", type=int, default=1_000_000)
+    budgets_parser.add_argument("--years", type=int, default=2)
+    budgets_parser.add_argument("--budgets", type=int, default=5)
+    budgets_parser.add_argument("--repeat", type=int, default=20)
+    budgets_parser.add_argument("--seed", type=int, default=0)
+    budgets_parser.set_defaults(func=bench_budgets)
+
+    export_parser = subparsers.add_parser("export", help="Streaming expense export throughput and memory")
+    export_parser.add_argument("--rows", type=int, default=1_000_000)
+    export_parser.add_argument("--formats", default="csv,jsonl,parquet")
+    export_parser.add_argument("--seed", type=int, default=0)
+    export_parser.set_defaults(func=bench_export)
+
+    history_parser = subparsers.add_parser("history", help="Keyset pagination of /api/expenses: correctness and memory")
+    history_parser.add_argument("--rows", type=int, default=200_000)
+    history_parser.add_argument("--page-size", type=int, default=500)
+    history_parser.add_argument("--max-growth-mb", type=float, default=32)
+    history_parser.add_argument("--seed", type=int, default=0)
+    history_parser.set_defaults(func=bench_history)
+
+    archive_parser = subparsers.add_parser("archive", help="Table and index size and query latency around archiving")
+    archive_parser.add_argument("--rows", type=int, default=1_000_000)
+    archive_parser.add_argument("--users", type=int, default=10)
+    archive_parser.add_argument("--years", type=int, default=5)
+    archive_parser.add_argument("--repeat", type=int, default=20)
+    archive_parser.add_argument("--seed", type=int, default=0)
+    archive_parser.set_defaults(func=bench_archive)
+
+    partitions_parser = subparsers.add_parser("partitions", help="Postgres partition pruning on date-filtered queries")
+    partitions_parser.add_argument("--database-url", required=True,
+                                   help="postgresql:// URL of an empty scratch database; its tables are dropped after")
+    partitions_parser.add_argument("--rows", type=int, default=1_000_000)
+    partitions_parser.add_argument("--users", type=int, default=10)
+    partitions_parser.add_argument("--months", type=int, default=24)
+    partitions_parser.add_argument("--repeat", type=int, default=20)
+    partitions_parser.add_argument("--seed", type=int, default=0)
+    partitions_parser.set_defaults(func=bench_partitions)
+
+    category_index_parser = subparsers.add_parser("category-index",
+                                                  help="Worker memory with and without the shared category index")
+    category_index_parser.add_argument("--workers", type=int, default=16)
+    category_index_parser.add_argument("--users", type=int, default=400)
+    category_index_parser.add_argument("--custom-ratio", type=float, default=0.25)
+    category_index_parser.add_argument("--learned-items", type=int, default=20000)
+    category_index_parser.add_argument("--uploads", type=int, default=100, help="Uploads served by each worker")
+    category_index_parser.add_argument("--items", type=int, default=20, help="Items per upload")
+    category_index_parser.add_argument("--seed", type=int, default=0)
+    category_index_parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    category_index_parser.set_defaults(func=bench_category_index)
+
+    items_parser = subparsers.add_parser("items", help="Memory and time of receipt items as records vs dicts")
+    items_parser.add_argument("--items", type=int, default=100_000, help="Lines of the generated statement")
+    items_parser.add_argument("--repeat", type=int, default=3)
+    items_parser.add_argument("--seed", type=int, default=0)
+    items_parser.set_defaults(func=bench_items)
+
+    google_login_parser = subparsers.add_parser("google-login",
+                                                help="Discovery caching and connection reuse of Google sign-in")
+    google_login_parser.add_argument("--logins", type=int, default=50)
+    google_login_parser.set_defaults(func=bench_google_login)
+
+    off_parser = subparsers.add_parser("open-food-facts",
+                                       help="Circuit breaker and lookup budget against a fault-injecting stub")
+    off_parser.add_argument("--uploads", type=int, default=5)
+    off_parser.add_argument("--items", type=int, default=10, help="Unmatched items per upload")
+    off_parser.add_argument("--timeout", type=float, default=0.5, help="Per-request timeout in seconds")
+    off_parser.add_argument("--budget", type=float, default=2.0, help="Lookup budget per upload in seconds")
+    off_parser.add_argument("--reset-timeout", type=float, default=1.0, help="Seconds the breaker stays open")
+    off_parser.set_defaults(func=bench_open_food_facts)
+
+    duplicates_parser = subparsers.add_parser("duplicates", help="Perceptual-hash near-duplicate receipt detection")
+    duplicates_parser.add_argument("--count", type=int, default=200)
+    duplicates_parser.add_argument("--seed", type=int, default=0)
+    duplicates_parser.add_argument("--distance", type=int, default=8, help="Max Hamming distance for a duplicate")
+    duplicates_parser.add_argument("--index-size", type=int, default=10000, help="Hashes stored for the lookup timing")
+    duplicates_parser.set_defaults(func=bench_duplicates)
+
+    ocr_parser = subparsers.add_parser("ocr", help="Accuracy per extra millisecond of word-level OCR and line re-OCR")
+    ocr_parser.add_argument("--count", type=int, default=50)
+    ocr_parser.add_argument("--seed", type=int, default=0)
+    ocr_parser.add_argument("--noise", type=float, default=25.0, help="Gaussian pixel noise added to each photo")
+    ocr_parser.set_defaults(func=bench_ocr)
+
+    args = parser.parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import os
+import logging
+from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
+from metrics import count_event
+
+logger = logging.getLogger(__name__)
+
+# Fractions of a monthly limit that raise an alert when spending crosses them
+BUDGET_ALERT_THRESHOLDS = tuple(float(value) for value in
+                                os.environ.get("BUDGET_ALERT_THRESHOLDS", "0.8,1.0").split(','))
+
+_UPSERT_DIALECTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+# Built once per dialect; constructing an upsert costs more than running it
+_upserts = {}
+
+
+def month_of(date):
+    """The "YYYY-MM" month an expense dated date is counted in."""
+    # Expenses are dated with the local clock (datetime.now()), so the current month is local too
+    return (date or datetime.now()).strftime('%Y-%m')
+
+
+def _add_to_counters(user_id, amounts):
+    """Add {(category_id, month): amount} to the counters in the current transaction, in one executemany."""
+    from models import db, CategorySpend
+
+    dialect = db.engine.dialect.name
+    if dialect not in _UPSERT_DIALECTS:
+        for (category_id, month), amount in amounts.items():
+            counter = db.session.get(CategorySpend, (user_id, category_id, month), with_for_update=True)
+            if counter is None:
+                counter = CategorySpend(user_id=user_id, category_id=category_id, month=month, total=0.0)
+                db.session.add(counter)
+            counter.total += amount
+        db.session.flush()
+        return
+
+    statement = _upserts.get(dialect)
+    if statement is None:
+        statement = _UPSERT_DIALECTS[dialect](CategorySpend)
+        statement = _upserts[dialect] = statement.on_conflict_do_update(
+            index_elements=['user_id', 'category_id', 'month'],
+            set_={'total': CategorySpend.total + statement.excluded.total})
+    db.session.execute(statement, [
+        {'user_id': user_id, 'category_id': category_id, 'month': month, 'total': amount}
+        for (category_id, month), amount in amounts.items()])
+
+
+def record_spending(user_id, changes):
+    """Apply spending changes to the user's monthly counters and raise budget alerts.
+
+    changes is an iterable of (category_id, date, amount); amounts are
+    negative for expenses moved out of a category. Changes are summed per
+    category and month first, so each expense costs one dict update, all
+    touched counters are upserted in one executemany and the totals of the
+    budgeted ones that grew are read back in one query. A threshold is
+    crossed when the total before the change was under it and the total
+    after is not; the new alerts are added to the session and returned.
+    Nothing is committed: call this in the transaction that saves the expenses.
+    """
+    from models import db, Budget, CategorySpend
+
+    deltas = {}
+    now = datetime.now()
+    for category_id, date, amount in changes:
+        date = date or now
+        key = (category_id, date.year, date.month)
+        deltas[key] = deltas.get(key, 0.0) + amount
+    if not deltas:
+        return []
+
+    limits = dict(db.session.query(Budget.category_id, Budget.monthly_limit).filter(
+        Budget.user_id == user_id, Budget.category_id.in_({category_id for category_id, _, _ in deltas})))
+    amounts = {(category_id, f"{year:04d}-{month_number:02d}"): amount
+               for (category_id, year, month_number), amount in deltas.items()}
+    _add_to_counters(user_id, amounts)
+
+    watched = {key: amount for key, amount in amounts.items() if key[0] in limits and amount > 0}
+    if not watched:
+        return []
+    # This transaction holds the counters it just wrote, so these are its own totals
+    totals = db.session.query(CategorySpend.category_id, CategorySpend.month, CategorySpend.total).filter(
+        CategorySpend.user_id == user_id, CategorySpend.category_id.in_({key[0] for key in watched}),
+        CategorySpend.month.in_({key[1] for key in watched})).all()
+    alerts = []
+    for category_id, month, total in totals:
+        amount = watched.get((category_id, month))
+        if amount is not None:
+            alerts += _new_alerts(user_id, category_id, month, limits[category_id], total - amount, total)
+    return alerts
+
+
+def _new_alerts(user_id, category_id, month, limit, before, after):
+    from models import db, BudgetAlert
+
+    alerts = []
+    for threshold in BUDGET_ALERT_THRESHOLDS:
+        if before < threshold * limit <= after:
+            # Spending that dropped and crossed again doesn't alert twice
+            if db.session.query(BudgetAlert.id).filter_by(user_id=user_id, category_id=category_id, month=month,
+                                                          threshold=threshold).first():
+                continue
+            alert = BudgetAlert(user_id=user_id, category_id=category_id, month=month, threshold=threshold,
+                                total=after, monthly_limit=limit)
+            db.session.add(alert)
+            alerts.append(alert)
+            count_event("budget_alerts")
+    return alerts
+
+
+def record_expenses(user_id, rows):
+    """record_spending for new expenses given as dicts or Expense objects with category_id, date and amount."""
+    return record_spending(user_id, (
+        (row['category_id'], row.get('date'), row['amount']) if isinstance(row, dict)
+        else (row.category_id, row.date, row.amount) for row in rows))
+
+
+def record_recategorization(user_id, moves):
+    """record_spending for expenses moved between categories, given as (old category, new category, date, amount)."""
+    changes = []
+    for old_category_id, new_category_id, date, amount in moves:
+        if old_category_id != new_category_id:
+            changes.append((old_category_id, date, -amount))
+            changes.append((new_category_id, date, amount))
+    return record_spending(user_id, changes)
+
+
+def check_budget(user_id, category_id, month=None):
+    """Raise the alerts a new or changed budget has already passed this month. Returns them."""
+    from models import db, Budget, CategorySpend
+
+    month = month or month_of(None)
+    limit = db.session.query(Budget.monthly_limit).filter_by(user_id=user_id, category_id=category_id).scalar()
+    total = db.session.query(CategorySpend.total).filter_by(user_id=user_id, category_id=category_id,
+                                                            month=month).scalar() or 0.0
+    if limit is None:
+        return []
+    return _new_alerts(user_id, category_id, month, limit, float('-inf'), total)
+
+
+def budget_status(user_id, month=None):
+    """Return ({'category_id', 'category', 'limit', 'spent', 'remaining', 'percent'} per budget, alerts) for a month.
+
+    Spending comes from the running counters, one row per budget.
+    """
+    from models import db, Budget, BudgetAlert, Category, CategorySpend
+
+    month = month or month_of(None)
+    rows = db.session.query(Budget.category_id, Category.name, Budget.monthly_limit, CategorySpend.total).join(
+        Category, Budget.category_id == Category.id).outerjoin(
+        CategorySpend, (CategorySpend.user_id == Budget.user_id) & (CategorySpend.category_id == Budget.category_id)
+        & (CategorySpend.month == month)).filter(Budget.user_id == user_id).order_by(Category.name)
+    budgets = []
+    for category_id, name, limit, spent in rows:
+        spent = round(spent or 0.0, 2)
+        budgets.append({
+            'category_id': category_id,
+            'category': name,
+            'limit': limit,
+            'spent': spent,
+            'remaining': round(limit - spent, 2),
+            'percent': round(100 * spent / limit, 1) if limit else None,
+        })
+    alerts = [{
+        'category_id': alert.category_id,
+        'category': name,
+        'month': alert.month,
+        'threshold': alert.threshold,
+        'total': round(alert.total, 2),
+        'limit': alert.monthly_limit,
+        'created_at': alert.created_at.isoformat() if alert.created_at else None,
+    } for alert, name in db.session.query(BudgetAlert, Category.name).join(
+        Category, BudgetAlert.category_id == Category.id).filter(
+        BudgetAlert.user_id == user_id, BudgetAlert.month == month).order_by(BudgetAlert.created_at.desc())]
+    return budgets, alerts
+
+
+def rebuild_counters(user_id=None):
+    """Recompute the monthly counters from the expense table, for all users or one. Needs an app context.
+
+    For databases that had expenses before the counters existed, or to repair
+    them after rows were changed outside the app. Archived expenses are
+    counted too. Commits; returns the number of counters written.
+    """
+    from models import db, Expense, CategorySpend
+    from archive import archived_user_ids, archived_monthly_totals
+
+    day = db.func.date(Expense.date, type_=db.Date)
+    query = db.session.query(Expense.user_id, Expense.category_id, day, db.func.sum(Expense.amount)).group_by(
+        Expense.user_id, Expense.category_id, day)
+    deletion = db.delete(CategorySpend)
+    if user_id is not None:
+        query = query.filter(Expense.user_id == user_id)
+        deletion = deletion.where(CategorySpend.user_id == user_id)
+
+    totals = {}
+    for row_user_id, category_id, expense_day, amount in query:
+        key = (row_user_id, category_id, month_of(expense_day))
+        totals[key] = totals.get(key, 0.0) + amount
+    for archive_user_id in ([user_id] if user_id is not None else archived_user_ids()):
+        for (category_id, month), amount in archived_monthly_totals(archive_user_id).items():
+            key = (archive_user_id, category_id, month)
+            totals[key] = totals.get(key, 0.0) + amount
+    db.session.execute(deletion)
+    if totals:
+        db.session.execute(db.insert(CategorySpend), [
+            {'user_id': row_user_id, 'category_id': category_id, 'month': month, 'total': total}
+            for (row_user_id, category_id, month), total in totals.items()])
+    db.session.commit()
+    return len(totals)
@@ -1,33 +1,171 @@
+import os
+import sys
 import json
+import time
 import logging
 import requests
 from rapidfuzz import fuzz
+from sqlalchemy import or_
 from models import db
-from models import Category
+from models import Category, User
+from metrics import timed, timed_function, count_event
+from circuit_breaker import CircuitBreaker, LookupBudget
+from keyword_matcher import (KeywordAutomaton, SizedLRUCache, estimate_categories_size, get_keyword_automaton,
+                             get_keyword_index)
+from normalizer import normalize_description
+from category_index import get_category_index, schedule_category_index_rebuild
+from utils import LEARNED_ITEMS_PATH
+from receipt_parser import ExpenseItem, extract_items, extract_date, extract_amounts
 
-def load_categories():
-    """Load categories from the database."""
+def visible_categories_query(user_id):
+    """Query for the shared default categories plus the user's own categories."""
+    if user_id is None:
+        return Category.query.filter(Category.user_id.is_(None))
+    return Category.query.filter(or_(Category.user_id.is_(None), Category.user_id == user_id))
+
+def load_categories(user_id=None):
+    """Load categories from the database.
+
+    Without a user only the shared defaults are loaded. A user's own category
+    replaces a shared one with the same name.
+    """
     categories = {}
-    for category in Category.query.all():
+    shadowed = {}
+    # Shared rows sort first so the user's rows can replace them
+    query = visible_categories_query(user_id).order_by(Category.user_id.isnot(None), Category.id)
+    for category in query:
+        if category.name in shadowed:
+            del categories[shadowed[category.name]]
+        shadowed[category.name] = category.id
         categories[category.id] = {
             'name': category.name,
             'keywords': json.loads(category.keywords) if category.keywords else []
         }
     return categories
 
+# Memory budget and size limit for the per-user category cache. Users without
+# categories of their own share the interned default index from keyword_matcher,
+# so only custom categories and their automata count against the budget.
+USER_CATEGORY_CACHE_BYTES = int(os.environ.get("USER_CATEGORY_CACHE_BYTES", 64 * 1024 * 1024))
+USER_CATEGORY_CACHE_SIZE = 10000
+
+# Bytes accounted for a cache entry that points at the shared default index
+SHARED_ENTRY_BYTES = 200
+
+_user_categories = SizedLRUCache(USER_CATEGORY_CACHE_BYTES, USER_CATEGORY_CACHE_SIZE)
+
+def get_user_categories(user_id):
+    """Return (categories, keyword automaton) for a user, cached across uploads.
+
+    Entries are checked against User.categories_version, a single primary-key
+    lookup, so an edit made in one worker invalidates the caches of all others.
+    Users the shared category index has at their current version are served
+    from it, without a private copy in this process.
+    """
+    version = db.session.query(User.categories_version).filter(User.id == user_id).scalar() or 0
+    shared_index = get_category_index()
+    if shared_index is not None:
+        index = shared_index.user_categories(user_id, version)
+        if index is not None:
+            return index
+        schedule_category_index_rebuild()
+    entry = _user_categories.get(user_id)
+    if entry is not None and entry[0] == version:
+        return entry[1], entry[2]
+
+    categories = load_categories(user_id)
+    if db.session.query(Category.id).filter(Category.user_id == user_id).first() is None:
+        categories, automaton = get_keyword_index(categories)
+        size = SHARED_ENTRY_BYTES
+    else:
+        automaton = KeywordAutomaton(categories)
+        size = automaton.memory_bytes + estimate_categories_size(categories)
+    _user_categories.put(user_id, (version, categories, automaton), size)
+    return categories, automaton
+
+def invalidate_user_categories(user_id):
+    """Mark a user's categories as changed. Call before committing a category edit."""
+    db.session.query(User).filter(User.id == user_id).update(
+        {User.categories_version: User.categories_version + 1}, synchronize_session=False)
+    _user_categories.pop(user_id)
+
+def user_category_cache_stats():
+    return _user_categories.stats()
+
+OPEN_FOOD_FACTS_URL = os.environ.get("OPEN_FOOD_FACTS_URL", "https://world.openfoodfacts.org/cgi/search.pl")
+
+# Longest wait for a single Open Food Facts request, in seconds
+OPEN_FOOD_FACTS_TIMEOUT = float(os.environ.get("OPEN_FOOD_FACTS_TIMEOUT", 5))
+
+# Total time one upload may spend on Open Food Facts lookups, in seconds
+OPEN_FOOD_FACTS_UPLOAD_BUDGET = float(os.environ.get("OPEN_FOOD_FACTS_UPLOAD_BUDGET", 10))
+
+# Distinct normalized product names whose Open Food Facts answer is remembered
+OPEN_FOOD_FACTS_CACHE_SIZE = 4096
+OPEN_FOOD_FACTS_CACHE_BYTES = 4 * 1024 * 1024
+
+_open_food_facts_answers = SizedLRUCache(OPEN_FOOD_FACTS_CACHE_BYTES, OPEN_FOOD_FACTS_CACHE_SIZE)
+_open_food_facts_session = requests.Session()
+
+# Shared by all requests in this process, so one slow upload protects the next
+open_food_facts_breaker = CircuitBreaker("open_food_facts",
+                                         slow_call_seconds=min(2.0, OPEN_FOOD_FACTS_TIMEOUT))
+
+# Minimum probability for the trained classifier's answer to be used
+CLASSIFIER_MIN_CONFIDENCE = 0.6
+
+def get_category_classifier():
+    """Return the trained text classifier, or None if it isn't trained or NumPy/SciPy are missing."""
+    try:
+        from text_classifier import get_classifier
+        return get_classifier()
+    except ImportError:
+        return None
+    except Exception as e:
+        logging.error(f"Error loading category classifier: {e}")
+        return None
+
 def load_user_learned_items(user_id):
-    """Load learned items from the JSON file."""
+    """Load learned items from the shared category index, or from the JSON file if the index is out of date."""
+    shared_index = get_category_index()
+    if shared_index is not None:
+        learned_items = shared_index.learned_items()
+        if learned_items is not None:
+            return learned_items
+        schedule_category_index_rebuild()
     try:
-        with open('user_learned_items.json', 'r') as f:
+        with open(LEARNED_ITEMS_PATH, 'r') as f:
             learned_items = json.load(f)
             return learned_items
     except (FileNotFoundError, json.JSONDecodeError):
-        with open('user_learned_items.json', 'w') as f:
+        with open(LEARNED_ITEMS_PATH, 'w') as f:
             json.dump({}, f)
         return {}
 
-def categorize_item(description, categories, user_learned_items):
-    """Categorize an item based on its description."""
+def fuzzy_match(desc_lower, categories):
+    """Return (category id, score) of the keyword that best fuzzy-matches a description."""
+    best_match = None
+    best_score = 0
+    for category_id, category_data in categories.items():
+        for keyword in category_data['keywords']:
+            score = fuzz.partial_ratio(desc_lower, keyword.lower())
+            if score > best_score:
+                best_score = score
+                best_match = category_id
+    return best_match, best_score
+
+@timed_function("categorize_item")
+def categorize_item(description, categories, user_learned_items, use_open_food_facts=True,
+                    predicted_category=None, automaton=None, lookup_budget=None):
+    """Categorize an item based on its description.
+
+    Set use_open_food_facts=False to skip the network lookup, e.g. for bulk
+    statement imports where a request per unmatched row is far too slow.
+    predicted_category is an optional (category name, confidence) pair from
+    the trained classifier, consulted when no keyword matches well.
+    automaton is the compiled keyword index for categories, if the caller has it.
+    lookup_budget caps the time spent on Open Food Facts across one upload.
+    """
 
     # Normalize and skip irrelevant lines
     desc_lower = description.lower().strip()
@@ -35,55 +173,103 @@ def categorize_item(description, categories, user_learned_items):
     if any(skip in desc_lower for skip in skip_words):
         return None
 
-    # Check if user already corrected it
-    if desc_lower in user_learned_items:
-        category_name = user_learned_items[desc_lower]
+    # Match on the normalized form so SKUs, weights and quantities don't get in the way
+    desc_key = normalize_description(description)
+
+    # Check if user already corrected it (older corrections are keyed by the raw lowercase text)
+    category_name = user_learned_items.get(desc_key) or user_learned_items.get(desc_lower)
+    if category_name:
         for category_id, category_data in categories.items():
             if category_data['name'] == category_name:
                 return category_id
 
-    # Fuzzy match to keywords
-    best_match = None
-    best_score = 0
-    for category_id, category_data in categories.items():
-        for keyword in category_data['keywords']:
-            score = fuzz.partial_ratio(desc_lower, keyword.lower())
-            if score > best_score:
-                best_score = score
-                best_match = category_id
+    # Exact keyword pass: one scan finds any keyword that appears verbatim
+    if automaton is None:
+        automaton = get_keyword_automaton(categories)
+    exact_match = automaton.best_match(desc_key)
+    if exact_match is not None:
+        count_event('keyword_exact_match')
+        return exact_match
 
+    # Fuzzy match to keywords
+    count_event('keyword_fuzzy_scan')
+    best_match, best_score = fuzzy_match(desc_key, categories)
     if best_score >= 80:
         return best_match
 
+    # Use the trained classifier if it is confident enough
+    if predicted_category:
+        predicted_name, confidence = predicted_category
+        if predicted_name and confidence >= CLASSIFIER_MIN_CONFIDENCE:
+            for category_id, category_data in categories.items():
+                if category_data['name'] == predicted_name:
+                    return category_id
+
     # Try Open Food Facts
-    try:
-        category = get_open_food_facts_category(description)
-        if category:
-            mapped_category_id = map_off_category_to_internal(category, categories)
-            if mapped_category_id:
-                return mapped_category_id
-    except Exception as e:
-        logging.error(f"Error looking up category in Open Food Facts: {e}")
+    if use_open_food_facts:
+        try:
+            category = get_open_food_facts_category(description, lookup_budget)
+            if category:
+                mapped_category_id = map_off_category_to_internal(category, categories)
+                if mapped_category_id:
+                    return mapped_category_id
+        except Exception as e:
+            logging.error(f"Error looking up category in Open Food Facts: {e}")
 
     # Default to first category if needed
     return list(categories.keys())[0]
 
-def get_open_food_facts_category(product_name):
-    """Query the Open Food Facts API to get product category."""
-    try:
-        query = product_name.replace(' ', '+')
-        url = f"https://world.openfoodfacts.org/cgi/search.pl?search_terms={query}&search_simple=1&action=process&json=1"
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('products') and len(data['products']) > 0:
-                categories = data['products'][0].get('categories', '')
-                if categories:
-                    return categories.split(',')[0].strip()
+def get_open_food_facts_category(product_name, lookup_budget=None):
+    """Query the Open Food Facts API to get product category.
+
+    Answers are cached by normalized name. Returns None without calling the
+    API while the circuit breaker is open or the upload's lookup_budget is
+    used up, and never waits longer than the budget has left.
+    """
+    search_terms = normalize_description(product_name)
+    cached = _open_food_facts_answers.get(search_terms)
+    if cached is not None:
+        return cached[0]
+
+    timeout = OPEN_FOOD_FACTS_TIMEOUT
+    if lookup_budget is not None:
+        if lookup_budget.exhausted:
+            lookup_budget.skipped += 1
+            count_event('open_food_facts_budget_exhausted')
+            return None
+        timeout = min(timeout, lookup_budget.remaining())
+    if not open_food_facts_breaker.allow_request():
+        count_event('open_food_facts_circuit_skipped')
         return None
+
+    start = time.perf_counter()
+    try:
+        category = fetch_open_food_facts(search_terms, timeout)
     except Exception as e:
+        open_food_facts_breaker.record_failure(type(e).__name__)
         logging.error(f"Error in Open Food Facts API: {e}")
         return None
+    finally:
+        if lookup_budget is not None:
+            lookup_budget.charge(time.perf_counter() - start)
+    open_food_facts_breaker.record_success(time.perf_counter() - start)
+
+    # Only answers (including "no category") are cached, so failed requests are retried
+    _open_food_facts_answers.put(search_terms, (category,), sys.getsizeof(search_terms) + sys.getsizeof(category))
+    return category
+
+def fetch_open_food_facts(search_terms, timeout):
+    """Return the first Open Food Facts category for search terms, raising on request errors."""
+    params = {'search_terms': search_terms, 'search_simple': 1, 'action': 'process', 'json': 1}
+    with timed("open_food_facts"):
+        response = _open_food_facts_session.get(OPEN_FOOD_FACTS_URL, params=params, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    if data.get('products') and len(data['products']) > 0:
+        categories = data['products'][0].get('categories', '')
+        if categories:
+            return categories.split(',')[0].strip()
+    return None
 
 def map_off_category_to_internal(off_category, internal_categories):
     """Map an Open Food Facts category to our internal categories."""
@@ -128,41 +314,53 @@ def map_off_category_to_internal(off_category, internal_categories):
 
     return list(internal_categories.keys())[0]
 
-def categorize_expense_items(text, user_id):
-    """Extract and categorize expense items from OCR text."""
-    from ocr_processor import extract_items, extract_date, extract_amounts
-
-    categories = load_categories()
+def categorize_expense_items(text, user_id, lines=None):
+    """Extract and categorize expense items from OCR text (and OCR lines with word boxes, if known)."""
+    categories, automaton = get_user_categories(user_id)
     user_learned_items = load_user_learned_items(user_id)
+    return categorize_text(text, categories, user_learned_items, automaton, lines)
+
+def categorize_text(text, categories, user_learned_items, automaton=None, lines=None):
+    """Extract and categorize expense items from OCR text with preloaded categories. Returns ExpenseItems.
+
+    Lets batch callers load categories and learned items once for many documents.
+    Open Food Facts lookups for the document share one OPEN_FOOD_FACTS_UPLOAD_BUDGET.
+    lines are the document's OCR lines from ocr_processor.ocr_layout, used to
+    find prices by position.
+    """
     date = extract_date(text)
-    items = extract_items(text)
+    items = extract_items(text, lines)
 
     if not items:
-        amounts = extract_amounts(text)
-        if amounts:
-            for i, amount in enumerate(amounts):
-                items.append({
-                    'description': f"Item {i+1}",
-                    'amount': amount
-                })
+        items = [ExpenseItem(f"Item {i+1}", amount) for i, amount in enumerate(extract_amounts(text))]
+
+    # Predict the whole receipt in one batch if a classifier has been trained
+    classifier = get_category_classifier()
+    if classifier:
+        predictions = classifier.predict([normalize_description(item.description) for item in items])
+    else:
+        predictions = [None] * len(items)
 
+    lookup_budget = LookupBudget(OPEN_FOOD_FACTS_UPLOAD_BUDGET)
     categorized_items = []
-    for item in items:
+    for item, prediction in zip(items, predictions):
         # Skip irrelevant lines again at this level
-        if any(skip in item['description'].lower() for skip in ['total', 'subtotal', 'tax', 'amount due', 'change due']):
+        if any(skip in item.description.lower() for skip in ['total', 'subtotal', 'tax', 'amount due', 'change due']):
             continue
 
-        category_id = categorize_item(item['description'], categories, user_learned_items)
+        category_id = categorize_item(item.description, categories, user_learned_items,
+                                      predicted_category=prediction, automaton=automaton,
+                                      lookup_budget=lookup_budget)
         if category_id is None:
             continue  # Item was skipped (irrelevant)
 
-        category_name = categories[category_id]['name']
-        categorized_items.append({
-            'description': item['description'],
-            'amount': item['amount'],
-            'category_id': category_id,
-            'category': category_name,
-            'date': date
-        })
+        # Filled in place: the extracted items aren't used again
+        item.category_id = category_id
+        item.category = categories[category_id]['name']
+        item.date = date
+        categorized_items.append(item)
 
+    if lookup_budget.skipped:
+        logging.info(f"Open Food Facts budget of {lookup_budget.seconds:.0f}s used up, "
+                     f"skipped {lookup_budget.skipped} lookups")
     return categorized_items
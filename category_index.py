@@ -0,0 +1,452 @@
+import os
+import sys
+import json
+import mmap
+import time
+import array
+import struct
+import hashlib
+import logging
+import threading
+from bisect import bisect_left
+from collections.abc import Mapping
+from contextlib import contextmanager
+from datetime import datetime
+from keyword_matcher import KeywordAutomaton, categories_version
+
+logger = logging.getLogger(__name__)
+
+# Compiled categories and learned items, memory-mapped read-only by every worker
+# process. Only used once `flask build-category-index` has created it.
+CATEGORY_INDEX_PATH = os.environ.get("CATEGORY_INDEX_PATH", "category_index.bin")
+
+# Seconds a worker waits after finding the index out of date before rebuilding it,
+# so a burst of category edits or corrections costs one rebuild
+CATEGORY_INDEX_REBUILD_DELAY = float(os.environ.get("CATEGORY_INDEX_REBUILD_DELAY", 5))
+
+MAGIC = b'EXPCATIX'
+FORMAT_VERSION = 1
+
+# Magic, format version and length of the JSON header that follows
+_PREAMBLE = struct.Struct('<8sII')
+
+# Every array starts at a multiple of this many bytes
+_ALIGNMENT = 8
+
+
+def _aligned(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def _fingerprint(categories):
+    """64-bit hash of categories_version, stored to recognise a category set in a later build."""
+    digest = hashlib.blake2b(repr(categories_version(categories)).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def _learned_items_stat():
+    """[mtime_ns, size] of the learned items file, or None if there is none."""
+    from utils import LEARNED_ITEMS_PATH
+
+    try:
+        stat = os.stat(LEARNED_ITEMS_PATH)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class _Symbols(dict):
+    """str.translate table mapping the alphabet to symbols 1.., every other character to 0."""
+
+    def __missing__(self, code):
+        return 0
+
+
+class CategoryIndex:
+    """Read-only view of an index file; its arrays are memoryviews of one shared mapping.
+
+    Layout: the preamble and a JSON header listing each array's offset,
+    typecode and length, then the arrays, native byte order:
+
+    - string_offsets/string_data: every name, keyword and learned item, UTF-8
+    - set_*: category sets, set 0 being the shared defaults; each has its
+      categories, a fingerprint of their content and a slice of the DFA states
+    - category_*/keyword: the categories of all sets, in set order
+    - transitions/best_rank/rank_category: the keyword automaton of each set
+      as a DFA, one row of `width` symbols per state, state ids and keyword
+      ranks counted from the start of the set's slice
+    - user_*: users with categories_version > 0, by id, and their set
+    - learned_key/learned_value: corrections sorted by UTF-8 key
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.size = stat.st_size
+        magic, version, header_size = _PREAMBLE.unpack_from(self._mapping)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} category index")
+        self.header = json.loads(self._mapping[_PREAMBLE.size:_PREAMBLE.size + header_size])
+        if self.header['byteorder'] != sys.byteorder:
+            raise ValueError(f"{path} was built on a {self.header['byteorder']}-endian machine")
+
+        data_start = _aligned(_PREAMBLE.size + header_size)
+        view = memoryview(self._mapping)
+        for name, (offset, typecode, count) in self.header['sections'].items():
+            start = data_start + offset
+            setattr(self, name, view[start:start + count * array.array(typecode).itemsize].cast(typecode))
+
+        self.alphabet = self.header['alphabet']
+        self.width = len(self.alphabet) + 1
+        self._symbols = _Symbols((ord(char), symbol) for symbol, char in enumerate(self.alphabet, 1))
+        self._defaults = None
+
+    def string(self, position):
+        return str(self.string_data[self.string_offsets[position]:self.string_offsets[position + 1]], 'utf-8')
+
+    def string_bytes(self, position):
+        return self.string_data[self.string_offsets[position]:self.string_offsets[position + 1]].tobytes()
+
+    def symbols(self, text):
+        """The DFA symbols of text's characters."""
+        translated = text.translate(self._symbols)
+        if self.width <= 256:
+            return translated.encode('latin-1')
+        return map(ord, translated)
+
+    def categories(self, set_index):
+        """The categories dict of a set, as load_categories returns it."""
+        categories = {}
+        for position in range(self.set_category_start[set_index], self.set_category_start[set_index + 1]):
+            keywords = self.keyword[self.category_keyword_start[position]:self.category_keyword_start[position + 1]]
+            categories[self.category_id[position]] = {
+                'name': self.string(self.category_name[position]),
+                'keywords': [self.string(keyword) for keyword in keywords],
+            }
+        return categories
+
+    def user_categories(self, user_id, version):
+        """Return (categories, automaton) of a user at a categories version, or None if the index lacks it."""
+        if version:
+            position = bisect_left(self.user_id, user_id)
+            if (position == len(self.user_id) or self.user_id[position] != user_id
+                    or self.user_version[position] != version):
+                return None
+            set_index = self.user_set[position]
+        else:
+            # Users who never edited their categories see the shared defaults
+            set_index = 0
+        if set_index:
+            return self.categories(set_index), MappedAutomaton(self, set_index)
+        if self._defaults is None:
+            self._defaults = (self.categories(0), MappedAutomaton(self, 0))
+        return self._defaults
+
+    def learned_items(self):
+        """The learned items as a read-only mapping, or None if the JSON file changed since the build."""
+        if self.header['learned_items'] != _learned_items_stat():
+            return None
+        return MappedLearnedItems(self)
+
+    def set_positions(self):
+        """{fingerprint: set index} of the sets in this index."""
+        return {fingerprint: set_index for set_index, fingerprint in enumerate(self.set_fingerprint)}
+
+
+class MappedAutomaton:
+    """KeywordAutomaton.best_match, following one set's DFA in a CategoryIndex."""
+
+    def __init__(self, index, set_index):
+        self.index = index
+        states = index.set_state_start[set_index], index.set_state_start[set_index + 1]
+        ranks = index.set_rank_start[set_index], index.set_rank_start[set_index + 1]
+        # Views of the set's slices, nothing is copied
+        self.transitions = index.transitions[states[0] * index.width:states[1] * index.width]
+        self.best_ranks = index.best_rank[states[0]:states[1]]
+        self.rank_category = index.rank_category[ranks[0]:ranks[1]]
+
+    def best_match(self, text):
+        """Return the category id of the best exact keyword hit in text, or None."""
+        transitions = self.transitions
+        best_ranks = self.best_ranks
+        width = self.index.width
+        state = 0
+        best = -1
+        for symbol in self.index.symbols(text):
+            state = transitions[state * width + symbol]
+            rank = best_ranks[state]
+            if rank >= 0 and (best < 0 or rank < best):
+                best = rank
+        return None if best < 0 else self.rank_category[best]
+
+
+class MappedLearnedItems(Mapping):
+    """{normalized description: category name} read from a CategoryIndex by binary search."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, key):
+        index = self.index
+        target = key.encode('utf-8')
+        position = bisect_left(index.learned_key, target, key=index.string_bytes)
+        if position < len(index.learned_key) and index.string_bytes(index.learned_key[position]) == target:
+            return index.string(index.learned_value[position])
+        raise KeyError(key)
+
+    def __iter__(self):
+        return map(self.index.string, self.index.learned_key)
+
+    def __len__(self):
+        return len(self.index.learned_key)
+
+
+_index_lock = threading.Lock()
+_current = {'index': None, 'failed': None}
+
+
+def get_category_index():
+    """Return the CategoryIndex at CATEGORY_INDEX_PATH, or None if there is no usable one.
+
+    The file is stat'ed on each call and mapped again once it has been
+    replaced, so a rebuild is picked up by every process without a restart.
+    """
+    try:
+        stat = os.stat(CATEGORY_INDEX_PATH)
+    except FileNotFoundError:
+        _current['index'] = None
+        return None
+    file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    index = _current['index']
+    if index is not None and index.file_id == file_id:
+        return index
+    if _current['failed'] == file_id:
+        return None
+    with _index_lock:
+        index = _current['index']
+        if index is None or index.file_id != file_id:
+            try:
+                index = CategoryIndex(CATEGORY_INDEX_PATH)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Ignoring category index {CATEGORY_INDEX_PATH}: {e}")
+                _current['failed'] = file_id
+                index = None
+            _current['index'] = index
+    return index
+
+
+def _open_existing(path):
+    try:
+        return CategoryIndex(path)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _is_current(index):
+    """Whether the learned items file and every user's categories version match what index was built from."""
+    from models import db, User
+
+    if index.header['learned_items'] != _learned_items_stat():
+        return False
+    users = db.session.query(User.id, User.categories_version).filter(
+        User.categories_version > 0).order_by(User.id).all()
+    return [tuple(user) for user in users] == list(zip(index.user_id, index.user_version))
+
+
+@contextmanager
+def _build_lock(path, blocking):
+    """Hold an exclusive lock on path.lock, so only one process builds at a time. Yields whether it is held."""
+    try:
+        import fcntl
+    except ImportError:
+        yield True
+        return
+    with open(f"{path}.lock", 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def _write_index(path, header, sections):
+    """Replace path with an index of the (name, array) sections, so readers see the old file or the new one."""
+    layout = {}
+    offset = 0
+    for name, values in sections:
+        layout[name] = [offset, values.typecode, len(values)]
+        offset = _aligned(offset + len(values) * values.itemsize)
+    encoded = json.dumps(dict(header, byteorder=sys.byteorder, sections=layout)).encode('utf-8')
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+        f.write(encoded)
+        f.write(b'\0' * (_aligned(_PREAMBLE.size + len(encoded)) - _PREAMBLE.size - len(encoded)))
+        for name, values in sections:
+            values.tofile(f)
+            size = len(values) * values.itemsize
+            f.write(b'\0' * (_aligned(size) - size))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def build_category_index(path=None, if_stale=False):
+    """Compile the categories of every user and the learned items into an index file. Needs an app context.
+
+    Users with the same categories share one compiled set, and sets whose
+    content is unchanged are copied from the previous file rather than
+    compiled again. Versions and the learned items file are read before
+    the data, so an edit made during the build shows up as out of date
+    later. With if_stale=True nothing is done unless the existing file is
+    out of date and no other process is building. Returns a dict of counts,
+    or None if nothing was built.
+    """
+    from models import db, User
+    from categorizer import load_categories
+    from utils import LEARNED_ITEMS_PATH
+
+    path = path or CATEGORY_INDEX_PATH
+    with _build_lock(path, blocking=not if_stale) as acquired:
+        if not acquired:
+            return None
+        previous = _open_existing(path)
+        if if_stale and (previous is None or _is_current(previous)):
+            return None
+
+        learned_stat = _learned_items_stat()
+        users = db.session.query(User.id, User.categories_version).filter(
+            User.categories_version > 0).order_by(User.id).all()
+        try:
+            with open(LEARNED_ITEMS_PATH, 'r') as f:
+                learned_items = json.load(f)
+        except FileNotFoundError:
+            learned_items = {}
+
+        category_sets = [load_categories(None)]
+        set_positions = {_fingerprint(category_sets[0]): 0}
+        user_sets = []
+        for user_id, _ in users:
+            categories = load_categories(user_id)
+            fingerprint = _fingerprint(categories)
+            if fingerprint not in set_positions:
+                set_positions[fingerprint] = len(category_sets)
+                category_sets.append(categories)
+            user_sets.append(set_positions[fingerprint])
+
+        alphabet = ''.join(sorted({char for categories in category_sets for category_data in categories.values()
+                                   for keyword in category_data['keywords'] for char in keyword.lower()}))
+        width = len(alphabet) + 1
+        reusable = previous.set_positions() if previous is not None and previous.alphabet == alphabet else {}
+
+        strings = {}
+
+        def string_id(value):
+            return strings.setdefault(value, len(strings))
+
+        set_category_start, set_state_start, set_rank_start = array.array('q'), array.array('q'), array.array('q')
+        set_fingerprint = array.array('q')
+        category_id, category_name, category_keyword_start = array.array('q'), array.array('q'), array.array('q')
+        keyword = array.array('q')
+        transitions, best_rank, rank_category = array.array('I'), array.array('i'), array.array('q')
+        reused = 0
+        for categories in category_sets:
+            fingerprint = _fingerprint(categories)
+            set_fingerprint.append(fingerprint)
+            set_category_start.append(len(category_id))
+            for category, category_data in categories.items():
+                category_id.append(category)
+                category_name.append(string_id(category_data['name']))
+                category_keyword_start.append(len(keyword))
+                keyword.extend(string_id(value) for value in category_data['keywords'])
+
+            set_state_start.append(len(best_rank))
+            set_rank_start.append(len(rank_category))
+            old_set = reusable.get(fingerprint)
+            if old_set is not None:
+                # Same content and alphabet: the old DFA, copied as it is
+                old_states = previous.set_state_start[old_set], previous.set_state_start[old_set + 1]
+                transitions.extend(previous.transitions[old_states[0] * width:old_states[1] * width])
+                best_rank.extend(previous.best_rank[old_states[0]:old_states[1]])
+                rank_category.extend(previous.rank_category[previous.set_rank_start[old_set]:
+                                                            previous.set_rank_start[old_set + 1]])
+                reused += 1
+            else:
+                automaton = KeywordAutomaton(categories)
+                transitions.extend(automaton.dense_transitions(alphabet))
+                best_rank.extend(-1 if rank is None else rank for rank in automaton.best)
+                rank_category.extend(automaton.rank_category)
+        set_category_start.append(len(category_id))
+        category_keyword_start.append(len(keyword))
+        set_state_start.append(len(best_rank))
+        set_rank_start.append(len(rank_category))
+        if all(end - start <= 0x10000 for start, end in zip(set_state_start, set_state_start[1:])):
+            # Halves the largest array when no set has more states than two bytes can number
+            transitions = array.array('H', transitions)
+
+        learned_key, learned_value = array.array('q'), array.array('q')
+        for key, value in sorted(learned_items.items(), key=lambda item: item[0].encode('utf-8')):
+            learned_key.append(string_id(key))
+            learned_value.append(string_id(str(value)))
+
+        string_offsets, string_data = array.array('q', [0]), bytearray()
+        for value in strings:
+            string_data += value.encode('utf-8')
+            string_offsets.append(len(string_data))
+
+        _write_index(path, {
+            'built_at': datetime.now().isoformat(timespec='seconds'),
+            'alphabet': alphabet,
+            'learned_items': learned_stat,
+        }, [
+            ('string_offsets', string_offsets), ('string_data', array.array('B', string_data)),
+            ('set_category_start', set_category_start), ('set_state_start', set_state_start),
+            ('set_rank_start', set_rank_start), ('set_fingerprint', set_fingerprint),
+            ('category_id', category_id), ('category_name', category_name),
+            ('category_keyword_start', category_keyword_start), ('keyword', keyword),
+            ('transitions', transitions), ('best_rank', best_rank), ('rank_category', rank_category),
+            ('user_id', array.array('q', (user_id for user_id, _ in users))),
+            ('user_version', array.array('q', (version for _, version in users))),
+            ('user_set', array.array('i', user_sets)),
+            ('learned_key', learned_key), ('learned_value', learned_value),
+        ])
+    stats = {'sets': len(category_sets), 'compiled': len(category_sets) - reused, 'users': len(users),
+             'learned_items': len(learned_key), 'bytes': os.path.getsize(path)}
+    logger.info(f"Built category index {path}: {stats}")
+    return stats
+
+
+_rebuild_lock = threading.Lock()
+_rebuild = {'scheduled': False}
+
+
+def _rebuild_later(app):
+    time.sleep(CATEGORY_INDEX_REBUILD_DELAY)
+    # Cleared first, so a change during the build schedules another one
+    _rebuild['scheduled'] = False
+    try:
+        with app.app_context():
+            build_category_index(if_stale=True)
+    except Exception as e:
+        logger.warning(f"Could not rebuild the category index, will retry: {e}")
+
+
+def schedule_category_index_rebuild():
+    """Rebuild the index in a thread after CATEGORY_INDEX_REBUILD_DELAY; needs an app context.
+
+    Called by readers that found the index out of date. They use the database
+    and the JSON file meanwhile. Cheap when a rebuild is already scheduled.
+    """
+    from flask import current_app
+
+    if _rebuild['scheduled']:
+        return
+    with _rebuild_lock:
+        if _rebuild['scheduled']:
+            return
+        _rebuild['scheduled'] = True
+    threading.Thread(target=_rebuild_later, args=(current_app._get_current_object(),), daemon=True).start()
@@ -0,0 +1,116 @@
+import time
+import logging
+import threading
+from collections import deque
+from metrics import count_event
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Stops calling a dependency that keeps failing or answering slowly.
+
+    The outcomes of the last window_size calls are kept; a call counts as a
+    failure if it raised or took longer than slow_call_seconds. Once at least
+    min_calls are recorded and failure_rate of them failed, the breaker opens
+    and allow_request() refuses every call for reset_timeout seconds. After
+    that it half-opens and lets a single probe through: success closes it
+    again, failure reopens it for another reset_timeout.
+    """
+
+    def __init__(self, name, window_size=20, min_calls=5, failure_rate=0.5, slow_call_seconds=2.0,
+                 reset_timeout=30.0, clock=time.monotonic):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._outcomes = deque(maxlen=window_size)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def allow_request(self):
+        """Return True if a call may be made now."""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if self._clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = HALF_OPEN
+                self._probe_in_flight = False
+            # Half-open: one probe at a time
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self, duration):
+        """Record a completed call and how long it took."""
+        if duration > self.slow_call_seconds:
+            self._record(False, f"slow call ({duration:.2f}s)")
+        else:
+            self._record(True)
+
+    def record_failure(self, reason="error"):
+        self._record(False, reason)
+
+    def _record(self, ok, reason=None):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probe_in_flight = False
+                if ok:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                    logger.info(f"Circuit {self.name} closed after a successful probe")
+                else:
+                    self._trip(f"probe failed: {reason}")
+                return
+            if self._state == OPEN:
+                # A call that started before the breaker opened
+                return
+
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures >= self.failure_rate * len(self._outcomes):
+                self._trip(f"{failures} of the last {len(self._outcomes)} calls failed, last: {reason}")
+
+    def _trip(self, reason):
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self._outcomes.clear()
+        count_event(f"{self.name}_circuit_opened")
+        logger.warning(f"Circuit {self.name} opened for {self.reset_timeout:.0f}s: {reason}")
+
+
+class LookupBudget:
+    """Total time one upload may spend waiting on external lookups."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.spent = 0.0
+        self.skipped = 0
+
+    def remaining(self):
+        return max(0.0, self.seconds - self.spent)
+
+    @property
+    def exhausted(self):
+        return self.spent >= self.seconds
+
+    def charge(self, seconds):
+        self.spent += seconds
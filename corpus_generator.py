@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Seeded generator for synthetic receipts and bank statements.
+
+Usage:
+    python corpus_generator.py OUTPUT_DIR [--count N] [--seed S] [--formats txt,pdf,png]
+
+Every document is written as text and optionally rendered to PDF (with
+generate_pdf) and rasterized to PNG. Ground-truth items and categories for
+the whole corpus are written to OUTPUT_DIR/labels.jsonl, one document per line,
+with the categories.json keyword each item was made from. With --holdout F a
+seeded fraction F of every category's keywords is held out and the split is
+written to OUTPUT_DIR/keywords.json, so a categorizer can be given only the
+known keywords and scored on items it has never seen verbatim.
+The same seed always produces the same corpus.
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+
+STORES = [
+    ("KROGER", "1234 MAIN ST"), ("SAFEWAY", "88 MARKET AVE"), ("TARGET", "500 COMMERCE BLVD"),
+    ("WALGREENS", "12 ELM ST"), ("CVS PHARMACY", "410 OAK DR"), ("TRADER JOE'S", "77 PINE RD"),
+    ("COSTCO WHOLESALE", "9 WAREHOUSE WAY"), ("WHOLE FOODS MARKET", "300 BROADWAY"),
+]
+
+PRODUCT_QUALIFIERS = ["", "", "", "ORGANIC ", "LARGE ", "FAMILY ", "FRESH ", "CLASSIC "]
+
+BANK_NAMES = ["FIRST NATIONAL BANK", "CITY CREDIT UNION", "METRO SAVINGS BANK"]
+
+TAX_RATE = 0.0725
+
+
+def load_category_keywords(path='categories.json'):
+    """Load {category name: [keywords]} used to label generated items."""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def split_category_keywords(category_keywords, holdout, seed=0):
+    """Split {category: [keywords]} into (known, held_out) dicts of the same shape.
+
+    A seeded fraction holdout of each category's keywords, never all of them,
+    is held out. Known keywords keep their order in categories.json.
+    """
+    rng = random.Random(seed)
+    known, held_out = {}, {}
+    for category, keywords in category_keywords.items():
+        count = min(round(len(keywords) * holdout), len(keywords) - 1)
+        held = set(rng.sample(keywords, count)) if count > 0 else set()
+        known[category] = [keyword for keyword in keywords if keyword not in held]
+        held_out[category] = [keyword for keyword in keywords if keyword in held]
+    return known, held_out
+
+
+def make_description(rng, keyword, noisy):
+    """Turn a category keyword into a receipt-style item description."""
+    description = f"{rng.choice(PRODUCT_QUALIFIERS)}{keyword.upper()}"
+    if noisy:
+        style = rng.randrange(6)
+        if style == 1:
+            description = f"{rng.randint(10000, 999999):07d} {description}"
+        elif style == 2:
+            description = f"{rng.randint(2, 6)} @ {description}"
+        elif style == 3:
+            description = f"{description} X{rng.randint(2, 4)}"
+        elif style == 4:
+            description = f"{description} {rng.randint(1, 64)}{rng.choice(['OZ', 'LB', 'CT', 'ML'])}"
+        elif style == 5:
+            # OCR reading the letter O as a zero
+            description = description.replace('O', '0')
+    return description
+
+
+def generate_receipt(rng, category_keywords, noisy=True):
+    """Generate one receipt: its text and ground-truth items."""
+    store, address = rng.choice(STORES)
+    date = datetime(2023, 1, 1) + timedelta(days=rng.randrange(730))
+    items = []
+    for _ in range(rng.randint(3, 25)):
+        category = rng.choice(list(category_keywords))
+        keyword = rng.choice(category_keywords[category])
+        items.append({
+            'description': make_description(rng, keyword, noisy),
+            'amount': round(rng.uniform(0.5, 80), 2),
+            'category': category,
+            'keyword': keyword,
+        })
+
+    subtotal = round(sum(item['amount'] for item in items), 2)
+    tax = round(subtotal * TAX_RATE, 2)
+    lines = [store, address, f"DATE: {date:%m/%d/%Y}", "-" * 40]
+    lines += [f"{item['description'][:30]:<30}{item['amount']:>10.2f}" for item in items]
+    lines += ["-" * 40,
+              f"{'SUBTOTAL':<30}{subtotal:>10.2f}",
+              f"{'TAX':<30}{tax:>10.2f}",
+              f"{'TOTAL':<30}{subtotal + tax:>10.2f}",
+              "THANK YOU FOR SHOPPING"]
+    return {
+        'kind': 'receipt',
+        'date': date.strftime('%Y-%m-%d'),
+        'items': items,
+        'text': "\n".join(lines) + "\n",
+    }
+
+
+def generate_statement(rng, category_keywords, noisy=True):
+    """Generate one bank statement page: its text and ground-truth transactions."""
+    bank = rng.choice(BANK_NAMES)
+    start = datetime(2023, 1, 1) + timedelta(days=30 * rng.randrange(24))
+    items = []
+    day = 0
+    for _ in range(rng.randint(10, 40)):
+        day += rng.randint(0, 2)
+        category = rng.choice(list(category_keywords))
+        keyword = rng.choice(category_keywords[category])
+        items.append({
+            'description': make_description(rng, keyword, noisy),
+            'amount': round(rng.uniform(2, 400), 2),
+            'category': category,
+            'keyword': keyword,
+            'date': (start + timedelta(days=day)).strftime('%Y-%m-%d'),
+        })
+
+    lines = [bank, f"STATEMENT PERIOD: {start:%m/%d/%Y} - {start + timedelta(days=day):%m/%d/%Y}",
+             f"ACCOUNT ENDING IN {rng.randint(1000, 9999)}", "-" * 60]
+    for item in items:
+        date = datetime.strptime(item['date'], '%Y-%m-%d')
+        lines.append(f"{date:%m/%d} {item['description'][:36]:<36}{item['amount']:>12.2f}")
+    lines += ["-" * 60, f"{'TOTAL DEBITS':<42}{sum(i['amount'] for i in items):>12.2f}"]
+    return {
+        'kind': 'statement',
+        'date': start.strftime('%Y-%m-%d'),
+        'items': items,
+        'text': "\n".join(lines) + "\n",
+    }
+
+
+def generate_documents(count, seed=0, statement_ratio=0.25, noisy=True, category_keywords=None):
+    """Yield count documents deterministically from seed."""
+    rng = random.Random(seed)
+    category_keywords = category_keywords or load_category_keywords()
+    for index in range(count):
+        if rng.random() < statement_ratio:
+            document = generate_statement(rng, category_keywords, noisy)
+        else:
+            document = generate_receipt(rng, category_keywords, noisy)
+        document['id'] = f"{document['kind']}_{index:06d}"
+        yield document
+
+
+def render_document(document, output_dir, formats, dpi=150):
+    """Write a document to output_dir in the requested formats.
+
+    Returns {format: path} for the files written.
+    """
+    paths = {}
+    text_path = os.path.join(output_dir, f"{document['id']}.txt")
+    with open(text_path, 'w') as f:
+        f.write(document['text'])
+    paths['txt'] = text_path
+
+    if 'pdf' in formats or 'png' in formats:
+        from generate_pdf import create_receipt_pdf, create_statement_pdf
+
+        pdf_path = os.path.join(output_dir, f"{document['id']}.pdf")
+        if document['kind'] == 'statement':
+            create_statement_pdf(text_path, pdf_path)
+        else:
+            create_receipt_pdf(text_path, pdf_path)
+        paths['pdf'] = pdf_path
+
+        if 'png' in formats:
+            from pdf2image import convert_from_path
+
+            png_path = os.path.join(output_dir, f"{document['id']}.png")
+            convert_from_path(pdf_path, dpi=dpi, first_page=1, last_page=1)[0].save(png_path, 'PNG')
+            paths['png'] = png_path
+            if 'pdf' not in formats:
+                os.remove(pdf_path)
+                del paths['pdf']
+
+    return paths
+
+
+def write_corpus(output_dir, count, seed=0, formats=('txt',), statement_ratio=0.25, noisy=True, holdout=0.0):
+    """Generate and render a corpus, writing ground truth to labels.jsonl.
+
+    With holdout, the known/held-out keyword split is written to keywords.json.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if holdout:
+        known, held_out = split_category_keywords(load_category_keywords(), holdout, seed)
+        with open(os.path.join(output_dir, 'keywords.json'), 'w') as f:
+            json.dump({'known': known, 'held_out': held_out}, f, indent=2)
+    with open(os.path.join(output_dir, 'labels.jsonl'), 'w') as labels:
+        for document in generate_documents(count, seed, statement_ratio, noisy):
+            paths = render_document(document, output_dir, formats)
+            record = {key: value for key, value in document.items() if key != 'text'}
+            record['files'] = {fmt: os.path.basename(path) for fmt, path in paths.items()}
+            labels.write(json.dumps(record) + "\n")
+    return os.path.join(output_dir, 'labels.jsonl')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic receipt/statement corpus.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--formats', default='txt', help='Comma-separated list of txt, pdf, png')
+    parser.add_argument('--statement-ratio', type=float, default=0.25)
+    parser.add_argument('--clean', action='store_true', help='Do not add SKU/quantity noise to descriptions')
+    parser.add_argument('--holdout', type=float, default=0.0,
+                        help='Fraction of each category\'s keywords to hold out (split written to keywords.json)')
+    args = parser.parse_args(argv)
+
+    formats = set(args.formats.split(','))
+    labels_path = write_corpus(args.output_dir, args.count, args.seed, formats,
+                               args.statement_ratio, noisy=not args.clean, holdout=args.holdout)
+    print(f"Wrote {args.count} documents to {args.output_dir} (labels: {labels_path})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
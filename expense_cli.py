@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Command-line tools for back-office expense imports.
+
+Usage:
+    python -m expense_cli ingest DIR --user ID [--workers N] [--batch-size N]
+
+Walks DIR for receipts (PDFs and images), OCRs them in a process pool,
+categorizes the extracted items and saves them for the given user in
+batches. Progress is checkpointed after every committed batch so that an
+interrupted run picks up where it left off when started again.
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+RECEIPT_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'bmp', 'tiff', 'tif', 'gif'}
+
+CHECKPOINT_FILENAME = '.expense_ingest_checkpoint'
+
+
+def find_receipt_files(directory):
+    """Yield paths of receipt files under directory, in a stable order."""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if '.' in name and name.rsplit('.', 1)[1].lower() in RECEIPT_EXTENSIONS:
+                yield os.path.join(root, name)
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def load_checkpoint(checkpoint_path):
+    """Return {path: signature} for files committed by a previous run."""
+    done = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r') as f:
+            for line in f:
+                path, _, signature = line.rstrip('\n').rpartition('\t')
+                if path:
+                    done[path] = signature
+    return done
+
+
+def append_checkpoint(checkpoint_path, paths):
+    """Record files whose expenses have been committed."""
+    with open(checkpoint_path, 'a') as f:
+        for path in paths:
+            f.write(f"{path}\t{_file_signature(path)}\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def ocr_file(path):
+    """OCR one file in a worker process. Returns (path, text, error, seconds)."""
+    from ocr_processor import process_uploaded_file
+
+    start = time.perf_counter()
+    try:
+        text = process_uploaded_file(path)
+        return path, text, None, time.perf_counter() - start
+    except Exception as e:
+        return path, None, str(e), time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def save_batch(user_id, rows, paths, checkpoint_path):
+    """Insert one batch of expenses and checkpoint the files they came from."""
+    from sqlalchemy import insert
+    from models import db, Expense
+    from budgets import record_expenses
+
+    if rows:
+        db.session.execute(insert(Expense), rows)
+        record_expenses(user_id, rows)
+    db.session.commit()
+    append_checkpoint(checkpoint_path, paths)
+
+
+def ingest(directory, user_id, workers, batch_size, checkpoint_path):
+    """OCR, categorize and save every receipt under directory for a user."""
+    from app import app
+    from models import User
+    from categorizer import get_user_categories, load_user_learned_items, categorize_text
+    from receipt_parser import parse_item_dates
+
+    directory = os.path.abspath(directory)
+    checkpoint_path = checkpoint_path or os.path.join(directory, CHECKPOINT_FILENAME)
+    done = load_checkpoint(checkpoint_path)
+
+    pending_files = [path for path in find_receipt_files(directory)
+                     if done.get(path) != _file_signature(path)]
+    skipped = sum(1 for _ in find_receipt_files(directory)) - len(pending_files)
+    print(f"Found {len(pending_files)} files to ingest ({skipped} already done)")
+
+    stats = {'files': 0, 'failed': 0, 'items': 0, 'latencies': []}
+    start = time.perf_counter()
+
+    with app.app_context():
+        if User.query.get(user_id) is None:
+            raise SystemExit(f"User {user_id} does not exist")
+
+        categories, automaton = get_user_categories(user_id)
+        user_learned_items = load_user_learned_items(user_id)
+
+        batch_rows = []
+        batch_paths = []
+
+        # Spawned workers don't inherit the parent's database connections
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            files = iter(pending_files)
+            in_flight = set()
+            # Keep a bounded number of files queued so memory does not grow with the folder
+            max_in_flight = workers * 4
+
+            while True:
+                for path in files:
+                    in_flight.add(executor.submit(ocr_file, path))
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if not in_flight:
+                    break
+
+                completed, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    path, text, error, seconds = future.result()
+                    stats['latencies'].append(seconds)
+                    stats['files'] += 1
+
+                    if error:
+                        stats['failed'] += 1
+                        logger.error(f"Failed to OCR {path}: {error}")
+                        continue
+
+                    items = categorize_text(text or '', categories, user_learned_items, automaton)
+                    dates = parse_item_dates(items)
+                    now = datetime.now()
+                    for item in items:
+                        batch_rows.append({
+                            'user_id': user_id,
+                            'description': item.description[:256],
+                            'amount': item.amount,
+                            'category_id': item.category_id,
+                            'date': dates[item.date] if item.date else now,
+                        })
+                        stats['items'] += 1
+                    batch_paths.append(path)
+
+                    if len(batch_paths) >= batch_size:
+                        save_batch(user_id, batch_rows, batch_paths, checkpoint_path)
+                        batch_rows, batch_paths = [], []
+
+        if batch_paths:
+            save_batch(user_id, batch_rows, batch_paths, checkpoint_path)
+
+    elapsed = time.perf_counter() - start
+    latencies = stats['latencies']
+    print("=" * 50)
+    print(f"Files processed: {stats['files']} ({stats['failed']} failed)")
+    print(f"Expense items saved: {stats['items']}")
+    print(f"Elapsed: {elapsed:.1f}s  throughput: {stats['files'] / elapsed if elapsed else 0:.2f} files/s")
+    print(f"OCR latency per file: p50 {percentile(latencies, 0.5):.2f}s  "
+          f"p95 {percentile(latencies, 0.95):.2f}s  max {max(latencies, default=0):.2f}s")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='expense_cli', description='Expense back-office tools.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = subparsers.add_parser('ingest', help='OCR and import a folder of receipts')
+    ingest_parser.add_argument('directory', help='Folder to scan for PDFs and images')
+    ingest_parser.add_argument('--user', type=int, required=True, help='ID of the user to import for')
+    ingest_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                               help='Number of OCR worker processes')
+    ingest_parser.add_argument('--batch-size', type=int, default=20,
+                               help='Files committed to the database per batch')
+    ingest_parser.add_argument('--checkpoint', help=f'Checkpoint file (default: DIR/{CHECKPOINT_FILENAME})')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'ingest':
+        if not os.path.isdir(args.directory):
+            parser.error(f"{args.directory} is not a directory")
+        stats = ingest(args.directory, args.user, args.workers, args.batch_size, args.checkpoint)
+        return 1 if stats['failed'] else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
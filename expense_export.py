@@ -0,0 +1,153 @@
+import io
+import csv
+import json
+import logging
+from itertools import chain
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+EXPORT_COLUMNS = ['id', 'date', 'description', 'amount', 'category_id', 'category']
+
+# Rows fetched from the cursor at a time; also the rows per CSV/JSON Lines chunk sent
+EXPORT_BATCH_SIZE = 5000
+
+# Rows per Parquet row group: a row group is buffered before it is written,
+# so this bounds the memory of a Parquet export
+PARQUET_ROW_GROUP_SIZE = 50000
+
+
+def export_filename(export_format, today=None):
+    return f"expenses-{(today or datetime.now()):%Y%m%d}.{export_format}"
+
+
+def _batches(query, batch_size, extra_batches=()):
+    """Yield lists of (id, description, amount, date, category_id, category) rows from a streamed query,
+    then the lists in extra_batches.
+    """
+    yield from chain(_query_batches(query, batch_size), extra_batches)
+
+
+def _query_batches(query, batch_size):
+    batch = []
+    # yield_per streams from a server-side cursor where the driver supports one
+    for row in query.yield_per(batch_size):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stream_csv(query, batch_size=EXPORT_BATCH_SIZE, extra_batches=()):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in _batches(query, batch_size, extra_batches):
+        writer.writerows((expense_id, date.strftime('%Y-%m-%d') if date else '', description, amount, category_id,
+                          category) for expense_id, description, amount, date, category_id, category in batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_jsonl(query, batch_size=EXPORT_BATCH_SIZE, extra_batches=()):
+    for batch in _batches(query, batch_size, extra_batches):
+        yield ''.join(json.dumps({
+            'id': expense_id,
+            'date': date.strftime('%Y-%m-%d') if date else None,
+            'description': description,
+            'amount': amount,
+            'category_id': category_id,
+            'category': category,
+        }) + '\n' for expense_id, description, amount, date, category_id, category in batch)
+
+
+class _ChunkSink:
+    """Write-only file that hands over what was written since the last drain()."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def stream_parquet(query, batch_size=EXPORT_BATCH_SIZE, row_group_size=PARQUET_ROW_GROUP_SIZE, extra_batches=()):
+    """Yield a Parquet file in pieces, one row group at a time. Needs pyarrow."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('date', pa.timestamp('us')),
+        ('description', pa.string()),
+        ('amount', pa.float64()),
+        ('category_id', pa.int64()),
+        ('category', pa.string()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    pending = []
+    pending_rows = 0
+    try:
+        for batch in _batches(query, batch_size, extra_batches):
+            expense_ids, descriptions, amounts, dates, category_ids, categories = zip(*batch)
+            # Columnar Arrow data as soon as it is fetched, in the order of EXPORT_COLUMNS
+            pending.append(pa.RecordBatch.from_arrays([
+                pa.array(values, type=field.type) for values, field in
+                zip((expense_ids, dates, descriptions, amounts, category_ids, categories), schema)], schema=schema))
+            pending_rows += len(batch)
+            if pending_rows >= row_group_size:
+                writer.write_table(pa.Table.from_batches(pending), row_group_size=pending_rows)
+                pending, pending_rows = [], 0
+                yield sink.drain()
+        if pending:
+            writer.write_table(pa.Table.from_batches(pending), row_group_size=pending_rows)
+    finally:
+        # Writes the footer; an export with no rows is still a valid, empty Parquet file
+        writer.close()
+    yield sink.drain()
+
+
+def stream_export(query, export_format, extra_batches=()):
+    """Yield the rows of an expense query, then those of extra_batches, in export_format ('csv', 'jsonl' or 'parquet')."""
+    if export_format == 'csv':
+        return stream_csv(query, extra_batches=extra_batches)
+    if export_format == 'jsonl':
+        return stream_jsonl(query, extra_batches=extra_batches)
+    return stream_parquet(query, extra_batches=extra_batches)
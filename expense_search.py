@@ -0,0 +1,192 @@
+import re
+import logging
+import sqlite3
+from sqlalchemy import event, text, DateTime
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Words of a search; anything else in the query is ignored
+_SEARCH_TERM = re.compile(r"[^\W_]+\*?")
+_WORD = re.compile(r"[^\W_]+")
+
+MAX_SEARCH_TERMS = 10
+
+
+def owned_terms(user_id, description):
+    """Return the words of description tagged with the owner, "u<user id>x<word>", for the SQLite index.
+
+    Words are split on every non-alphanumeric character, as FTS5 and
+    parse_search_terms split them, so no word is indexed without its tag.
+    """
+    if description is None:
+        return None
+    return ' '.join(f"u{user_id}x{word}" for word in _WORD.findall(description))
+
+
+@event.listens_for(Engine, "connect")
+def _register_owned_terms(dbapi_connection, connection_record):
+    # The index triggers call owned_terms, so every SQLite connection that writes expenses needs it
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('owned_terms', 2, owned_terms, deterministic=True)
+
+
+# SQLite: a contentless FTS5 index kept in step with expense by triggers.
+# Every word is indexed together with its owner ("u12xcoffee"), so a search
+# only reads the searching user's postings however many users share the table.
+_SQLITE_SETUP = [
+    "CREATE VIRTUAL TABLE expense_fts USING fts5(terms, content='', tokenize='unicode61 remove_diacritics 2')",
+    """CREATE TRIGGER expense_fts_insert AFTER INSERT ON expense BEGIN
+        INSERT INTO expense_fts(rowid, terms) VALUES (new.id, owned_terms(new.user_id, new.description));
+    END""",
+    """CREATE TRIGGER expense_fts_delete AFTER DELETE ON expense BEGIN
+        INSERT INTO expense_fts(expense_fts, rowid, terms)
+            VALUES ('delete', old.id, owned_terms(old.user_id, old.description));
+    END""",
+    """CREATE TRIGGER expense_fts_update AFTER UPDATE OF description, user_id ON expense BEGIN
+        INSERT INTO expense_fts(expense_fts, rowid, terms)
+            VALUES ('delete', old.id, owned_terms(old.user_id, old.description));
+        INSERT INTO expense_fts(rowid, terms) VALUES (new.id, owned_terms(new.user_id, new.description));
+    END""",
+    "INSERT INTO expense_fts(rowid, terms) SELECT id, owned_terms(user_id, description) FROM expense",
+]
+
+_SQLITE_TEARDOWN = [
+    "DROP TRIGGER IF EXISTS expense_fts_insert",
+    "DROP TRIGGER IF EXISTS expense_fts_delete",
+    "DROP TRIGGER IF EXISTS expense_fts_update",
+    "DROP TABLE IF EXISTS expense_fts",
+]
+
+# Postgres: a generated tsvector column, so inserts and updates maintain it, with a GIN index
+_POSTGRES_SETUP = [
+    """ALTER TABLE expense ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', coalesce(description, ''))) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_expense_search_vector ON expense USING GIN (search_vector)",
+]
+
+_backends = {}
+
+
+def search_backend(engine):
+    """Return 'sqlite', 'postgresql' or None if the database has no full-text index."""
+    if engine.url not in _backends:
+        backend = None
+        if engine.dialect.name == 'sqlite':
+            with engine.connect() as connection:
+                if connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'expense_fts'")).first():
+                    backend = 'sqlite'
+        elif engine.dialect.name == 'postgresql':
+            backend = 'postgresql'
+        _backends[engine.url] = backend
+    return _backends[engine.url]
+
+
+def create_search_index(engine):
+    """Create the full-text index over expense descriptions and fill it from existing rows."""
+    if engine.dialect.name == 'sqlite':
+        _backends.pop(engine.url, None)
+        if search_backend(engine):
+            with engine.connect() as connection:
+                trigger = connection.execute(text(
+                    "SELECT sql FROM sqlite_master WHERE name = 'expense_fts_insert'")).scalar()
+            if trigger and 'owned_terms' in trigger:
+                return
+            # Indexes built by SQL replace() calls missed words after unlisted punctuation; rebuild them
+            statements = _SQLITE_TEARDOWN + _SQLITE_SETUP
+        else:
+            statements = _SQLITE_SETUP
+    elif engine.dialect.name == 'postgresql':
+        statements = _POSTGRES_SETUP
+    else:
+        logger.warning(f"No full-text index for {engine.dialect.name}; expense search will scan")
+        return
+    try:
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+    except Exception as e:
+        # e.g. an SQLite build without FTS5
+        logger.warning(f"Could not create the expense search index, search will scan: {e}")
+        if engine.dialect.name == 'sqlite':
+            # SQLite DDL isn't rolled back with the transaction; don't leave a half-built index
+            with engine.begin() as connection:
+                for statement in _SQLITE_TEARDOWN:
+                    connection.execute(text(statement))
+    _backends.pop(engine.url, None)
+
+
+def optimize_search_index(engine):
+    """Merge the SQLite index into one segment, dropping the entries of deleted expenses.
+
+    FTS5 records a deletion as a new entry next to the old one, so after
+    many rows are deleted the index is larger than before until it's merged.
+    """
+    if search_backend(engine) == 'sqlite':
+        with engine.begin() as connection:
+            connection.execute(text("INSERT INTO expense_fts(expense_fts) VALUES ('optimize')"))
+
+
+def parse_search_terms(query, prefix=True):
+    """Split a search into terms. Returns [(term, is_prefix)].
+
+    A term ending in * is always a prefix; with prefix the last term is one
+    too, so results follow the user while they type.
+    """
+    terms = []
+    for match in _SEARCH_TERM.findall(query.lower())[:MAX_SEARCH_TERMS]:
+        term = match.rstrip('*')
+        if term:
+            terms.append((term, match.endswith('*')))
+    if prefix and terms:
+        terms[-1] = (terms[-1][0], True)
+    return terms
+
+
+def search_expenses(user_id, terms, limit, order='rank'):
+    """Return a user's expenses matching all terms as rows of
+    (id, description, amount, date, category_id, category name, score).
+
+    order='rank' puts the best matches first (BM25 on SQLite, ts_rank on
+    Postgres; lower scores are better); order='date' puts the newest first
+    and the score may be None.
+    """
+    from models import db, Expense, Category
+
+    backend = search_backend(db.engine)
+    if backend == 'sqlite':
+        match = ' '.join(f'"u{int(user_id)}x{term}"' + ('*' if is_prefix else '') for term, is_prefix in terms)
+        # Materialized so the matches are found once, not probed per expense row.
+        # Ranked: the best matches are picked inside the index before any join.
+        # By date: every match needs its date, and scoring (which reads each
+        # match's length) is skipped.
+        if order == 'rank':
+            hits = ("SELECT rowid, bm25(expense_fts) AS score FROM expense_fts WHERE expense_fts MATCH :match "
+                    "ORDER BY score LIMIT :limit")
+        else:
+            hits = "SELECT rowid, NULL AS score FROM expense_fts WHERE expense_fts MATCH :match"
+        sql = f"""WITH hits AS MATERIALIZED ({hits})
+            SELECT e.id, e.description, e.amount, e.date, e.category_id, c.name, hits.score
+            FROM hits JOIN expense e ON e.id = hits.rowid JOIN category c ON c.id = e.category_id
+            ORDER BY {'hits.score' if order == 'rank' else 'e.date DESC, e.id DESC'} LIMIT :limit"""
+        params = {'match': match, 'limit': limit}
+    elif backend == 'postgresql':
+        tsquery = ' & '.join(term + (':*' if is_prefix else '') for term, is_prefix in terms)
+        # Negated so that, as with BM25, lower scores are better matches
+        sql = f"""SELECT e.id, e.description, e.amount, e.date, e.category_id, c.name,
+                -ts_rank(e.search_vector, to_tsquery('simple', :tsquery)) AS score
+            FROM expense e JOIN category c ON c.id = e.category_id
+            WHERE e.user_id = :user_id AND e.search_vector @@ to_tsquery('simple', :tsquery)
+            ORDER BY {'score' if order == 'rank' else 'e.date DESC, e.id DESC'} LIMIT :limit"""
+        params = {'tsquery': tsquery, 'user_id': user_id, 'limit': limit}
+    else:
+        query = db.session.query(Expense.id, Expense.description, Expense.amount, Expense.date,
+                                 Expense.category_id, Category.name).join(
+            Category, Expense.category_id == Category.id).filter(Expense.user_id == user_id)
+        for term, is_prefix in terms:
+            query = query.filter(Expense.description.ilike(f"%{term}%"))
+        rows = query.order_by(Expense.date.desc(), Expense.id.desc()).limit(limit)
+        return [tuple(row) + (None,) for row in rows]
+
+    # Typed so SQLite's text dates come back as datetimes
+    return db.session.execute(text(sql).columns(date=DateTime), params).all()
@@ -44,6 +44,17 @@ def create_statement_pdf(input_file, output_file):
     return output_file
 
 if __name__ == "__main__":
+    # Generate the sample text files if they aren't there yet
+    if not os.path.exists("sample_receipt.txt") or not os.path.exists("sample_bank_statement.txt"):
+        import random
+        from corpus_generator import load_category_keywords, generate_receipt, generate_statement
+        rng = random.Random(0)
+        keywords = load_category_keywords()
+        with open("sample_receipt.txt", "w") as f:
+            f.write(generate_receipt(rng, keywords)['text'])
+        with open("sample_bank_statement.txt", "w") as f:
+            f.write(generate_statement(rng, keywords)['text'])
+    
     # Generate receipt PDF
     receipt_output = create_receipt_pdf("sample_receipt.txt", "sample_receipt.pdf")
     print(f"Created: {receipt_output}")
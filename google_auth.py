@@ -2,8 +2,10 @@
 
 import json
 import os
+import re
+import time
 import logging
-import secrets
+import threading
 import traceback
 from urllib.parse import urlencode
 from dotenv import load_dotenv
@@ -11,14 +13,26 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 import requests
-from flask import Blueprint, redirect, request, url_for, flash, session, current_app
-from flask_login import login_required, login_user, logout_user, current_user
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Blueprint, redirect, request, url_for, flash, session
+from flask_login import login_user
 from models import db, User
-from oauthlib.oauth2 import WebApplicationClient
 
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_OAUTH_CLIENT_ID", "")
 GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_OAUTH_CLIENT_SECRET", "")
-GOOGLE_DISCOVERY_URL = "https://accounts.google.com/.well-known/openid-configuration"
+# Overridable so the sign-in flow can be exercised against a local stub provider
+GOOGLE_DISCOVERY_URL = os.environ.get(
+    "GOOGLE_DISCOVERY_URL", "https://accounts.google.com/.well-known/openid-configuration")
+
+# (connect, read) timeouts for every call to the identity provider
+HTTP_TIMEOUT = (3.05, 10)
+
+# Used when the discovery response has no Cache-Control max-age
+DEFAULT_DISCOVERY_MAX_AGE = 3600
+
+# Start a background refresh once this fraction of max-age has elapsed
+DISCOVERY_REFRESH_FRACTION = 0.8
 
 # Make sure to use this redirect URL. It has to match the one in the whitelist
 DEV_REDIRECT_URL = 'http://localhost:5000/google_login/callback'
@@ -27,8 +41,12 @@ DEV_REDIRECT_URL = 'http://localhost:5000/google_login/callback'
 ALT_REDIRECT_URL = f'https://{os.environ.get("REPLIT_DEV_DOMAIN", "")}/login'
 JS_ORIGIN = f'https://{os.environ.get("REPLIT_DEV_DOMAIN", "")}'
 
-# Display setup instructions to the user
-print(f"""To make Google authentication work:
+logger = logging.getLogger(__name__)
+
+
+def print_setup_instructions():
+    """Print the Google OAuth setup instructions and current configuration."""
+    print(f"""To make Google authentication work:
 1. Go to https://console.cloud.google.com/apis/credentials
 2. Create a new OAuth 2.0 Client ID
 3. Add these URIs to "Authorized redirect URIs":
@@ -40,23 +58,101 @@ print(f"""To make Google authentication work:
 For detailed instructions, see:
 https://docs.replit.com/additional-resources/google-auth-in-flask#set-up-your-oauth-app--client
 """)
+    logger.info(f"Google OAuth redirect URL: {DEV_REDIRECT_URL}")
+    logger.info(f"Alternative redirect URL: {ALT_REDIRECT_URL}")
+    logger.info(f"JavaScript Origin: {JS_ORIGIN}")
+    logger.info(f"GOOGLE_CLIENT_ID: {'Configured' if GOOGLE_CLIENT_ID else 'Not configured'}")
+    logger.info(f"GOOGLE_CLIENT_SECRET: {'Configured' if GOOGLE_CLIENT_SECRET else 'Not configured'}")
+
+    # For debugging, print the exact credentials
+    if GOOGLE_CLIENT_ID:
+        # Only print first few and last few characters for security
+        masked_id = f"{GOOGLE_CLIENT_ID[:5]}...{GOOGLE_CLIENT_ID[-5:]}"
+        logger.info(f"Client ID (masked): {masked_id}")
+
+
+def create_http_session():
+    """Create a pooled HTTP session that keeps connections to the provider alive."""
+    http = requests.Session()
+    retries = Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504),
+                    allowed_methods=frozenset(["GET"]))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http
+
+
+def parse_max_age(cache_control):
+    """Return the max-age in seconds from a Cache-Control header, or None."""
+    if not cache_control:
+        return None
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0
+    match = re.search(r"max-age=(\d+)", cache_control)
+    return int(match.group(1)) if match else None
+
+
+class DiscoveryCache:
+    """Caches the OpenID discovery document, honoring Cache-Control.
+
+    Once most of the max-age has elapsed the document is refreshed on a
+    background thread while callers keep getting the cached copy. If a fetch
+    fails and a previous document exists, the stale document is served.
+    """
+
+    def __init__(self, url, http, timeout=HTTP_TIMEOUT):
+        self.url = url
+        self.http = http
+        self.timeout = timeout
+        self.document = None
+        self.fetched_at = 0.0
+        self.max_age = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _fetch(self):
+        response = self.http.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        document = response.json()
+        max_age = parse_max_age(response.headers.get("Cache-Control"))
+        with self._lock:
+            self.document = document
+            self.fetched_at = time.monotonic()
+            self.max_age = DEFAULT_DISCOVERY_MAX_AGE if max_age is None else max_age
+        return document
+
+    def _background_refresh(self):
+        try:
+            self._fetch()
+        except Exception as e:
+            logger.warning(f"Background refresh of OpenID discovery document failed: {e}")
+        finally:
+            self._refreshing = False
+
+    def get(self):
+        """Return the discovery document, fetching it only when needed."""
+        age = time.monotonic() - self.fetched_at
+        if self.document is None or age >= self.max_age:
+            try:
+                return self._fetch()
+            except Exception:
+                if self.document is None:
+                    raise
+                logger.warning("Could not refresh OpenID discovery document, using stale copy", exc_info=True)
+                return self.document
+
+        if age >= self.max_age * DISCOVERY_REFRESH_FRACTION and not self._refreshing:
+            with self._lock:
+                if self._refreshing:
+                    return self.document
+                self._refreshing = True
+            threading.Thread(target=self._background_refresh, daemon=True).start()
+        return self.document
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-logger.info(f"Google OAuth redirect URL: {DEV_REDIRECT_URL}")
-logger.info(f"Alternative redirect URL: {ALT_REDIRECT_URL}")
-logger.info(f"JavaScript Origin: {JS_ORIGIN}")
-logger.info(f"GOOGLE_CLIENT_ID: {'Configured' if GOOGLE_CLIENT_ID else 'Not configured'}")
-logger.info(f"GOOGLE_CLIENT_SECRET: {'Configured' if GOOGLE_CLIENT_SECRET else 'Not configured'}")
 
-# For debugging, print the exact credentials
-if GOOGLE_CLIENT_ID:
-    # Only print first few and last few characters for security
-    masked_id = f"{GOOGLE_CLIENT_ID[:5]}...{GOOGLE_CLIENT_ID[-5:]}"
-    logger.info(f"Client ID (masked): {masked_id}")
+http_session = create_http_session()
+discovery_cache = DiscoveryCache(GOOGLE_DISCOVERY_URL, http_session)
 
-client = WebApplicationClient(GOOGLE_CLIENT_ID)
 
 google_auth = Blueprint("google_auth", __name__)
 
@@ -76,7 +172,7 @@ def login():
     
     try:
         # Fetch Google's OAuth configuration
-        google_provider_cfg = requests.get(GOOGLE_DISCOVERY_URL).json()
+        google_provider_cfg = discovery_cache.get()
         authorization_endpoint = google_provider_cfg["authorization_endpoint"]
         
         # Build the redirect URI - Always use the full static redirect URI
@@ -125,7 +221,7 @@ def auth_debug():
     
     # Get Google's discovery configuration
     try:
-        google_config = requests.get(GOOGLE_DISCOVERY_URL).json()
+        google_config = discovery_cache.get()
         debug_info["google_discovery"] = {
             "authorization_endpoint": google_config.get("authorization_endpoint"),
             "token_endpoint": google_config.get("token_endpoint"),
@@ -194,7 +290,7 @@ def callback():
     
     try:
         # Get token endpoint
-        google_provider_cfg = requests.get(GOOGLE_DISCOVERY_URL).json()
+        google_provider_cfg = discovery_cache.get()
         token_endpoint = google_provider_cfg["token_endpoint"]
         
         # Use static redirect URL for token request - this must match what Google expects
@@ -216,9 +312,10 @@ def callback():
         logging.info(f"Token request data: {token_data}")
         
         # Exchange code for tokens
-        token_response = requests.post(
+        token_response = http_session.post(
             token_endpoint,
-            data=token_data
+            data=token_data,
+            timeout=HTTP_TIMEOUT
         )
         
         # Check token response
@@ -249,7 +346,7 @@ def callback():
         headers = {'Authorization': f'Bearer {access_token}'}
         logging.info(f"User info request URL: {userinfo_endpoint}")
         
-        userinfo_response = requests.get(userinfo_endpoint, headers=headers)
+        userinfo_response = http_session.get(userinfo_endpoint, headers=headers, timeout=HTTP_TIMEOUT)
         logging.info(f"User info response status: {userinfo_response.status_code}")
         
         if userinfo_response.status_code != 200:
@@ -0,0 +1,267 @@
+import os
+import sys
+import threading
+from collections import deque, OrderedDict
+
+# Memory budget for compiled automata keyed by category content, so every user
+# of the shared default categories shares one categories dict and automaton.
+AUTOMATON_CACHE_BYTES = int(os.environ.get("KEYWORD_INDEX_CACHE_BYTES", 16 * 1024 * 1024))
+
+
+class SizedLRUCache:
+    """Thread-safe LRU cache bounded by the estimated bytes of its values and an entry count."""
+
+    def __init__(self, max_bytes, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            # Always keep the newest entry, even if it alone exceeds the budget
+            while len(self._entries) > 1 and (
+                    self.current_bytes > self.max_bytes
+                    or (self.max_entries and len(self._entries) > self.max_entries)):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self.current_bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def estimate_categories_size(categories):
+    """Rough size in bytes of a categories dict of names and keyword lists."""
+    size = sys.getsizeof(categories)
+    for category_data in categories.values():
+        size += sys.getsizeof(category_data) + sys.getsizeof(category_data['name'])
+        size += sys.getsizeof(category_data['keywords'])
+        size += sum(sys.getsizeof(keyword) for keyword in category_data['keywords'])
+    return size
+
+
+# Number of distinct character codes, used to pack (state, character) into one int key
+_CHAR_SPAN = 0x110000
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton over all category keywords.
+
+    Keywords are ranked in category/keyword order, the same order the fuzzy
+    pass visits them, so when several keywords occur in a description the
+    one the fuzzy pass would have scored 100 first wins.
+    """
+
+    def __init__(self, categories):
+        # State 0 is the root; goto holds the trie edges of each state while building
+        goto = [{}]
+        self.fail = [0]
+        # Ranks of keywords ending at each state, including via fail links
+        self.outputs = [[]]
+        # Category id of each keyword rank
+        self.rank_category = []
+        self.rank_keyword = []
+
+        seen = set()
+        for category_id, category_data in categories.items():
+            for keyword in category_data['keywords']:
+                keyword = keyword.lower()
+                if not keyword or keyword in seen:
+                    continue
+                seen.add(keyword)
+                self._add(goto, keyword, len(self.rank_category))
+                self.rank_category.append(category_id)
+                self.rank_keyword.append(keyword)
+        self._build_fail_links(goto)
+        # Best (lowest) rank reachable from each state, so a scan only keeps a minimum
+        self.best = [min(ranks) if ranks else None for ranks in self.outputs]
+        # Pack the trie into one dict keyed by state and character code: a dict per
+        # state costs several times more memory when thousands of users have one
+        self.transitions = {state * _CHAR_SPAN + ord(char): next_state
+                            for state, edges in enumerate(goto) for char, next_state in edges.items()}
+        # Most states output nothing; share the empty tuple between them
+        self.outputs = [tuple(ranks) for ranks in self.outputs]
+        self.memory_bytes = self._estimate_size()
+
+    def _add(self, goto, keyword, rank):
+        state = 0
+        for char in keyword:
+            next_state = goto[state].get(char)
+            if next_state is None:
+                next_state = len(goto)
+                goto[state][char] = next_state
+                goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            state = next_state
+        self.outputs[state].append(rank)
+
+    def _build_fail_links(self, goto):
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = goto[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def _estimate_size(self):
+        size = sys.getsizeof(self.transitions)
+        # Keys beyond the small-int cache are separate objects; states mostly are too
+        size += sum(sys.getsizeof(key) for key in self.transitions)
+        size += sum(sys.getsizeof(ranks) for ranks in self.outputs if ranks)
+        size += sum(sys.getsizeof(keyword) for keyword in self.rank_keyword)
+        for table in (self.fail, self.outputs, self.best, self.rank_category, self.rank_keyword):
+            size += sys.getsizeof(table)
+        return size
+
+    def dense_transitions(self, alphabet):
+        """Return the automaton as a DFA table of len(states) rows by len(alphabet) + 1 symbols.
+
+        Symbol i stands for alphabet[i - 1] and symbol 0 for every other
+        character. Fail links are folded into the table, so following it
+        takes one lookup per character.
+        """
+        width = len(alphabet) + 1
+        codes = [ord(char) for char in alphabet]
+        table = [0] * (len(self.fail) * width)
+        children = {}
+        for key, next_state in self.transitions.items():
+            children.setdefault(key // _CHAR_SPAN, []).append(next_state)
+        # Breadth-first, so the row of a state's (shallower) fail target is already filled
+        queue = deque([0])
+        while queue:
+            state = queue.popleft()
+            row = state * width
+            fallback = self.fail[state] * width
+            for symbol, code in enumerate(codes, 1):
+                next_state = self.transitions.get(state * _CHAR_SPAN + code)
+                if next_state is None:
+                    next_state = table[fallback + symbol] if state else 0
+                table[row + symbol] = next_state
+            queue.extend(children.get(state, ()))
+        return table
+
+    def _step(self, state, char):
+        transitions = self.transitions
+        code = ord(char)
+        while True:
+            next_state = transitions.get(state * _CHAR_SPAN + code)
+            if next_state is not None:
+                return next_state
+            if not state:
+                return 0
+            state = self.fail[state]
+
+    def iter_matches(self, text):
+        """Yield (end index, keyword) for every keyword occurring in text."""
+        state = 0
+        for index, char in enumerate(text):
+            state = self._step(state, char)
+            for rank in self.outputs[state]:
+                yield index, self.rank_keyword[rank]
+
+    def best_match(self, text):
+        """Return the category id of the best exact keyword hit in text, or None."""
+        # _step inlined: this runs for every line of every receipt
+        transitions = self.transitions
+        fail = self.fail
+        best_ranks = self.best
+        state = 0
+        best = None
+        for char in text:
+            code = ord(char)
+            while True:
+                next_state = transitions.get(state * _CHAR_SPAN + code)
+                if next_state is not None:
+                    state = next_state
+                    break
+                if not state:
+                    break
+                state = fail[state]
+            rank = best_ranks[state]
+            if rank is not None and (best is None or rank < best):
+                best = rank
+        return None if best is None else self.rank_category[best]
+
+
+def categories_version(categories):
+    """Hashable fingerprint of the names and keywords in a categories dict."""
+    return tuple((category_id, category_data['name'], tuple(category_data['keywords']))
+                 for category_id, category_data in categories.items())
+
+
+_automata = SizedLRUCache(AUTOMATON_CACHE_BYTES)
+# (categories dict, automaton) of the most recent call, swapped as one tuple
+_last_seen = (None, None)
+
+
+def get_keyword_index(categories):
+    """Return (categories, automaton) for a categories dict, building the automaton once per version.
+
+    The returned categories dict is the first one seen with the same content,
+    so callers holding on to it don't keep duplicate copies alive.
+    """
+    version = categories_version(categories)
+    index = _automata.get(version)
+    if index is None:
+        automaton = KeywordAutomaton(categories)
+        index = (categories, automaton)
+        _automata.put(version, index, automaton.memory_bytes + estimate_categories_size(categories))
+    return index
+
+
+def get_keyword_automaton(categories):
+    """Return the automaton for a categories dict, building it once per category version."""
+    global _last_seen
+    # Fast path: the same dict object is passed for every item of a receipt
+    last_categories, last_automaton = _last_seen
+    if last_categories is categories:
+        return last_automaton
+
+    automaton = get_keyword_index(categories)[1]
+    _last_seen = (categories, automaton)
+    return automaton
+
+
+def automaton_cache_stats():
+    return _automata.stats()
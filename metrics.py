@@ -0,0 +1,164 @@
+import os
+import time
+import threading
+from functools import wraps
+from bisect import bisect_left
+from contextlib import nullcontext
+
+# Set METRICS_ENABLED=0 to turn spans into no-ops and disable /metrics
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+
+STAGE_METRIC = "expense_stage_duration_seconds"
+STAGE_HELP = "Time spent in each stage of the expense pipeline."
+
+# Upper bounds in seconds, from cheap in-process work up to slow OCR pages
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+EVENT_METRIC = "expense_events_total"
+EVENT_HELP = "Count of notable events in the expense pipeline."
+
+_NOOP_SPAN = nullcontext()
+
+
+class Histogram:
+    """Fixed-bucket histogram of observed durations."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One slot per bucket plus the +Inf overflow bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """Return (cumulative bucket counts, sum, count)."""
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = []
+        running = 0
+        for value in counts:
+            running += value
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+_stage_histograms = {}
+_registry_lock = threading.Lock()
+
+
+def get_stage_histogram(stage):
+    """Return the histogram for a pipeline stage, creating it on first use."""
+    histogram = _stage_histograms.get(stage)
+    if histogram is None:
+        with _registry_lock:
+            histogram = _stage_histograms.setdefault(stage, Histogram())
+    return histogram
+
+
+_event_counts = {}
+
+
+def count_event(event, amount=1):
+    """Increment the counter for a named pipeline event."""
+    if METRICS_ENABLED:
+        with _registry_lock:
+            _event_counts[event] = _event_counts.get(event, 0) + amount
+
+
+def get_event_count(event):
+    return _event_counts.get(event, 0)
+
+
+class _Span:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+def timed(stage):
+    """Context manager that records the duration of a block under a stage name."""
+    if not METRICS_ENABLED:
+        return _NOOP_SPAN
+    return _Span(get_stage_histogram(stage))
+
+
+def timed_function(stage):
+    """Decorator that records every call of a function under a stage name."""
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+        histogram = get_stage_histogram(stage)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+
+        return wrapper
+    return decorator
+
+
+def instrument_commits(session_class):
+    """Record the duration of every commit (including its flush) on a SQLAlchemy session class."""
+    if not METRICS_ENABLED:
+        return
+    from sqlalchemy import event
+
+    histogram = get_stage_histogram("db_commit")
+
+    @event.listens_for(session_class, "before_commit")
+    def _before_commit(session):
+        session.info["metrics_commit_start"] = time.perf_counter()
+
+    @event.listens_for(session_class, "after_commit")
+    def _after_commit(session):
+        start = session.info.pop("metrics_commit_start", None)
+        if start is not None:
+            histogram.observe(time.perf_counter() - start)
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+def render_metrics():
+    """Render all histograms and counters in the Prometheus text exposition format.
+
+    Histograms are per process, so under gunicorn each scrape sees the
+    worker that happened to serve it.
+    """
+    lines = [f"# HELP {STAGE_METRIC} {STAGE_HELP}", f"# TYPE {STAGE_METRIC} histogram"]
+    for stage in sorted(_stage_histograms):
+        histogram = _stage_histograms[stage]
+        cumulative, total, count = histogram.snapshot()
+        for bound, value in zip(histogram.buckets, cumulative):
+            lines.append(f'{STAGE_METRIC}_bucket{{stage="{stage}",le="{_format_bound(bound)}"}} {value}')
+        lines.append(f'{STAGE_METRIC}_bucket{{stage="{stage}",le="+Inf"}} {cumulative[-1]}')
+        lines.append(f'{STAGE_METRIC}_sum{{stage="{stage}"}} {total}')
+        lines.append(f'{STAGE_METRIC}_count{{stage="{stage}"}} {count}')
+
+    lines += [f"# HELP {EVENT_METRIC} {EVENT_HELP}", f"# TYPE {EVENT_METRIC} counter"]
+    for event in sorted(_event_counts):
+        lines.append(f'{EVENT_METRIC}{{event="{event}"}} {_event_counts[event]}')
+    return "\n".join(lines) + "\n"
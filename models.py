@@ -1,8 +1,12 @@
 
+import os
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+from normalizer import normalize_description
 
 db = SQLAlchemy()
 
@@ -12,6 +16,8 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(256))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bumped on every edit to the user's categories so cached matchers can be invalidated
+    categories_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     expenses = db.relationship('Expense', backref='user', lazy=True)
     
     def set_password(self, password):
@@ -24,19 +30,160 @@ class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
     keywords = db.Column(db.Text, nullable=True)  # JSON string of keywords
+    # NULL for the shared default categories, otherwise the owner of a custom category
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
     expenses = db.relationship('Expense', backref='category', lazy=True)
     
     def __repr__(self):
         return f'<Category {self.name}>'
 
+def _normalized_description_default(context):
+    # Filled in from the description on every insert path, including bulk Core inserts
+    description = context.get_current_parameters().get('description')
+    return normalize_description(description) if description else None
+
 class Expense(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     description = db.Column(db.String(256), nullable=False)
+    # normalize_description(description), so corrections can find the same item across a user's history
+    normalized_description = db.Column(db.String(256), nullable=True, default=_normalized_description_default)
     amount = db.Column(db.Float, nullable=False)
+    # On Postgres, `flask partition-expenses` partitions the table by month of date; the
+    # database key is then (id, date), and date is NOT NULL
     date = db.Column(db.DateTime, default=datetime.utcnow)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Composite indexes backing the history API: keyset pagination walks
+    # (user_id, date, id) and category filters narrow on (user_id, category_id)
+    __table_args__ = (
+        db.Index('ix_expense_user_date_id', 'user_id', 'date', 'id'),
+        db.Index('ix_expense_user_category', 'user_id', 'category_id'),
+        db.Index('ix_expense_user_normalized_id', 'user_id', 'normalized_description', 'id'),
+        # Reading a user's rows newer than a known id, as the recurring-charge detector does
+        db.Index('ix_expense_user_id', 'user_id', 'id'),
+    )
+    
     def __repr__(self):
         return f'<Expense {self.description}: ${self.amount:.2f}>'
+
+class ReceiptImageHash(db.Model):
+    """Perceptual hash of an OCR'd receipt image, used to flag re-uploads of the same receipt."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    image_hash = db.Column(db.String(16), nullable=False)  # 64-bit pHash as hex
+    aspect = db.Column(db.Float, nullable=False)  # log(height / width) of the text region
+    sha256 = db.Column(db.String(64), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # The per-user index catches up by reading rows with a higher id than it has seen
+    __table_args__ = (
+        db.Index('ix_receipt_image_hash_user_id', 'user_id', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<ReceiptImageHash {self.image_hash}>'
+
+class Budget(db.Model):
+    """A monthly spending limit on one of a user's categories."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    monthly_limit = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'category_id', name='uq_budget_user_category'),
+    )
+
+    def __repr__(self):
+        return f'<Budget {self.category_id}: ${self.monthly_limit:.2f}>'
+
+class CategorySpend(db.Model):
+    """Running total of a user's expenses in a category for one month ("YYYY-MM").
+
+    Updated in the same transaction as every insert and category change, so
+    budgets never need to sum the expense table.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), primary_key=True)
+    month = db.Column(db.String(7), primary_key=True)
+    total = db.Column(db.Float, nullable=False, default=0.0)
+
+    def __repr__(self):
+        return f'<CategorySpend {self.category_id} {self.month}: ${self.total:.2f}>'
+
+class BudgetAlert(db.Model):
+    """A budget threshold (a fraction of the limit) that a month's spending crossed."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    month = db.Column(db.String(7), nullable=False)
+    threshold = db.Column(db.Float, nullable=False)
+    total = db.Column(db.Float, nullable=False)
+    monthly_limit = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Each threshold alerts once per category and month
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'category_id', 'month', 'threshold', name='uq_budget_alert'),
+        db.Index('ix_budget_alert_user_month', 'user_id', 'month'),
+    )
+
+    def __repr__(self):
+        return f'<BudgetAlert {self.category_id} {self.month} {self.threshold:.0%}>'
+
+# Longest a transaction may take from inserting a row to committing it. Ids are taken
+# on insert, so rows can become visible below the highest id a per-user index has read
+LATE_COMMIT_SECONDS = int(os.environ.get("LATE_COMMIT_SECONDS", 60))
+
+def catch_up_floor(model, user_id, last_id, last_read_at):
+    """Return the id above which a per-user index of model must read to catch up since its read at last_read_at.
+
+    last_read_at is a utcnow time, as created_at is. A row committed since
+    then was inserted at most LATE_COMMIT_SECONDS before it, after the newest
+    row created before that, so only rows above that row's id are read
+    again. Walks the (user_id, id) index back over the rows of that window.
+    """
+    if not last_id:
+        return 0
+    return db.session.query(model.id).filter(
+        model.user_id == user_id, model.id <= last_id,
+        model.created_at < last_read_at - timedelta(seconds=LATE_COMMIT_SECONDS)).order_by(
+        model.id.desc()).limit(1).scalar() or 0
+
+# Columns added to tables that databases created by earlier versions already have.
+# db.create_all() creates missing tables but never alters existing ones.
+ADDED_COLUMNS = [User.__table__.c.categories_version, Category.__table__.c.user_id,
+                 Expense.__table__.c.normalized_description]
+
+def upgrade_schema(engine):
+    """Add missing ADDED_COLUMNS, and missing indexes of their tables, to an existing database.
+
+    Safe to run on every start: only what the inspector doesn't find is
+    created. Returns the names of the columns added.
+    """
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    tables = []
+    added = []
+    with engine.begin() as connection:
+        for column in ADDED_COLUMNS:
+            table = column.table
+            if table not in tables:
+                tables.append(table)
+            if column.name in {existing['name'] for existing in inspector.get_columns(table.name)}:
+                continue
+            definition = str(CreateColumn(column).compile(dialect=engine.dialect))
+            for foreign_key in column.foreign_keys:
+                definition += (f" REFERENCES {preparer.format_table(foreign_key.column.table)} "
+                               f"({preparer.quote(foreign_key.column.name)})")
+            connection.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {definition}"))
+            added.append(f"{table.name}.{column.name}")
+        for table in tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+    return added
@@ -0,0 +1,52 @@
+import re
+from functools import lru_cache
+
+# Distinct descriptions whose normalized form is memoized
+NORMALIZE_CACHE_SIZE = 65536
+
+_PRICE = re.compile(r'\$?\d+[.,]\d{2}(?!\d)')
+_UNIT_QUANTITY = re.compile(
+    r'(?<![a-z])\d+(?:[.,]\d+)?\s*(?:lbs?|oz|kg|gr?|ml|cl|ltr|l|gal|qt|pt|ct|pk|pcs?|ea)(?![a-z])')
+_MULTIPLIER = re.compile(r'(?<![a-z0-9])(?:\d+\s*[x@*]|[x@*]\s*\d+|qty\s*\d+)(?![a-z0-9])')
+_SKU = re.compile(r'#?\d{4,}')
+_MIXED_TOKEN = re.compile(r'[a-z0-9]*(?:[a-z][0-9]|[0-9][a-z])[a-z0-9]*')
+_NON_WORD = re.compile(r"[^a-z0-9'&+\- ]+")
+_NUMBER_TOKEN = re.compile(r'(?<![a-z0-9])[0-9%+\-]+(?![a-z0-9])')
+
+# Digits OCR commonly reads in place of letters inside words
+_CONFUSABLES = str.maketrans({'0': 'o', '1': 'l', '5': 's', '8': 'b'})
+
+
+def _fix_confusables(match):
+    token = match.group(0)
+    # Only repair tokens that are mostly letters, e.g. "ch0c0late" but not "4k"
+    letters = sum(char.isalpha() for char in token)
+    return token.translate(_CONFUSABLES) if letters > len(token) - letters else token
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_description(description):
+    """Reduce an OCR'd item description to a stable key for lookups and caches.
+
+    Removes prices, SKU/PLU codes, weights and units, quantities and
+    multipliers, repairs digit/letter OCR confusions inside words and
+    collapses punctuation and whitespace, so that "0012345 MILK 2%" and
+    "2 @ MILK" both become "milk".
+    """
+    text = description.lower()
+    # Weights go before prices so "2.31lb" isn't half-consumed as a price
+    text = _UNIT_QUANTITY.sub(' ', text)
+    text = _PRICE.sub(' ', text)
+    text = _MULTIPLIER.sub(' ', text)
+    text = _SKU.sub(' ', text)
+    text = _MIXED_TOKEN.sub(_fix_confusables, text)
+    text = _NON_WORD.sub(' ', text)
+    text = _NUMBER_TOKEN.sub(' ', text)
+    normalized = ' '.join(token.strip("-'") for token in text.split() if token.strip("-'"))
+    # Never turn a description into an empty key
+    return normalized or ' '.join(description.lower().split())
+
+
+def normalization_cache_info():
+    """Hit/miss statistics of the memoized normalizer."""
+    return normalize_description.cache_info()
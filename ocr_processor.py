@@ -1,20 +1,30 @@
+import io
 import os
-import re
 import logging
 import cv2
 import numpy as np
 import pytesseract
 pytesseract.pytesseract.tesseract_cmd = r'/usr/bin/tesseract'
 from PIL import Image
-from pdf2image import convert_from_path
-from datetime import datetime
+from pdf2image import convert_from_path, convert_from_bytes
+from metrics import timed, timed_function, count_event
+# Re-exported for callers that used to get the parsers from here
+from receipt_parser import extract_date, extract_amounts, extract_items  # noqa: F401
 
 
 
 # Set up logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Lines whose mean word confidence is below this are OCR'd again on their own
+OCR_RECHECK_CONFIDENCE = float(os.environ.get("OCR_RECHECK_CONFIDENCE", 70))
+
+# Most lines re-OCR'd per page, weakest first, to bound the extra time
+OCR_RECHECK_MAX_LINES = int(os.environ.get("OCR_RECHECK_MAX_LINES", 15))
+
+# Upscaling applied to a line crop before it is OCR'd again
+OCR_RECHECK_SCALE = 2
+
 # Check if Tesseract is installed and available
 def check_tesseract():
     """Check if Tesseract OCR is properly installed."""
@@ -27,36 +37,163 @@ def check_tesseract():
         logger.error("Please ensure Tesseract OCR is installed on your system.")
         return False
 
+def to_grayscale(img):
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+
 # Image preprocessing to improve OCR results
-def preprocess_image(image_path):
-    """Preprocess image to improve OCR quality."""
-    try:
-        # Read image using OpenCV
-        img = cv2.imread(image_path)
-        if img is None:
-            logger.error(f"Failed to load image: {image_path}")
+@timed_function("preprocess_image")
+def preprocess_array(img):
+    """Binarize an image array (BGR or grayscale) to improve OCR quality."""
+    # Convert to grayscale
+    gray = to_grayscale(img)
+
+    # Apply thresholding to get black and white image
+    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    # Noise removal
+    kernel = np.ones((1, 1), np.uint8)
+    return cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, iterations=1)
+
+@timed_function("perceptual_hash")
+def perceptual_hash(gray):
+    """Return (64-bit pHash, log aspect ratio) of the text on a grayscale receipt, or None if blank.
+
+    The ink is deskewed and cropped to its bounding box first, so two photos
+    of the same receipt at slightly different angles, offsets and zoom get
+    hashes a few bits apart. Text lines are smeared into blocks so the hash
+    describes the layout rather than individual glyphs.
+    """
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    points = cv2.findNonZero(ink)
+    if points is None:
+        return None
+    (center_x, center_y), _, angle = cv2.minAreaRect(points)
+    # minAreaRect reports [-90, 0) or [0, 90) depending on the OpenCV version;
+    # map either to the smallest rotation
+    if angle > 45:
+        angle -= 90
+    elif angle < -45:
+        angle += 90
+    rotation = cv2.getRotationMatrix2D((center_x, center_y), angle, 1.0)
+    ink = cv2.warpAffine(ink, rotation, (ink.shape[1], ink.shape[0]))
+    points = cv2.findNonZero(ink)
+    if points is None:
+        return None
+    x, y, width, height = cv2.boundingRect(points)
+    ink = cv2.dilate(ink[y:y + height, x:x + width], np.ones((3, 15), np.uint8))
+
+    small = cv2.resize(ink.astype(np.float32), (32, 32), interpolation=cv2.INTER_AREA)
+    # Low-frequency DCT coefficients without the DC term, thresholded at their median
+    coefficients = cv2.dct(small)[:8, :8].flatten()[1:]
+    bits = coefficients > np.median(coefficients)
+    image_hash = 0
+    for bit in bits:
+        image_hash = (image_hash << 1) | int(bit)
+    return image_hash, float(np.log(height / width))
+
+def decode_image(data):
+    """Decode image bytes into an array without touching the disk. Returns None if unreadable."""
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        # OpenCV can't decode GIFs, PIL can
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                img = np.asarray(image.convert('L'))
+        except Exception as e:
+            logger.error(f"Failed to decode image: {e}")
             return None
-            
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        # Apply thresholding to get black and white image
-        _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        
-        # Noise removal
-        kernel = np.ones((1, 1), np.uint8)
-        opening = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, iterations=1)
-        
-        # Save preprocessed image
-        preprocessed_path = f"{image_path}_preprocessed.jpg"
-        cv2.imwrite(preprocessed_path, opening)
-        
-        logger.debug(f"Image preprocessed: {preprocessed_path}")
-        return preprocessed_path
-    except Exception as e:
-        logger.error(f"Error preprocessing image: {e}")
-        # Fall back to original image
-        return image_path
+    return img
+
+def _make_line(words, page):
+    words.sort(key=lambda word: word['box'][0])
+    return {
+        'text': ' '.join(word['text'] for word in words),
+        'confidence': sum(word['confidence'] for word in words) / len(words),
+        'box': (min(word['box'][0] for word in words), min(word['box'][1] for word in words),
+                max(word['box'][2] for word in words), max(word['box'][3] for word in words)),
+        'words': words,
+        'page': page,
+    }
+
+def _data_to_lines(data, page, offset=(0, 0), scale=1):
+    """Group image_to_data output into lines of words, mapping boxes back to page pixels."""
+    lines = {}
+    for i, text in enumerate(data['text']):
+        text = text.strip()
+        confidence = float(data['conf'][i])
+        # Tesseract reports -1 for block/paragraph/line rows
+        if not text or confidence < 0:
+            continue
+        left = offset[0] + data['left'][i] / scale
+        top = offset[1] + data['top'][i] / scale
+        box = (int(left), int(top), int(left + data['width'][i] / scale), int(top + data['height'][i] / scale))
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        lines.setdefault(key, []).append({'text': text, 'confidence': confidence, 'box': box})
+    return [_make_line(words, page) for words in lines.values()]
+
+def _recheck_line(gray, line, lang):
+    """OCR one line again from the grayscale page: cropped with a margin, upscaled, as a single line."""
+    left, top, right, bottom = line['box']
+    margin = max(2, (bottom - top) // 2)
+    x, y = max(0, left - margin), max(0, top - margin)
+    crop = gray[y:bottom + margin, x:right + margin]
+    crop = cv2.resize(crop, None, fx=OCR_RECHECK_SCALE, fy=OCR_RECHECK_SCALE, interpolation=cv2.INTER_CUBIC)
+    _, crop = cv2.threshold(crop, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    data = pytesseract.image_to_data(crop, lang=lang, config='--psm 7 --oem 3',
+                                     output_type=pytesseract.Output.DICT)
+    words = [word for found in _data_to_lines(data, line['page'], (x, y), OCR_RECHECK_SCALE)
+             for word in found['words']]
+    return _make_line(words, line['page']) if words else None
+
+def ocr_layout(pages, lang='eng', recheck=True):
+    """OCR page arrays into lines with word boxes and confidences.
+
+    Returns [{'text', 'confidence', 'box', 'words', 'page'}] in reading order;
+    each word is {'text', 'confidence', 'box'} with box = (left, top, right,
+    bottom) in page pixels. With recheck, lines below OCR_RECHECK_CONFIDENCE
+    are OCR'd again on their own and replaced if that reads them with more
+    confidence, instead of OCR'ing the whole page again.
+    """
+    lines = []
+    for page, img in enumerate(pages):
+        preprocessed = preprocess_array(img)
+        with timed("image_to_data"):
+            data = pytesseract.image_to_data(
+                preprocessed,
+                lang=lang,
+                config='--psm 6 --oem 3',  # Page segmentation mode: assume a single uniform block of text
+                output_type=pytesseract.Output.DICT
+            )
+        page_lines = _data_to_lines(data, page)
+
+        weak = sorted((line for line in page_lines if line['confidence'] < OCR_RECHECK_CONFIDENCE),
+                      key=lambda line: line['confidence'])[:OCR_RECHECK_MAX_LINES] if recheck else []
+        if weak:
+            gray = to_grayscale(img)
+            with timed("ocr_recheck"):
+                for line in weak:
+                    better = _recheck_line(gray, line, lang)
+                    if better and better['confidence'] > line['confidence']:
+                        line.update(better)
+                        count_event("ocr_line_improved")
+            count_event("ocr_line_rechecked", len(weak))
+        lines.extend(page_lines)
+    return lines
+
+def layout_text(lines, page_markers=False):
+    """Join OCR lines back into text, optionally with a marker before each page."""
+    parts = []
+    page = None
+    for line in lines:
+        if page_markers and line['page'] != page:
+            page = line['page']
+            parts.append(f"\n--- PAGE {page+1} ---\n")
+        parts.append(line['text'])
+    return "\n".join(parts) + "\n" if parts else ""
+
+def ocr_array(img, lang='eng'):
+    """Preprocess an image array and OCR it."""
+    return layout_text(ocr_layout([img], lang))
 
 def extract_text_from_image(image_path, lang='eng'):
     """Extract text from an image using pytesseract OCR with improved settings."""
@@ -65,26 +202,15 @@ def extract_text_from_image(image_path, lang='eng'):
     
     try:
         logger.debug(f"Processing image: {image_path}")
-        
-        # Preprocess image for better OCR results
-        preprocessed_image = preprocess_image(image_path)
-        if preprocessed_image is None:
+        img = cv2.imread(image_path)
+        if img is None:
+            with open(image_path, 'rb') as f:
+                img = decode_image(f.read())
+        if img is None:
+            logger.error(f"Failed to load image: {image_path}")
             return ""
-            
-        # Use PIL to open the preprocessed image
-        image = Image.open(preprocessed_image if preprocessed_image else image_path)
-        
-        # Apply OCR with advanced configurations
-        text = pytesseract.image_to_string(
-            image,
-            lang=lang,
-            config='--psm 6 --oem 3'  # Page segmentation mode: assume a single uniform block of text
-        )
-        
-        # Clean up any temporary files
-        if preprocessed_image and preprocessed_image != image_path and os.path.exists(preprocessed_image):
-            os.remove(preprocessed_image)
-        
+
+        text = ocr_array(img, lang)
         logger.debug(f"Extracted text length: {len(text)}")
         if not text.strip():
             logger.warning(f"No text extracted from image: {image_path}")
@@ -104,7 +230,8 @@ def extract_text_from_pdf(pdf_path, lang='eng'):
         
         # Convert PDF to images
         try:
-            images = convert_from_path(pdf_path)
+            with timed("convert_from_path"):
+                images = convert_from_path(pdf_path)
             logger.info(f"Converted PDF to {len(images)} images")
         except Exception as pdf_err:
             logger.error(f"Error converting PDF to images: {pdf_err}", exc_info=True)
@@ -113,25 +240,7 @@ def extract_text_from_pdf(pdf_path, lang='eng'):
         if not images:
             return "ERROR: No images extracted from PDF"
         
-        extracted_text = ""
-        
-        # Process each page
-        for i, image in enumerate(images):
-            # Save as temporary image
-            temp_image_path = f"temp_page_{i}.jpg"
-            image.save(temp_image_path, 'JPEG')
-            logger.debug(f"Saved temporary image: {temp_image_path}")
-            
-            # Extract text from the image
-            page_text = extract_text_from_image(temp_image_path, lang=lang)
-            extracted_text += f"\n\n--- PAGE {i+1} ---\n\n{page_text}"
-            
-            # Clean up temp file
-            try:
-                os.remove(temp_image_path)
-            except Exception as rm_err:
-                logger.warning(f"Could not remove temp file: {rm_err}")
-        
+        extracted_text = ocr_pages([np.asarray(image.convert('L')) for image in images], lang)
         if not extracted_text.strip():
             logger.warning(f"No text extracted from PDF: {pdf_path}")
             
@@ -140,122 +249,32 @@ def extract_text_from_pdf(pdf_path, lang='eng'):
         logger.error(f"Error extracting text from PDF: {e}", exc_info=True)
         return f"ERROR: {str(e)}"
 
-def extract_date(text):
-    """Extract a date from the text of a receipt or statement."""
-    # Try different date formats
-    date_patterns = [
-        r'(\d{1,2}/\d{1,2}/\d{2,4})',  # MM/DD/YYYY or DD/MM/YYYY
-        r'(\d{1,2}-\d{1,2}-\d{2,4})',  # MM-DD-YYYY or DD-MM-YYYY
-        r'(\d{2,4}\.\d{1,2}\.\d{1,2})',  # YYYY.MM.DD
-        r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]* (\d{1,2}),? \d{2,4}',  # Month DD, YYYY
-        r'\d{1,2} (?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]* \d{2,4}'  # DD Month YYYY
-    ]
-    
-    logger.debug("Searching for date in extracted text")
-    
-    for pattern in date_patterns:
-        matches = re.findall(pattern, text, re.IGNORECASE)
-        if matches:
-            # Try to parse the date
-            try:
-                for match in matches:
-                    # Try different date formats
-                    for fmt in ['%m/%d/%Y', '%m/%d/%y', '%d/%m/%Y', '%d/%m/%y', 
-                               '%m-%d-%Y', '%m-%d-%y', '%d-%m-%Y', '%d-%m-%y',
-                               '%Y.%m.%d', '%d.%m.%Y', '%B %d, %Y', '%b %d, %Y',
-                               '%d %B %Y', '%d %b %Y']:
-                        try:
-                            date = datetime.strptime(match, fmt)
-                            logger.info(f"Found date: {date.strftime('%Y-%m-%d')}")
-                            return date.strftime('%Y-%m-%d')
-                        except ValueError:
-                            continue
-            except Exception as e:
-                logger.debug(f"Error parsing date: {e}")
-                continue
-    
-    # If no date found, return today's date
-    today = datetime.now().strftime('%Y-%m-%d')
-    logger.info(f"No date found, using today's date: {today}")
-    return today
+def load_pages(data, kind):
+    """Decode an uploaded PDF or image held in memory into a list of page arrays.
 
-def extract_amounts(text):
-    """Extract monetary amounts from text."""
-    # Look for patterns like $XX.XX or XX.XX
-    amount_patterns = [
-        r'\$\s*(\d+(?:,\d{3})*\.\d{2})',  # $XX.XX with possible commas
-        r'(\d+(?:,\d{3})*\.\d{2})',  # XX.XX with possible commas
-        r'(\d+)\s*\.\s*(\d{2})'  # XX . XX (with possible spaces)
-    ]
-    
-    logger.debug("Searching for amounts in extracted text")
-    
-    amounts = []
-    for pattern in amount_patterns:
-        matches = re.findall(pattern, text)
-        for match in matches:
-            try:
-                if isinstance(match, tuple):
-                    # Handle the case where regex captures groups
-                    amount = float(f"{match[0]}.{match[1]}")
-                else:
-                    # Clean up any commas
-                    amount_str = match.replace(',', '')
-                    amount = float(amount_str)
-                amounts.append(amount)
-                logger.debug(f"Found amount: {amount}")
-            except ValueError:
-                continue
-    
-    if not amounts:
-        logger.warning("No amounts found in text")
-    else:
-        logger.info(f"Found {len(amounts)} amounts")
-        
-    return amounts
+    kind is the sniffed file type ('pdf' or an image type). Raises ValueError
+    if the file can't be decoded.
+    """
+    if kind == 'pdf':
+        try:
+            with timed("convert_from_path"):
+                images = convert_from_bytes(data)
+        except Exception as pdf_err:
+            logger.error(f"Error converting PDF to images: {pdf_err}", exc_info=True)
+            raise ValueError(f"Failed to convert PDF to images: {str(pdf_err)}")
+        if not images:
+            raise ValueError("No images extracted from PDF")
+        logger.info(f"Converted PDF to {len(images)} images")
+        return [np.asarray(image.convert('L')) for image in images]
 
-def extract_items(text):
-    """Extract item descriptions and prices from receipt text."""
-    items = []
-    
-    # Split text into lines
-    lines = text.split('\n')
-    
-    logger.debug(f"Extracting items from {len(lines)} lines of text")
-    
-    # Process each line
-    for line in lines:
-        # Skip empty lines
-        if not line.strip():
-            continue
-        
-        # Look for price patterns
-        amount_match = re.search(r'(\d+\.\d{2})', line)
-        if amount_match:
-            try:
-                amount = float(amount_match.group(1))
-                # Extract the description (everything before the price)
-                description = line[:amount_match.start()].strip()
-                
-                # Clean up the description
-                description = re.sub(r'\s+', ' ', description)
-                
-                # Only add if we have both description and amount
-                if description and amount > 0:
-                    items.append({
-                        'description': description,
-                        'amount': amount
-                    })
-                    logger.debug(f"Found item: {description} - ${amount}")
-            except ValueError:
-                continue
-    
-    if not items:
-        logger.warning("No items extracted from text")
-    else:
-        logger.info(f"Found {len(items)} items")
-        
-    return items
+    img = decode_image(data)
+    if img is None:
+        raise ValueError("The image could not be read.")
+    return [img]
+
+def ocr_pages(pages, lang='eng'):
+    """OCR PDF page arrays in memory and join them with page markers."""
+    return layout_text(ocr_layout(pages, lang), page_markers=True)
 
 def process_uploaded_file(file_path):
     """Process an uploaded file (PDF or image) and extract text."""
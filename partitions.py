@@ -0,0 +1,224 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Monthly expense partitions are created this many months past the current one
+PARTITION_MONTHS_AHEAD = int(os.environ.get("EXPENSE_PARTITION_MONTHS_AHEAD", 3))
+
+# How often a running app checks that the coming months have partitions
+PARTITION_CHECK_INTERVAL = int(os.environ.get("EXPENSE_PARTITION_CHECK_INTERVAL", 6 * 3600))
+
+# Partition DDL waits at most this long for locks held by running queries, then retries later
+PARTITION_LOCK_TIMEOUT = '5s'
+
+DEFAULT_PARTITION = 'expense_default'
+
+
+def partition_name(month):
+    return f"expense_p{month:%Y%m}"
+
+
+def _next_month(month):
+    return month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+
+
+def _month_start(date):
+    return datetime(date.year, date.month, 1)
+
+
+def is_partitioned(engine):
+    """Whether expense is a partitioned Postgres table."""
+    if engine.dialect.name != 'postgresql':
+        return False
+    with engine.connect() as connection:
+        return connection.execute(text(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('expense')")).first() is not None
+
+
+def _partitions(connection):
+    return {name for name, in connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'expense'::regclass"))}
+
+
+def _column_list(connection):
+    """The stored columns of expense, quoted; generated columns can't be inserted into."""
+    preparer = connection.dialect.identifier_preparer
+    return ', '.join(preparer.quote(name) for name, in connection.execute(text(
+        "SELECT attname FROM pg_attribute WHERE attrelid = 'expense'::regclass AND attnum > 0 "
+        "AND NOT attisdropped AND attgenerated = '' ORDER BY attnum")))
+
+
+def _create_partition(connection, month, existing):
+    """Create the partition of one month, moving its rows out of the default partition if any landed there."""
+    name = partition_name(month)
+    bounds = f"FROM ('{month:%Y-%m-%d}') TO ('{_next_month(month):%Y-%m-%d}')"
+    in_month = f"date >= '{month:%Y-%m-%d}' AND date < '{_next_month(month):%Y-%m-%d}'"
+    if DEFAULT_PARTITION in existing and connection.execute(text(
+            f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_month} LIMIT 1")).first():
+        # Postgres won't create a partition for rows the default partition holds
+        columns = _column_list(connection)
+        connection.execute(text(f"ALTER TABLE expense DETACH PARTITION {DEFAULT_PARTITION}"))
+        connection.execute(text(f"CREATE TABLE {name} PARTITION OF expense FOR VALUES {bounds}"))
+        connection.execute(text(
+            f"INSERT INTO expense ({columns}) SELECT {columns} FROM {DEFAULT_PARTITION} WHERE {in_month}"))
+        connection.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_month}"))
+        connection.execute(text(f"ALTER TABLE expense ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    else:
+        connection.execute(text(f"CREATE TABLE {name} PARTITION OF expense FOR VALUES {bounds}"))
+    existing.add(name)
+
+
+def ensure_partitions(engine, months=(), today=None):
+    """Create the monthly partitions of expense that are missing. Returns the names created.
+
+    Covers the current month and the PARTITION_MONTHS_AHEAD after it, plus
+    any months given. Does nothing unless expense is a partitioned Postgres
+    table. Each partition is created in its own short transaction, which
+    gives up after PARTITION_LOCK_TIMEOUT rather than queueing writers
+    behind it.
+    """
+    if not is_partitioned(engine):
+        return []
+    month = _month_start(today or datetime.now())
+    wanted = {_month_start(value) for value in months}
+    for _ in range(PARTITION_MONTHS_AHEAD + 1):
+        wanted.add(month)
+        month = _next_month(month)
+
+    with engine.connect() as connection:
+        existing = _partitions(connection)
+    created = []
+    for month in sorted(wanted):
+        if partition_name(month) in existing:
+            continue
+        with engine.begin() as connection:
+            connection.execute(text(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'"))
+            _create_partition(connection, month, existing)
+        created.append(partition_name(month))
+    if created:
+        logger.info(f"Created expense partitions {', '.join(created)}")
+    return created
+
+
+def partition_expense_table(engine):
+    """Turn expense into a table partitioned by month of date, keeping its rows, indexes and keys.
+
+    Postgres only (12 or later); SQLite databases are left as they are.
+    Partitioned tables need the partition key in their primary key, so the
+    key becomes (id, date) and date NOT NULL, and rows without a date get
+    their created_at. The table is locked for the copy, so run this once,
+    from `flask partition-expenses`, while the app is stopped. Returns
+    False when there was nothing to do.
+    """
+    if engine.dialect.name != 'postgresql' or is_partitioned(engine):
+        return False
+    with engine.begin() as connection:
+        connection.execute(text("LOCK TABLE expense IN ACCESS EXCLUSIVE MODE"))
+        sequence = connection.execute(text("SELECT pg_get_serial_sequence('expense', 'id')")).scalar()
+        primary_key = connection.execute(text(
+            "SELECT conname FROM pg_constraint WHERE conrelid = 'expense'::regclass AND contype = 'p'")).scalar()
+        indexes = [definition for definition, in connection.execute(text(
+            "SELECT pg_get_indexdef(indexrelid) FROM pg_index "
+            "WHERE indrelid = 'expense'::regclass AND NOT indisprimary"))]
+        foreign_keys = connection.execute(text(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = 'expense'::regclass AND contype = 'f'")).all()
+        connection.execute(text("UPDATE expense SET date = coalesce(created_at, now()) WHERE date IS NULL"))
+        columns = _column_list(connection)
+
+        connection.execute(text("ALTER TABLE expense RENAME TO expense_unpartitioned"))
+        if primary_key:
+            # Frees the index name for the new table's key
+            connection.execute(text(f"ALTER TABLE expense_unpartitioned RENAME CONSTRAINT {primary_key} "
+                                    f"TO expense_unpartitioned_pkey"))
+        connection.execute(text(
+            "CREATE TABLE expense (LIKE expense_unpartitioned INCLUDING DEFAULTS INCLUDING GENERATED "
+            "INCLUDING CONSTRAINTS) PARTITION BY RANGE (date)"))
+        connection.execute(text("ALTER TABLE expense ADD PRIMARY KEY (id, date)"))
+        months = [month for month, in connection.execute(text(
+            "SELECT DISTINCT date_trunc('month', date) FROM expense_unpartitioned"))]
+        existing = set()
+        for month in sorted(months):
+            _create_partition(connection, month, existing)
+        connection.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF expense DEFAULT"))
+
+        connection.execute(text(f"INSERT INTO expense ({columns}) SELECT {columns} FROM expense_unpartitioned"))
+        if sequence:
+            # The sequence belongs to the old table's id and would be dropped with it
+            connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+        connection.execute(text("DROP TABLE expense_unpartitioned"))
+        if sequence:
+            connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY expense.id"))
+        # Created on the parent, indexes and keys apply to every partition, present and future
+        for name, definition in foreign_keys:
+            connection.execute(text(f"ALTER TABLE expense ADD CONSTRAINT {name} {definition}"))
+        for definition in indexes:
+            connection.execute(text(definition))
+    with engine.connect() as connection:
+        connection.execute(text("ANALYZE expense"))
+        connection.commit()
+    logger.info(f"Partitioned expense by month into {len(months)} partitions")
+    ensure_partitions(engine)
+    return True
+
+
+def scanned_partitions(query):
+    """The partitions of expense that Postgres plans to read for a query, from EXPLAIN.
+
+    Partitions pruned while planning are left out of the plan; ones only
+    pruned at run time show up here but are skipped when it executes.
+    """
+    from models import db
+
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    plan = db.session.connection().exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()
+    names = set()
+
+    def walk(node):
+        relation = node.get('Relation Name')
+        if relation and (relation.startswith('expense_p') or relation == DEFAULT_PARTITION):
+            names.add(relation)
+        for child in node.get('Plans', []):
+            walk(child)
+
+    walk(plan[0]['Plan'])
+    return sorted(names)
+
+
+_maintenance_lock = threading.Lock()
+_maintenance = {'next_check': 0.0, 'running': False}
+
+
+def _maintain(app):
+    from models import db
+
+    try:
+        with app.app_context():
+            ensure_partitions(db.engine)
+    except Exception as e:
+        logger.warning(f"Could not create expense partitions, will retry: {e}")
+    finally:
+        _maintenance['running'] = False
+
+
+def maintain_partitions_in_background(app):
+    """Check for missing partitions in a thread, at most every PARTITION_CHECK_INTERVAL seconds.
+
+    Called on each request; cheap when it isn't time yet. Rows dated beyond
+    the created partitions land in the default partition until then.
+    """
+    now = time.monotonic()
+    if now < _maintenance['next_check'] or _maintenance['running']:
+        return
+    with _maintenance_lock:
+        if now < _maintenance['next_check'] or _maintenance['running']:
+            return
+        _maintenance['next_check'] = now + PARTITION_CHECK_INTERVAL
+        _maintenance['running'] = True
+    threading.Thread(target=_maintain, args=(app,), daemon=True).start()
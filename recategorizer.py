@@ -0,0 +1,89 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from metrics import timed, count_event
+
+logger = logging.getLogger(__name__)
+
+# Rows changed per transaction, so a large history never holds the write lock for long
+RECATEGORIZE_CHUNK_SIZE = int(os.environ.get("RECATEGORIZE_CHUNK_SIZE", 2000))
+
+# One worker: corrections are applied in the order they were made
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recategorize")
+
+
+def recategorize_history(user_id, corrections, chunk_size=RECATEGORIZE_CHUNK_SIZE):
+    """Move a user's past expenses to their corrected categories. Needs an app context.
+
+    corrections maps normalized descriptions to category ids. Matching rows
+    not yet in that category are found through ix_expense_user_normalized_id
+    and updated chunk_size at a time, each chunk in its own short transaction
+    together with the budget counters it affects. Returns the number of rows changed.
+    """
+    from models import db, Expense
+    from budgets import record_recategorization
+
+    changed = 0
+    for normalized, category_id in corrections.items():
+        last_id = 0
+        while True:
+            rows = db.session.query(Expense.id, Expense.category_id).filter(
+                Expense.user_id == user_id, Expense.normalized_description == normalized,
+                Expense.id > last_id, Expense.category_id != category_id).order_by(Expense.id).limit(chunk_size).all()
+            if not rows:
+                break
+            ids = [row.id for row in rows]
+            moves = []
+            with timed("recategorize_chunk"):
+                # One update per previous category, re-checked in case a row was edited since it was
+                # read; the rows each one returns are exactly what the budget counters move
+                for old_category_id in {row.category_id for row in rows}:
+                    moved = db.session.execute(
+                        db.update(Expense).where(Expense.id.in_(ids), Expense.category_id == old_category_id)
+                        .values(category_id=category_id).returning(Expense.date, Expense.amount)
+                        .execution_options(synchronize_session=False)).all()
+                    moves += [(old_category_id, category_id, date, amount) for date, amount in moved]
+                record_recategorization(user_id, moves)
+                db.session.commit()
+            changed += len(moves)
+            last_id = rows[-1].id
+            if len(rows) < chunk_size:
+                break
+    count_event("recategorized_expenses", changed)
+    return changed
+
+
+def schedule_recategorization(app, user_id, corrections):
+    """Run recategorize_history in the background worker. Returns its Future."""
+    def run():
+        start = time.perf_counter()
+        with app.app_context():
+            try:
+                changed = recategorize_history(user_id, corrections)
+            except Exception:
+                logger.exception(f"Recategorizing the history of user {user_id} failed")
+                return 0
+        logger.info(f"Recategorized {changed} past expenses of user {user_id} for {len(corrections)} "
+                    f"corrections in {time.perf_counter() - start:.2f}s")
+        return changed
+
+    return _executor.submit(run)
+
+
+def backfill_normalized_descriptions(chunk_size=RECATEGORIZE_CHUNK_SIZE):
+    """Fill Expense.normalized_description for rows saved before the column existed. Needs an app context."""
+    from models import db, Expense
+    from normalizer import normalize_description
+
+    filled = 0
+    while True:
+        rows = db.session.query(Expense.id, Expense.description).filter(
+            Expense.normalized_description.is_(None)).order_by(Expense.id).limit(chunk_size).all()
+        if not rows:
+            return filled
+        db.session.execute(db.update(Expense), [
+            {'id': expense_id, 'normalized_description': normalize_description(description)}
+            for expense_id, description in rows])
+        db.session.commit()
+        filled += len(rows)
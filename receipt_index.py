@@ -0,0 +1,143 @@
+import os
+import logging
+import threading
+from datetime import datetime
+from functools import lru_cache
+from itertools import combinations
+from metrics import timed
+from keyword_matcher import SizedLRUCache
+
+logger = logging.getLogger(__name__)
+
+# Largest Hamming distance between the hashes of two photos of the same receipt
+DUPLICATE_HASH_DISTANCE = int(os.environ.get("DUPLICATE_HASH_DISTANCE", 8))
+
+# Largest difference in log aspect ratio of the text region between two such photos
+DUPLICATE_ASPECT_TOLERANCE = 0.1
+
+# Memory budget for the per-user indexes, at roughly ENTRY_BYTES per stored hash
+RECEIPT_INDEX_CACHE_BYTES = 32 * 1024 * 1024
+ENTRY_BYTES = 300
+
+HASH_BITS = 64
+BLOCKS = 4
+BLOCK_BITS = HASH_BITS // BLOCKS
+BLOCK_MASK = (1 << BLOCK_BITS) - 1
+
+
+@lru_cache(maxsize=None)
+def _flip_masks(radius):
+    """All BLOCK_BITS-bit masks with at most radius bits set."""
+    return tuple(sum(1 << bit for bit in bits)
+                 for count in range(radius + 1) for bits in combinations(range(BLOCK_BITS), count))
+
+
+class MultiIndexHash:
+    """Hamming-radius search over 64-bit hashes by multi-index hashing.
+
+    Each hash is split into BLOCKS 16-bit blocks with a table per block. Two
+    hashes within distance d differ in at most d // BLOCKS bits in at least
+    one block (pigeonhole), so a search only probes each table with the block
+    values within that radius and checks the few candidates exactly. A
+    BK-tree degrades to visiting most of its nodes at these radii on 64-bit
+    hashes, slower than a plain scan.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.tables = [{} for _ in range(BLOCKS)]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, value_hash, value):
+        position = len(self.entries)
+        self.entries.append((value_hash, value))
+        for block, table in enumerate(self.tables):
+            table.setdefault((value_hash >> (block * BLOCK_BITS)) & BLOCK_MASK, []).append(position)
+
+    def search(self, query_hash, max_distance):
+        """Return (distance, value) for every stored hash within max_distance, nearest first."""
+        masks = _flip_masks(max_distance // BLOCKS)
+        candidates = set()
+        for block, table in enumerate(self.tables):
+            key = (query_hash >> (block * BLOCK_BITS)) & BLOCK_MASK
+            for mask in masks:
+                positions = table.get(key ^ mask)
+                if positions:
+                    candidates.update(positions)
+        results = []
+        for position in candidates:
+            value_hash, value = self.entries[position]
+            distance = (value_hash ^ query_hash).bit_count()
+            if distance <= max_distance:
+                results.append((distance, value))
+        results.sort(key=lambda result: result[0])
+        return results
+
+
+class ReceiptIndex:
+    """A user's receipt hashes, kept current by reading the rows added since the last refresh."""
+
+    def __init__(self):
+        self.hashes = MultiIndexHash()
+        self.ids = set()
+        self.last_id = 0
+        self.read_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self, user_id):
+        """Add the user's hashes stored since the last refresh. Returns how many were added."""
+        from models import db, ReceiptImageHash, catch_up_floor
+        with self._lock:
+            read_at = datetime.utcnow()
+            # Rows that committed out of id order since the last refresh are read again
+            floor = catch_up_floor(ReceiptImageHash, user_id, self.last_id, self.read_at) if self.read_at else 0
+            rows = db.session.query(ReceiptImageHash.id, ReceiptImageHash.image_hash, ReceiptImageHash.aspect,
+                                    ReceiptImageHash.created_at).filter(
+                ReceiptImageHash.user_id == user_id, ReceiptImageHash.id > floor).order_by(ReceiptImageHash.id)
+            added = 0
+            for row_id, image_hash, aspect, created_at in rows:
+                self.last_id = max(self.last_id, row_id)
+                if row_id in self.ids:
+                    continue
+                self.ids.add(row_id)
+                self.hashes.add(int(image_hash, 16), (row_id, aspect, created_at))
+                added += 1
+            self.read_at = read_at
+            return added
+
+
+_indexes = SizedLRUCache(RECEIPT_INDEX_CACHE_BYTES)
+
+
+def get_receipt_index(user_id):
+    """Return the user's receipt index, loading it on first use and catching up on new rows."""
+    index = _indexes.get(user_id)
+    is_new = index is None
+    if is_new:
+        index = ReceiptIndex()
+    if index.refresh(user_id) or is_new:
+        # Re-put to update the accounted size
+        _indexes.put(user_id, index, max(1, len(index.hashes)) * ENTRY_BYTES)
+    return index
+
+
+def find_near_duplicates(user_id, receipt_hash, max_distance=DUPLICATE_HASH_DISTANCE):
+    """Return [(distance, hash row id, created_at)] of the user's receipts that look like receipt_hash.
+
+    receipt_hash is the (hash, aspect) pair from ocr_processor.perceptual_hash.
+    """
+    image_hash, aspect = receipt_hash
+    with timed("duplicate_lookup"):
+        index = get_receipt_index(user_id)
+        return [(distance, row_id, created_at)
+                for distance, (row_id, stored_aspect, created_at) in index.hashes.search(image_hash, max_distance)
+                if abs(stored_aspect - aspect) <= DUPLICATE_ASPECT_TOLERANCE]
+
+
+def record_receipt_hash(user_id, receipt_hash, sha256=None):
+    """Add a processed receipt's hash to the session; it is indexed once committed."""
+    from models import db, ReceiptImageHash
+    image_hash, aspect = receipt_hash
+    db.session.add(ReceiptImageHash(user_id=user_id, image_hash=f"{image_hash:016x}", aspect=aspect, sha256=sha256))
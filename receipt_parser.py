@@ -0,0 +1,225 @@
+import re
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+
+# Text parsing for OCR output. Kept free of the OCR libraries so that
+# categorization can run in processes that never load cv2 or Tesseract.
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class ExpenseItem:
+    """One item of a receipt, from extraction through categorization to saving.
+
+    Slots instead of a dict per item: a large statement has thousands. Items
+    of one document share a single date string. Convert with to_dict() only
+    where JSON is needed (the session, API responses).
+    """
+    description: str
+    amount: float
+    category_id: int | None = None
+    category: str | None = None
+    date: str | None = None
+
+    def to_dict(self):
+        return {'description': self.description, 'amount': self.amount, 'category_id': self.category_id,
+                'category': self.category, 'date': self.date}
+
+
+def parse_item_dates(items):
+    """Return {date string: datetime} for the dates of items, parsing each distinct date once."""
+    return {date: datetime.strptime(date, '%Y-%m-%d') for date in {item.date for item in items} if date}
+
+
+def extract_date(text):
+    """Extract a date from the text of a receipt or statement."""
+    # Try different date formats
+    date_patterns = [
+        r'(\d{1,2}/\d{1,2}/\d{2,4})',  # MM/DD/YYYY or DD/MM/YYYY
+        r'(\d{1,2}-\d{1,2}-\d{2,4})',  # MM-DD-YYYY or DD-MM-YYYY
+        r'(\d{2,4}\.\d{1,2}\.\d{1,2})',  # YYYY.MM.DD
+        r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]* (\d{1,2}),? \d{2,4}',  # Month DD, YYYY
+        r'\d{1,2} (?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]* \d{2,4}'  # DD Month YYYY
+    ]
+    
+    logger.debug("Searching for date in extracted text")
+    
+    for pattern in date_patterns:
+        matches = re.findall(pattern, text, re.IGNORECASE)
+        if matches:
+            # Try to parse the date
+            try:
+                for match in matches:
+                    # Try different date formats
+                    for fmt in ['%m/%d/%Y', '%m/%d/%y', '%d/%m/%Y', '%d/%m/%y', 
+                               '%m-%d-%Y', '%m-%d-%y', '%d-%m-%Y', '%d-%m-%y',
+                               '%Y.%m.%d', '%d.%m.%Y', '%B %d, %Y', '%b %d, %Y',
+                               '%d %B %Y', '%d %b %Y']:
+                        try:
+                            date = datetime.strptime(match, fmt)
+                            logger.info(f"Found date: {date.strftime('%Y-%m-%d')}")
+                            return date.strftime('%Y-%m-%d')
+                        except ValueError:
+                            continue
+            except Exception as e:
+                logger.debug(f"Error parsing date: {e}")
+                continue
+    
+    # If no date found, return today's date
+    today = datetime.now().strftime('%Y-%m-%d')
+    logger.info(f"No date found, using today's date: {today}")
+    return today
+
+def extract_amounts(text):
+    """Extract monetary amounts from text."""
+    # Look for patterns like $XX.XX or XX.XX
+    amount_patterns = [
+        r'\$\s*(\d+(?:,\d{3})*\.\d{2})',  # $XX.XX with possible commas
+        r'(\d+(?:,\d{3})*\.\d{2})',  # XX.XX with possible commas
+        r'(\d+)\s*\.\s*(\d{2})'  # XX . XX (with possible spaces)
+    ]
+    
+    logger.debug("Searching for amounts in extracted text")
+    
+    amounts = []
+    for pattern in amount_patterns:
+        matches = re.findall(pattern, text)
+        for match in matches:
+            try:
+                if isinstance(match, tuple):
+                    # Handle the case where regex captures groups
+                    amount = float(f"{match[0]}.{match[1]}")
+                else:
+                    # Clean up any commas
+                    amount_str = match.replace(',', '')
+                    amount = float(amount_str)
+                amounts.append(amount)
+                logger.debug("Found amount: %s", amount)
+            except ValueError:
+                continue
+    
+    if not amounts:
+        logger.warning("No amounts found in text")
+    else:
+        logger.info(f"Found {len(amounts)} amounts")
+        
+    return amounts
+
+_PRICE_WORD = re.compile(r'^\$?(\d+(?:,\d{3})*\.\d{2})$')
+
+def find_price_column(lines):
+    """Locate the price column among one page's OCR lines.
+
+    Prices on a receipt are right-aligned, so the right edges of the last
+    price on each line pile up at the column. Returns (right edge x,
+    tolerance) for the densest pile, or None if no line has a price.
+    """
+    edges = []
+    char_widths = []
+    for line in lines:
+        for word in reversed(line['words']):
+            if _PRICE_WORD.match(word['text']):
+                left, _, right, _ = word['box']
+                edges.append(right)
+                char_widths.append((right - left) / len(word['text']))
+                break
+    if not edges:
+        return None
+
+    # Allow the column to wander by about two characters
+    char_widths.sort()
+    tolerance = 2 * char_widths[len(char_widths) // 2]
+    edges.sort()
+    best_start, best_count = 0, 0
+    start = 0
+    for end, edge in enumerate(edges):
+        while edge - edges[start] > tolerance:
+            start += 1
+        if end - start + 1 > best_count:
+            best_start, best_count = start, end - start + 1
+    return edges[best_start + best_count // 2], tolerance
+
+def extract_items_from_layout(lines):
+    """Extract items from OCR lines, taking each line's price from the price column.
+
+    Unlike the text parser this ignores unit prices and quantities before
+    the column ("2 @ 1.99   3.98" is 3.98) and lines with no price in it.
+    """
+    pages = {}
+    for line in lines:
+        pages.setdefault(line['page'], []).append(line)
+
+    items = []
+    for page_lines in pages.values():
+        column = find_price_column(page_lines)
+        if column is None:
+            continue
+        column_x, tolerance = column
+        for line in page_lines:
+            words = line['words']
+            for position in range(len(words) - 1, 0, -1):
+                match = _PRICE_WORD.match(words[position]['text'])
+                if match and abs(words[position]['box'][2] - column_x) <= tolerance:
+                    break
+            else:
+                continue
+            amount = float(match.group(1).replace(',', ''))
+            description = ' '.join(word['text'] for word in words[:position])
+            if description and amount > 0:
+                items.append(ExpenseItem(description, amount))
+                logger.debug("Found item: %s - $%s", description, amount)
+
+    logger.info(f"Found {len(items)} items in the price column")
+    return items
+
+def extract_items(text, lines=None):
+    """Extract item descriptions and prices from receipt text as a list of ExpenseItem.
+
+    If OCR lines with word boxes are given, prices are found geometrically
+    with extract_items_from_layout, falling back to the text if that finds
+    nothing.
+    """
+    if lines:
+        items = extract_items_from_layout(lines)
+        if items:
+            return items
+
+    items = []
+    
+    # Split text into lines
+    lines = text.split('\n')
+    
+    logger.debug(f"Extracting items from {len(lines)} lines of text")
+    
+    # Process each line
+    for line in lines:
+        # Skip empty lines
+        if not line.strip():
+            continue
+        
+        # Look for price patterns
+        amount_match = re.search(r'(\d+\.\d{2})', line)
+        if amount_match:
+            try:
+                amount = float(amount_match.group(1))
+                # Extract the description (everything before the price)
+                description = line[:amount_match.start()].strip()
+                
+                # Clean up the description
+                description = re.sub(r'\s+', ' ', description)
+                
+                # Only add if we have both description and amount
+                if description and amount > 0:
+                    items.append(ExpenseItem(description, amount))
+                    logger.debug("Found item: %s - $%s", description, amount)
+            except ValueError:
+                continue
+    
+    if not items:
+        logger.warning("No items extracted from text")
+    else:
+        logger.info(f"Found {len(items)} items")
+        
+    return items
@@ -0,0 +1,292 @@
+import os
+import logging
+import threading
+from datetime import date, datetime
+import numpy as np
+from metrics import timed
+from keyword_matcher import SizedLRUCache
+from archive import archive_files, archived_daily_charges
+
+logger = logging.getLogger(__name__)
+
+# Fewest charges before a description can be reported as recurring
+RECURRING_MIN_OCCURRENCES = int(os.environ.get("RECURRING_MIN_OCCURRENCES", 3))
+
+# Share of the gaps between charges that must match the period
+RECURRING_REGULARITY = 0.75
+
+# Largest typical change in amount between consecutive charges, as a fraction
+RECURRING_AMOUNT_DRIFT = 0.2
+
+# (name, days, tolerance in days); monthly allows for 28-31 day months and weekend shifts
+PERIODS = [
+    ('weekly', 7, 1),
+    ('biweekly', 14, 2),
+    ('monthly', 30.44, 4),
+    ('quarterly', 91.31, 10),
+    ('annual', 365.25, 15),
+]
+_PERIOD_DAYS = np.array([days for _, days, _ in PERIODS])
+_PERIOD_TOLERANCE = np.array([tolerance for _, _, tolerance in PERIODS])
+
+# Memory budget for the per-user indexes: ROW_BYTES per expense plus GROUP_BYTES per description
+RECURRING_INDEX_CACHE_BYTES = 128 * 1024 * 1024
+ROW_BYTES = 16
+GROUP_BYTES = 400
+
+# Rows fetched from the cursor at a time while loading a history
+LOAD_BATCH_SIZE = 10000
+
+
+def _grouped_median(groups, values, n_groups):
+    """Median of values per group index (NaN for empty groups), without a Python loop."""
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    medians = np.full(n_groups, np.nan)
+    present = counts > 0
+    low = starts[present] + (counts[present] - 1) // 2
+    high = starts[present] + counts[present] // 2
+    medians[present] = (sorted_values[low] + sorted_values[high]) / 2
+    return medians
+
+
+def detect_patterns(codes, days, amounts, min_occurrences=RECURRING_MIN_OCCURRENCES):
+    """Find periodic charges in expense rows grouped by description code.
+
+    codes, days (date ordinals) and amounts are parallel arrays in any order.
+    Several charges of a group on one day count once, as the largest. A group is recurring
+    when its median gap falls within one of PERIODS, RECURRING_REGULARITY of
+    its gaps match that period and the median change in amount between
+    consecutive charges is at most RECURRING_AMOUNT_DRIFT, so prices that
+    creep up over time are still recognised. Returns {code: pattern dict}.
+    """
+    order = np.lexsort((amounts, days, codes))
+    codes, days, amounts = codes[order], days[order], amounts[order]
+    # Keep the largest charge of each group and day
+    keep = np.ones(len(codes), dtype=bool)
+    keep[:-1] = (codes[:-1] != codes[1:]) | (days[:-1] != days[1:])
+    codes, days, amounts = codes[keep], days[keep], amounts[keep]
+    if not len(codes):
+        return {}
+
+    group_codes, first, groups, occurrences = np.unique(codes, return_index=True, return_inverse=True,
+                                                        return_counts=True)
+    n_groups = len(group_codes)
+    last = first + occurrences - 1
+
+    # Gaps and amount changes between consecutive charges of the same group
+    same = groups[1:] == groups[:-1]
+    pair_groups = groups[1:][same]
+    gaps = np.diff(days)[same].astype(np.float64)
+    previous = np.abs(amounts[:-1][same])
+    changes = np.abs(np.diff(amounts)[same]) / np.maximum(previous, 0.01)
+
+    median_gap = _grouped_median(pair_groups, gaps, n_groups)
+    median_change = _grouped_median(pair_groups, changes, n_groups)
+
+    # The first period whose window holds the median gap, or -1
+    fits = np.abs(median_gap[:, None] - _PERIOD_DAYS[None, :]) <= _PERIOD_TOLERANCE[None, :]
+    period = np.where(fits.any(axis=1), fits.argmax(axis=1), -1)
+
+    on_period = np.abs(gaps - _PERIOD_DAYS[period[pair_groups]]) <= _PERIOD_TOLERANCE[period[pair_groups]]
+    regularity = np.bincount(pair_groups, weights=on_period & (period[pair_groups] >= 0), minlength=n_groups) \
+        / np.maximum(occurrences - 1, 1)
+    amount_sums = np.bincount(groups, weights=amounts, minlength=n_groups)
+
+    recurring = ((occurrences >= min_occurrences) & (period >= 0) & (regularity >= RECURRING_REGULARITY)
+                 & (median_change <= RECURRING_AMOUNT_DRIFT))
+    patterns = {}
+    for index in np.flatnonzero(recurring):
+        name, period_days, tolerance = PERIODS[period[index]]
+        patterns[int(group_codes[index])] = {
+            'frequency': name,
+            'period_days': period_days,
+            'tolerance_days': tolerance,
+            'interval_days': float(median_gap[index]),
+            'occurrences': int(occurrences[index]),
+            'regularity': round(float(regularity[index]), 3),
+            'average_amount': round(float(amount_sums[index] / occurrences[index]), 2),
+            'last_amount': float(amounts[last[index]]),
+            'first_day': int(days[first[index]]),
+            'last_day': int(days[last[index]]),
+        }
+    return patterns
+
+
+class RecurringIndex:
+    """A user's charges per description and day as arrays, kept current by reading the rows added since.
+
+    The rows are grouped in the database, so a long history of frequent
+    purchases loads as at most one row per description and day. Each refresh
+    only re-analyses the descriptions whose charges changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.codes = np.zeros(0, dtype=np.int32)
+        self.days = np.zeros(0, dtype=np.int32)
+        self.amounts = np.zeros(0, dtype=np.float64)
+        # normalized description -> code, and code -> normalized description
+        self.keys = {}
+        self.normalized = []
+        # code -> latest description as entered, for the recurring ones
+        self.descriptions = {}
+        self.patterns = {}
+        self.last_id = 0
+        self.read_at = None
+        # (count, id bound) of the user's rows without a normalized description when loaded, if any
+        self.unnormalized = None
+        self.archive_loaded = False
+
+    @property
+    def memory_bytes(self):
+        return len(self.codes) * ROW_BYTES + len(self.normalized) * GROUP_BYTES
+
+    def _code(self, key):
+        code = self.keys.get(key)
+        if code is None:
+            code = self.keys[key] = len(self.normalized)
+            self.normalized.append(key)
+        return code
+
+    @staticmethod
+    def _count_unnormalized(user_id, last_id):
+        from models import db, Expense
+
+        return db.session.query(db.func.count(Expense.id)).filter(
+            Expense.user_id == user_id, Expense.normalized_description.is_(None), Expense.id <= last_id).scalar()
+
+    def refresh(self, user_id):
+        """Add the user's expenses stored since the last refresh. Returns how many days of charges changed.
+
+        The first refresh also reads the user's archived expenses. Rows
+        without a normalized_description (saved before the column existed)
+        are skipped; once `flask backfill-normalized-descriptions` fills
+        them in, the next refresh loads the whole history again.
+        """
+        from models import db, Expense, catch_up_floor
+
+        with self._lock:
+            if self.unnormalized and self._count_unnormalized(user_id, self.unnormalized[1]) < self.unnormalized[0]:
+                self._clear()
+            read_at = datetime.utcnow()
+            # Rows that committed out of id order since the last refresh are read again
+            floor = catch_up_floor(Expense, user_id, self.last_id, self.read_at) if self.read_at else 0
+            day = db.func.date(Expense.date, type_=db.Date)
+            # Walks ix_expense_user_id, so catching up reads only the rows above the floor
+            rows = db.session.query(Expense.normalized_description, day, db.func.max(Expense.amount),
+                                    db.func.max(Expense.id)).filter(
+                Expense.user_id == user_id, Expense.id > floor, Expense.date.isnot(None),
+                Expense.normalized_description.isnot(None)).group_by(
+                Expense.normalized_description, day).yield_per(LOAD_BATCH_SIZE)
+            codes, days, amounts = [], [], []
+            if not self.archive_loaded:
+                if archive_files(user_id):
+                    for key, charge_day, amount in archived_daily_charges(user_id):
+                        codes.append(self._code(key))
+                        days.append(charge_day.toordinal())
+                        amounts.append(amount)
+                self.archive_loaded = True
+            normalized = self.normalized
+            last_id = self.last_id
+            for key, charge_day, amount, row_id in rows:
+                codes.append(self._code(key))
+                days.append(charge_day.toordinal())
+                amounts.append(amount)
+                last_id = max(last_id, row_id)
+            if self.read_at is None:
+                count = self._count_unnormalized(user_id, last_id)
+                self.unnormalized = (count, last_id) if count else None
+            self.read_at = read_at
+            self.last_id = last_id
+            if not codes:
+                return 0
+
+            codes = np.concatenate([self.codes, np.array(codes, dtype=np.int32)])
+            days = np.concatenate([self.days, np.array(days, dtype=np.int32)])
+            amounts = np.concatenate([self.amounts, np.array(amounts, dtype=np.float64)])
+            is_old = np.arange(len(codes)) < len(self.codes)
+            # Merge days that already had charges, keeping the larger amount as detect_patterns does;
+            # on a tie the charge already held is kept, so rows read again change nothing
+            order = np.lexsort((is_old, amounts, days, codes))
+            codes, days, amounts, is_old = codes[order], days[order], amounts[order], is_old[order]
+            keep = np.ones(len(codes), dtype=bool)
+            keep[:-1] = (codes[:-1] != codes[1:]) | (days[:-1] != days[1:])
+            self.codes, self.days, self.amounts = codes[keep], days[keep], amounts[keep]
+
+            added = self.codes[~is_old[keep]]
+            if not len(added):
+                return 0
+            changed = np.unique(added)
+            # A full pass needs no selection
+            selected = np.isin(self.codes, changed) if len(changed) < len(normalized) else slice(None)
+            for code in changed.tolist():
+                self.patterns.pop(code, None)
+                self.descriptions.pop(code, None)
+            self.patterns.update(detect_patterns(self.codes[selected], self.days[selected], self.amounts[selected]))
+            for code in changed.tolist():
+                if code in self.patterns:
+                    # Charges that are all archived are named by their normalized description
+                    self.descriptions[code] = db.session.query(Expense.description).filter(
+                        Expense.user_id == user_id, Expense.normalized_description == normalized[code]).order_by(
+                        Expense.id.desc()).limit(1).scalar() or normalized[code]
+            return len(added)
+
+    def recurring(self):
+        """Return [(description, pattern)] of the recurring charges found so far."""
+        with self._lock:
+            return [(self.descriptions[code], pattern) for code, pattern in self.patterns.items()]
+
+
+_indexes = SizedLRUCache(RECURRING_INDEX_CACHE_BYTES)
+
+
+def get_recurring_index(user_id):
+    """Return the user's recurring-charge index, loading it on first use and catching up on new rows."""
+    index = _indexes.get(user_id)
+    is_new = index is None
+    if is_new:
+        index = RecurringIndex()
+    if index.refresh(user_id) or is_new:
+        # Re-put to update the accounted size
+        _indexes.put(user_id, index, max(1, index.memory_bytes))
+    return index
+
+
+def find_recurring_expenses(user_id, include_inactive=False, today=None):
+    """Return the user's recurring charges, soonest next charge first.
+
+    A pattern is active while its next charge is at most two tolerances
+    overdue; inactive ones (cancelled subscriptions) are left out unless
+    include_inactive is set.
+    """
+    today = (today or date.today()).toordinal()
+    with timed("recurring_detection"):
+        index = get_recurring_index(user_id)
+    results = []
+    for description, pattern in index.recurring():
+        next_day = pattern['last_day'] + round(pattern['period_days'])
+        active = today <= next_day + 2 * pattern['tolerance_days']
+        if not active and not include_inactive:
+            continue
+        results.append({
+            'description': description,
+            'frequency': pattern['frequency'],
+            'interval_days': pattern['interval_days'],
+            'occurrences': pattern['occurrences'],
+            'regularity': pattern['regularity'],
+            'average_amount': pattern['average_amount'],
+            'last_amount': pattern['last_amount'],
+            'monthly_amount': round(pattern['last_amount'] * 30.44 / pattern['period_days'], 2),
+            'first_date': date.fromordinal(pattern['first_day']).isoformat(),
+            'last_date': date.fromordinal(pattern['last_day']).isoformat(),
+            'next_date': date.fromordinal(next_day).isoformat(),
+            'active': active,
+        })
+    results.sort(key=lambda result: (not result['active'], result['next_date']))
+    return results
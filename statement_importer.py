@@ -0,0 +1,292 @@
+import io
+import re
+import csv
+import logging
+from datetime import datetime, timedelta
+from functools import lru_cache
+from sqlalchemy import insert
+from models import db, Expense
+from categorizer import get_user_categories, load_user_learned_items, categorize_item
+from normalizer import normalize_description
+from budgets import record_expenses
+from archive import archive_files, iter_archived_rows
+
+logger = logging.getLogger(__name__)
+
+# File extensions handled by the structured import path instead of OCR
+STATEMENT_EXTENSIONS = {'csv', 'ofx', 'qfx'}
+
+# Rows categorized, deduplicated and inserted per transaction
+DEFAULT_BATCH_SIZE = 1000
+
+# Distinct descriptions remembered while categorizing a single import
+CATEGORY_CACHE_SIZE = 50000
+
+# Header names recognised for each field, in order of preference
+DESCRIPTION_COLUMNS = ['description', 'transaction description', 'details', 'payee', 'name', 'memo', 'narrative']
+# A signed amount column has debits negative (as OFX does); a debit column
+# next to a separate credit column holds the debits unsigned
+SIGNED_AMOUNT_COLUMNS = ['amount', 'transaction amount', 'value']
+DEBIT_COLUMNS = ['debit', 'withdrawal', 'withdrawals']
+AMOUNT_COLUMNS = SIGNED_AMOUNT_COLUMNS[:2] + DEBIT_COLUMNS + SIGNED_AMOUNT_COLUMNS[2:]
+DATE_COLUMNS = ['date', 'transaction date', 'posted date', 'posting date', 'trans date', 'value date']
+
+DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%d/%m/%Y', '%d/%m/%y',
+                '%m-%d-%Y', '%d-%m-%Y', '%Y/%m/%d', '%d %b %Y', '%b %d, %Y']
+
+# OFX transaction types that move money into the account
+OFX_CREDIT_TYPES = {'CREDIT', 'DEP', 'INT', 'DIV', 'DIRECTDEP'}
+
+OFX_FIELD_PATTERN = re.compile(r'<(\w+)>([^<\r\n]*)')
+
+
+def _find_column(header, candidates):
+    """Return the index of the first header matching one of the candidate names."""
+    normalized = [h.strip().lower() for h in header]
+    for candidate in candidates:
+        if candidate in normalized:
+            return normalized.index(candidate)
+    return None
+
+
+def _parse_amount(value):
+    """Parse an amount such as '$1,234.56', '(12.00)' or '-12.00'."""
+    value = value.strip().replace('$', '').replace(',', '')
+    if not value:
+        return None
+    negative = value.startswith('(') and value.endswith(')')
+    if negative:
+        value = value[1:-1]
+    amount = float(value)
+    return -amount if negative else amount
+
+
+class _DateParser:
+    """Parse statement dates, remembering the format that last worked."""
+
+    def __init__(self):
+        self.last_format = None
+
+    def __call__(self, value):
+        value = value.strip()
+        if self.last_format:
+            try:
+                return datetime.strptime(value, self.last_format)
+            except ValueError:
+                pass
+        for fmt in DATE_FORMATS:
+            try:
+                date = datetime.strptime(value, fmt)
+                self.last_format = fmt
+                return date
+            except ValueError:
+                continue
+        return None
+
+
+def iter_csv_transactions(text_stream):
+    """Yield (description, amount, date) tuples from a bank CSV export.
+
+    Columns are mapped from the header row. Amounts are returned as positive
+    expense values. Credits are skipped: positive rows of a signed amount
+    column, and rows with a blank debit when debits have their own column.
+    """
+    reader = csv.reader(text_stream)
+    header = next(reader, None)
+    if not header:
+        return
+
+    description_col = _find_column(header, DESCRIPTION_COLUMNS)
+    amount_col = _find_column(header, AMOUNT_COLUMNS)
+    date_col = _find_column(header, DATE_COLUMNS)
+    if description_col is None or amount_col is None:
+        raise ValueError(f"Could not find description and amount columns in CSV header: {header}")
+
+    signed = header[amount_col].strip().lower() not in DEBIT_COLUMNS
+
+    parse_date = _DateParser()
+    for line_number, row in enumerate(reader, start=2):
+        if len(row) <= max(description_col, amount_col):
+            continue
+        try:
+            amount = _parse_amount(row[amount_col])
+        except ValueError:
+            logger.debug(f"Skipping CSV line {line_number}: bad amount {row[amount_col]!r}")
+            continue
+        if not amount:
+            # Separate debit/credit columns leave the debit blank on deposits
+            continue
+        if signed and amount > 0:
+            # Deposits and refunds
+            continue
+
+        date = parse_date(row[date_col]) if date_col is not None and date_col < len(row) else None
+        yield row[description_col].strip(), abs(amount), date
+
+
+def iter_ofx_transactions(text_stream, chunk_size=64 * 1024):
+    """Yield (description, amount, date) tuples from an OFX/QFX statement.
+
+    The file is scanned in chunks and only one <STMTTRN> block is held in
+    memory at a time. Both SGML (unclosed leaf tags) and XML flavours work.
+    """
+    buffer = ''
+    while True:
+        chunk = text_stream.read(chunk_size)
+        if chunk:
+            buffer += chunk
+        while True:
+            start = buffer.find('<STMTTRN>')
+            if start == -1:
+                # Keep a tail in case the opening tag is split across chunks
+                buffer = buffer[-len('<STMTTRN>'):]
+                break
+            end = buffer.find('</STMTTRN>', start)
+            if end == -1:
+                buffer = buffer[start:]
+                break
+            block = buffer[start + len('<STMTTRN>'):end]
+            buffer = buffer[end + len('</STMTTRN>'):]
+
+            transaction = _parse_ofx_transaction(block)
+            if transaction:
+                yield transaction
+        if not chunk:
+            break
+
+
+def _parse_ofx_transaction(block):
+    fields = {tag.upper(): value.strip() for tag, value in OFX_FIELD_PATTERN.findall(block)}
+    if fields.get('TRNTYPE', '').upper() in OFX_CREDIT_TYPES:
+        return None
+    try:
+        amount = float(fields.get('TRNAMT', ''))
+    except ValueError:
+        return None
+    if amount >= 0:
+        # OFX amounts are signed from the account's point of view
+        return None
+
+    description = fields.get('NAME') or fields.get('MEMO') or ''
+    posted = fields.get('DTPOSTED', '')
+    try:
+        date = datetime.strptime(posted[:8], '%Y%m%d')
+    except ValueError:
+        date = None
+    return description, abs(amount), date
+
+
+def iter_statement_transactions(binary_stream, file_extension):
+    """Yield (description, amount, date) tuples from an uploaded statement file."""
+    text_stream = io.TextIOWrapper(binary_stream, encoding='utf-8-sig', errors='replace', newline='')
+    if file_extension == 'csv':
+        yield from iter_csv_transactions(text_stream)
+    elif file_extension in ('ofx', 'qfx'):
+        yield from iter_ofx_transactions(text_stream)
+    else:
+        raise ValueError(f"Unsupported statement format: {file_extension}")
+
+
+def _expense_key(date, amount, description):
+    return (date.date(), round(amount * 100), description.lower())
+
+
+def _filter_duplicates(user_id, rows, imported_ids=frozenset()):
+    """Drop rows that already exist for the user (same day, amount and description).
+
+    Identical rows are compared as a multiset so that two genuine purchases of
+    the same thing on the same day in one file are both kept on first import.
+    Rows with an id in imported_ids, inserted by earlier batches of the same
+    file, don't count as existing, so that holds across batches too.
+    """
+    start = min(row['date'] for row in rows).replace(hour=0, minute=0, second=0, microsecond=0)
+    end = max(row['date'] for row in rows).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    existing = {}
+    for expense_id, date, amount, description in db.session.query(
+            Expense.id, Expense.date, Expense.amount, Expense.description).filter(
+            Expense.user_id == user_id, Expense.date >= start, Expense.date < end):
+        if expense_id in imported_ids:
+            continue
+        key = _expense_key(date, amount, description)
+        existing[key] = existing.get(key, 0) + 1
+    # An old statement imported again is compared with the archived expenses too
+    if archive_files(user_id):
+        for batch in iter_archived_rows(user_id, ['date', 'amount', 'description'], date_from=start, date_before=end):
+            for date, amount, description in batch:
+                key = _expense_key(date, amount, description)
+                existing[key] = existing.get(key, 0) + 1
+
+    unique_rows = []
+    for row in rows:
+        key = _expense_key(row['date'], row['amount'], row['description'])
+        if existing.get(key):
+            existing[key] -= 1
+            continue
+        unique_rows.append(row)
+    return unique_rows
+
+
+def _insert_batch(user_id, rows, imported_ids):
+    """Deduplicate and bulk-insert one batch, adding the new ids to imported_ids. Returns the inserted count."""
+    unique_rows = _filter_duplicates(user_id, rows, imported_ids)
+    if unique_rows:
+        imported_ids.update(db.session.scalars(insert(Expense).returning(Expense.id), unique_rows))
+        record_expenses(user_id, unique_rows)
+    db.session.commit()
+    return len(unique_rows)
+
+
+def import_statement(binary_stream, file_extension, user_id, batch_size=DEFAULT_BATCH_SIZE):
+    """Import a CSV/OFX statement for a user without going through OCR.
+
+    Rows are streamed from the file, categorized in batches with the same
+    rules as OCR'd receipts (minus the Open Food Facts lookup), deduplicated
+    against the user's existing expenses and bulk-inserted one batch per
+    transaction, so memory stays bounded by the batch size.
+
+    Returns a summary dict with 'rows', 'imported', 'duplicates' and 'skipped'.
+    """
+    categories, automaton = get_user_categories(user_id)
+    user_learned_items = load_user_learned_items(user_id)
+
+    # Keyed by normalized description so "STARBUCKS #1234" and "STARBUCKS #987" share an entry
+    @lru_cache(maxsize=CATEGORY_CACHE_SIZE)
+    def categorize(description_key):
+        return categorize_item(description_key, categories, user_learned_items, use_open_food_facts=False,
+                               automaton=automaton)
+
+    summary = {'rows': 0, 'imported': 0, 'duplicates': 0, 'skipped': 0}
+    imported_ids = set()
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    batch = []
+
+    for description, amount, date in iter_statement_transactions(binary_stream, file_extension):
+        summary['rows'] += 1
+        if not description:
+            summary['skipped'] += 1
+            continue
+        category_id = categorize(normalize_description(description))
+        if category_id is None:
+            summary['skipped'] += 1
+            continue
+
+        batch.append({
+            'user_id': user_id,
+            'description': description[:256],
+            'amount': amount,
+            'category_id': category_id,
+            'date': date or today,
+        })
+        if len(batch) >= batch_size:
+            inserted = _insert_batch(user_id, batch, imported_ids)
+            summary['imported'] += inserted
+            summary['duplicates'] += len(batch) - inserted
+            batch = []
+
+    if batch:
+        inserted = _insert_batch(user_id, batch, imported_ids)
+        summary['imported'] += inserted
+        summary['duplicates'] += len(batch) - inserted
+
+    logger.info(f"Statement import for user {user_id}: {summary}")
+    return summary
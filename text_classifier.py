@@ -0,0 +1,231 @@
+import os
+import json
+import zlib
+import logging
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+# Where the trained model lives; the engine is disabled while the file is missing
+MODEL_PATH = os.environ.get("CLASSIFIER_MODEL_PATH", "category_model.npz")
+
+# Size of the hashed feature space. 2**16 columns keeps the model around a
+# megabyte compressed while collisions stay rare for short item descriptions.
+DEFAULT_N_FEATURES = 2 ** 16
+
+DEFAULT_NGRAM_RANGE = (2, 4)
+
+# Additive smoothing of the per-class feature counts
+DEFAULT_ALPHA = 0.1
+
+
+def _ngram_hashes(text, ngram_range, n_features):
+    text = f" {' '.join(text.lower().split())} "
+    low, high = ngram_range
+    hashes = []
+    for n in range(low, high + 1):
+        for i in range(len(text) - n + 1):
+            hashes.append(zlib.crc32(text[i:i + n].encode('utf-8')) % n_features)
+    return hashes
+
+
+def vectorize(descriptions, n_features=DEFAULT_N_FEATURES, ngram_range=DEFAULT_NGRAM_RANGE):
+    """Turn descriptions into an L2-normalized CSR matrix of hashed character n-gram counts.
+
+    crc32 is used instead of hash() so features are stable across processes.
+    """
+    indices = []
+    indptr = [0]
+    for description in descriptions:
+        indices.extend(_ngram_hashes(description, ngram_range, n_features))
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.float32)
+    matrix = sparse.csr_matrix((data, np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+                               shape=(len(descriptions), n_features))
+    # Merge repeated n-grams into counts, then scale rows to unit length
+    matrix.sum_duplicates()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sparse.diags(1.0 / norms).dot(matrix).tocsr()
+
+
+class TextClassifier:
+    """Multinomial naive Bayes over hashed character n-grams.
+
+    The model keeps raw per-class feature counts, so training is incremental:
+    partial_fit adds new examples and unlearn removes examples, e.g. when a
+    learned correction changes category. Prediction is one sparse matrix
+    multiply against the log-probability matrix for a whole batch.
+    """
+
+    def __init__(self, n_features=DEFAULT_N_FEATURES, ngram_range=DEFAULT_NGRAM_RANGE, alpha=DEFAULT_ALPHA):
+        self.n_features = n_features
+        self.ngram_range = tuple(ngram_range)
+        self.alpha = alpha
+        self.classes = []
+        self.feature_counts = np.zeros((0, n_features), dtype=np.float32)
+        self.class_counts = np.zeros(0, dtype=np.float64)
+        # Training bookkeeping used by train_from_history
+        self.last_expense_id = 0
+        self.learned_items = {}
+        self._log_prob = None
+
+    def _class_index(self, label):
+        if label not in self.classes:
+            self.classes.append(label)
+            self.feature_counts = np.vstack([self.feature_counts, np.zeros((1, self.n_features), dtype=np.float32)])
+            self.class_counts = np.append(self.class_counts, 0.0)
+        return self.classes.index(label)
+
+    def _update(self, descriptions, labels, sign):
+        if not descriptions:
+            return
+        matrix = vectorize(descriptions, self.n_features, self.ngram_range)
+        label_indices = np.array([self._class_index(label) for label in labels])
+        # One-hot (examples x classes) so per-class sums are a single product
+        onehot = sparse.csr_matrix((np.full(len(labels), sign, dtype=np.float32),
+                                    (np.arange(len(labels)), label_indices)),
+                                   shape=(len(labels), len(self.classes)))
+        self.feature_counts += np.asarray((onehot.T @ matrix).todense(), dtype=np.float32)
+        np.maximum(self.feature_counts, 0, out=self.feature_counts)
+        self.class_counts += np.bincount(label_indices, minlength=len(self.classes)) * sign
+        np.maximum(self.class_counts, 0, out=self.class_counts)
+        self._log_prob = None
+
+    def partial_fit(self, descriptions, labels):
+        """Add labelled examples to the model."""
+        self._update(list(descriptions), list(labels), 1.0)
+
+    def unlearn(self, descriptions, labels):
+        """Remove previously added examples from the model."""
+        self._update(list(descriptions), list(labels), -1.0)
+
+    def _log_probabilities(self):
+        if self._log_prob is None:
+            smoothed = self.feature_counts + self.alpha
+            log_prob = np.log(smoothed) - np.log(smoothed.sum(axis=1, keepdims=True))
+            prior = np.log(self.class_counts + 1.0) - np.log(self.class_counts.sum() + len(self.classes))
+            self._log_prob = (log_prob.T.astype(np.float32), prior.astype(np.float32))
+        return self._log_prob
+
+    def predict_proba(self, descriptions):
+        """Return an (n_descriptions x n_classes) matrix of class probabilities."""
+        if not self.classes:
+            return np.zeros((len(descriptions), 0), dtype=np.float32)
+        log_prob, prior = self._log_probabilities()
+        scores = vectorize(descriptions, self.n_features, self.ngram_range) @ log_prob + prior
+        scores -= scores.max(axis=1, keepdims=True)
+        probabilities = np.exp(scores)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        return probabilities
+
+    def predict(self, descriptions):
+        """Return a (category name, confidence) tuple for each description."""
+        if not descriptions or not self.classes:
+            return [(None, 0.0)] * len(descriptions)
+        probabilities = self.predict_proba(descriptions)
+        best = probabilities.argmax(axis=1)
+        return [(self.classes[index], float(probabilities[row, index])) for row, index in enumerate(best)]
+
+    def save(self, path=MODEL_PATH):
+        """Write the model atomically to a compressed .npz file."""
+        metadata = {
+            'classes': self.classes,
+            'n_features': self.n_features,
+            'ngram_range': list(self.ngram_range),
+            'alpha': self.alpha,
+            'last_expense_id': self.last_expense_id,
+            'learned_items': self.learned_items,
+        }
+        temp_path = f"{path}.tmp"
+        # Counts are stored sparsely; most hashed columns are empty for any class
+        counts = sparse.csr_matrix(self.feature_counts)
+        with open(temp_path, 'wb') as f:
+            np.savez_compressed(f, metadata=np.frombuffer(json.dumps(metadata).encode('utf-8'), dtype=np.uint8),
+                                data=counts.data, indices=counts.indices, indptr=counts.indptr,
+                                class_counts=self.class_counts)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH):
+        with np.load(path) as archive:
+            metadata = json.loads(archive['metadata'].tobytes().decode('utf-8'))
+            classifier = cls(metadata['n_features'], metadata['ngram_range'], metadata['alpha'])
+            classifier.classes = metadata['classes']
+            classifier.feature_counts = sparse.csr_matrix(
+                (archive['data'], archive['indices'], archive['indptr']),
+                shape=(len(classifier.classes), classifier.n_features)).toarray()
+            classifier.class_counts = archive['class_counts']
+        classifier.last_expense_id = metadata['last_expense_id']
+        classifier.learned_items = metadata['learned_items']
+        return classifier
+
+
+_loaded = {'path': None, 'mtime': None, 'classifier': None}
+
+
+def get_classifier(path=MODEL_PATH):
+    """Return the trained classifier, reloading it when the file changes. None if untrained."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    if _loaded['path'] != path or _loaded['mtime'] != mtime:
+        classifier = TextClassifier.load(path)
+        _loaded.update(path=path, mtime=mtime, classifier=classifier)
+        logger.info(f"Loaded category classifier from {path} ({len(classifier.classes)} classes)")
+    return _loaded['classifier']
+
+
+def train_from_history(path=MODEL_PATH, full=False, batch_size=5000):
+    """Train or incrementally update the classifier from saved data. Needs an app context.
+
+    Learns from the learned-items corrections file and from saved expenses,
+    using normalized descriptions like the categorizer does.
+    Without full=True only expenses added since the last training run are
+    read, and corrections whose category changed are unlearned and relearned.
+    Returns the updated classifier after saving it to path.
+    """
+    from models import db, Expense, Category
+    from categorizer import load_user_learned_items
+    from normalizer import normalize_description
+
+    classifier = None
+    if not full and os.path.exists(path):
+        classifier = TextClassifier.load(path)
+    if classifier is None:
+        classifier = TextClassifier()
+
+    # Corrections: apply only what changed since the last run
+    learned_items = load_user_learned_items(None)
+    removed = {d: c for d, c in classifier.learned_items.items() if learned_items.get(d) != c}
+    added = {d: c for d, c in learned_items.items() if classifier.learned_items.get(d) != c}
+    if removed:
+        classifier.unlearn(list(removed), list(removed.values()))
+    if added:
+        classifier.partial_fit(list(added), list(added.values()))
+    classifier.learned_items = dict(learned_items)
+
+    # Saved expenses: stream everything newer than the last run in batches
+    query = db.session.query(Expense.id, Expense.description, Category.name).join(
+        Category, Expense.category_id == Category.id).filter(
+        Expense.id > classifier.last_expense_id).order_by(Expense.id)
+    descriptions, labels = [], []
+    trained = 0
+    for expense_id, description, category_name in query.yield_per(batch_size):
+        descriptions.append(normalize_description(description))
+        labels.append(category_name)
+        classifier.last_expense_id = expense_id
+        if len(descriptions) >= batch_size:
+            classifier.partial_fit(descriptions, labels)
+            trained += len(descriptions)
+            descriptions, labels = [], []
+    if descriptions:
+        classifier.partial_fit(descriptions, labels)
+        trained += len(descriptions)
+
+    classifier.save(path)
+    logger.info(f"Trained classifier on {trained} expenses and {len(added)} new corrections "
+                f"({len(removed)} corrections unlearned)")
+    return classifier
@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import secrets
+import tempfile
+import threading
+from datetime import datetime
+from flask import Request
+
+logger = logging.getLogger(__name__)
+
+# Uploads are kept in memory up to this size, then rolled over to a temporary file
+SPOOL_MEMORY_LIMIT = 4 * 1024 * 1024
+
+# Bytes inspected to recognise the file type
+SNIFF_BYTES = 512
+
+CHUNK_SIZE = 1024 * 1024
+
+# Resumable uploads may exceed MAX_CONTENT_LENGTH, but only bank statements that large are accepted
+CHUNKED_UPLOAD_MAX_SIZE = int(os.environ.get("CHUNKED_UPLOAD_MAX_SIZE", 512 * 1024 * 1024))
+CHUNKED_UPLOAD_MAX_AGE = 24 * 60 * 60
+
+# Seconds between sweeps of abandoned chunked uploads, so they go away on an instance that gets no new ones
+CHUNKED_UPLOAD_CLEANUP_INTERVAL = int(os.environ.get("CHUNKED_UPLOAD_CLEANUP_INTERVAL", 3600))
+
+STATEMENT_KINDS = {'csv', 'ofx'}
+IMAGE_KINDS = {'png', 'jpeg', 'gif', 'bmp', 'tiff'}
+OCR_KINDS = IMAGE_KINDS | {'pdf'}
+
+_MAGIC_NUMBERS = [
+    (b'%PDF-', 'pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+    (b'BM', 'bmp'),
+]
+
+
+class UploadError(Exception):
+    """An upload that can't be processed, with a message for the user."""
+
+
+class DuplicateReceiptError(UploadError):
+    """The upload looks like a receipt the user has already uploaded."""
+
+    def __init__(self, uploaded_at, distance):
+        super().__init__(f"This looks like a receipt you already uploaded on {uploaded_at:%Y-%m-%d %H:%M}. "
+                         "Upload it again with 'allow duplicate' checked to process it anyway.")
+        self.uploaded_at = uploaded_at
+        self.distance = distance
+
+
+def sniff_file_type(header):
+    """Identify a file from its first bytes. Returns a kind from OCR_KINDS or STATEMENT_KINDS, or None."""
+    for magic, kind in _MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return kind
+    if b'\x00' in header:
+        return None
+    text = header.decode('utf-8', errors='ignore').lstrip('\ufeff \t\r\n')
+    if text.upper().startswith(('OFXHEADER', '<OFX')) or (text.startswith('<?xml') and '<OFX' in text.upper()):
+        return 'ofx'
+    # Any other text is treated as a CSV export and validated by the importer
+    return 'csv' if text else None
+
+
+class HashingSpool:
+    """Writable spool that hashes and sniffs the data as it is written.
+
+    Used as the stream factory for multipart uploads, so the upload is hashed
+    while it is received and never written to disk unless it is large.
+    """
+
+    def __init__(self, max_memory=SPOOL_MEMORY_LIMIT):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self._header = b''
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        if len(self._header) < SNIFF_BYTES:
+            self._header += data[:SNIFF_BYTES - len(self._header)]
+        return self.file.write(data)
+
+    @property
+    def sha256(self):
+        return self.hasher.hexdigest()
+
+    @property
+    def kind(self):
+        return sniff_file_type(self._header)
+
+    def read_all(self):
+        """Return the whole upload as bytes, from memory if it never rolled over."""
+        self.file.seek(0)
+        return self.file.read()
+
+    def __getattr__(self, name):
+        # read, seek, tell, close, ... go to the spooled file
+        return getattr(self.file, name)
+
+
+class SpoolingRequest(Request):
+    """Request whose uploaded files are streamed into HashingSpool objects."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingSpool()
+
+
+def ingest_upload(binary_stream, kind, user_id, data=None, sha256=None, allow_duplicate=False):
+    """Run an uploaded file through the statement importer or OCR and categorization.
+
+    binary_stream is the open upload, kind its sniffed type; data may hold
+    the upload's bytes if they are already in memory. Receipts that look like
+    one the user already uploaded raise DuplicateReceiptError before any OCR
+    runs, unless allow_duplicate is set. Returns
+    {'type': 'statement', 'summary': ...} or
+    {'type': 'receipt', 'items': [ExpenseItem, ...], 'expense_ids': [id of each item's saved expense]}.
+    Raises UploadError for files that can't be used.
+    """
+    from models import db, Expense
+
+    if kind in STATEMENT_KINDS:
+        from statement_importer import import_statement
+        binary_stream.seek(0)
+        return {'type': 'statement', 'summary': import_statement(binary_stream, kind, user_id)}
+    if kind not in OCR_KINDS:
+        raise UploadError('Unrecognised file type. Please upload a PDF, image, CSV or OFX file.')
+
+    from ocr_processor import check_tesseract, load_pages, to_grayscale, perceptual_hash, ocr_layout, layout_text
+    from categorizer import categorize_expense_items
+    from receipt_parser import parse_item_dates
+    from receipt_index import find_near_duplicates, record_receipt_hash
+    from budgets import record_expenses
+    if not check_tesseract():
+        raise UploadError('Tesseract OCR is not installed or configured properly. '
+                          'Please install Tesseract OCR to process images and PDFs.')
+
+    if data is None:
+        binary_stream.seek(0)
+        data = binary_stream.read()
+    try:
+        pages = load_pages(data, kind)
+    except ValueError as e:
+        raise UploadError(f'OCR Error: {e}')
+
+    # The first page identifies the receipt
+    receipt_hash = perceptual_hash(to_grayscale(pages[0]))
+    if receipt_hash and not allow_duplicate:
+        matches = find_near_duplicates(user_id, receipt_hash)
+        if matches:
+            distance, _, uploaded_at = matches[0]
+            raise DuplicateReceiptError(uploaded_at, distance)
+
+    lines = ocr_layout(pages)
+    extracted_text = layout_text(lines, page_markers=kind == 'pdf')
+    if not extracted_text.strip():
+        raise UploadError('No text could be extracted from the file. '
+                          'Please try another file or ensure the image has clear text.')
+    logger.debug(f"Extracted text sample: {extracted_text[:200]}...")
+
+    categorized_items = categorize_expense_items(extracted_text, user_id, lines)
+    if not categorized_items:
+        raise UploadError('No expense items were found in the extracted text. Please upload a receipt or invoice.')
+
+    dates = parse_item_dates(categorized_items)
+    now = datetime.now()
+    expenses = [Expense(
+        user_id=user_id,
+        description=item.description,
+        amount=item.amount,
+        category_id=item.category_id,
+        date=dates[item.date] if item.date else now
+    ) for item in categorized_items]
+    db.session.add_all(expenses)
+    record_expenses(user_id, expenses)
+    if receipt_hash:
+        record_receipt_hash(user_id, receipt_hash, sha256)
+    db.session.commit()
+    return {'type': 'receipt', 'items': categorized_items, 'expense_ids': [expense.id for expense in expenses]}
+
+
+# Resumable chunked uploads: <id>.part holds the bytes received so far and
+# <id>.json the upload's owner, declared size and progress.
+
+_hashers = {}
+
+
+def _chunked_paths(folder, upload_id):
+    return os.path.join(folder, f"{upload_id}.part"), os.path.join(folder, f"{upload_id}.json")
+
+
+def _write_metadata(path, metadata):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(metadata, f)
+    os.replace(temp_path, path)
+
+
+def cleanup_stale_uploads(folder, max_age=CHUNKED_UPLOAD_MAX_AGE):
+    """Delete chunked uploads that haven't received data for max_age seconds. Returns the files deleted."""
+    cutoff = time.time() - max_age
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    for name in names:
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                _hashers.pop(name.split('.', 1)[0], None)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+_cleanup_lock = threading.Lock()
+_cleanup = {'next_run': 0.0, 'running': False}
+
+
+def _cleanup_stale_uploads(folder):
+    try:
+        removed = cleanup_stale_uploads(folder)
+        if removed:
+            logger.info(f"Removed {removed} abandoned chunked upload files from {folder}")
+    except Exception as e:
+        logger.warning(f"Could not clean up chunked uploads, will retry: {e}")
+    finally:
+        _cleanup['running'] = False
+
+
+def cleanup_stale_uploads_in_background(folder):
+    """Sweep abandoned chunked uploads in a thread, at most every CHUNKED_UPLOAD_CLEANUP_INTERVAL seconds.
+
+    Called on each request; cheap when it isn't time yet.
+    """
+    now = time.monotonic()
+    if now < _cleanup['next_run'] or _cleanup['running']:
+        return
+    with _cleanup_lock:
+        if now < _cleanup['next_run'] or _cleanup['running']:
+            return
+        _cleanup['next_run'] = now + CHUNKED_UPLOAD_CLEANUP_INTERVAL
+        _cleanup['running'] = True
+    threading.Thread(target=_cleanup_stale_uploads, args=(folder,), daemon=True).start()
+
+
+def create_chunked_upload(folder, user_id, filename, size, sha256=None, allow_duplicate=False):
+    """Start a resumable upload and return its metadata."""
+    if size <= 0 or size > CHUNKED_UPLOAD_MAX_SIZE:
+        raise UploadError(f'Upload size must be between 1 byte and {CHUNKED_UPLOAD_MAX_SIZE} bytes.')
+    os.makedirs(folder, exist_ok=True)
+    cleanup_stale_uploads(folder)
+
+    upload_id = secrets.token_urlsafe(16)
+    part_path, metadata_path = _chunked_paths(folder, upload_id)
+    open(part_path, 'wb').close()
+    metadata = {'id': upload_id, 'user_id': user_id, 'filename': filename, 'size': size,
+                'sha256': sha256.lower() if sha256 else None, 'offset': 0, 'kind': None,
+                'allow_duplicate': allow_duplicate}
+    _write_metadata(metadata_path, metadata)
+    _hashers[upload_id] = (0, hashlib.sha256())
+    return metadata
+
+
+def load_chunked_upload(folder, upload_id, user_id):
+    """Return the metadata of a user's chunked upload, or None."""
+    if not (upload_id.isascii() and upload_id.replace('-', '').replace('_', '').isalnum()):
+        return None
+    _, metadata_path = _chunked_paths(folder, upload_id)
+    try:
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return metadata if metadata['user_id'] == user_id else None
+
+
+def _get_hasher(part_path, upload_id, offset):
+    # Another worker may have received the earlier chunks; rebuild from the file once
+    entry = _hashers.get(upload_id)
+    if entry is not None and entry[0] == offset:
+        # A copy, so a chunk that fails halfway doesn't corrupt the saved state
+        return entry[1].copy()
+    hasher = hashlib.sha256()
+    with open(part_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher
+
+
+def _sniff_chunked_upload(folder, metadata, header, max_other_size):
+    """Return the type of a chunked upload from its first bytes.
+
+    Discards the upload and raises UploadError if it isn't a statement but
+    is larger than max_other_size.
+    """
+    kind = sniff_file_type(header)
+    if max_other_size is not None and kind not in STATEMENT_KINDS and metadata['size'] > max_other_size:
+        discard_chunked_upload(folder, metadata['id'])
+        raise UploadError('Only bank statements may be larger than a single upload; the upload has been discarded.')
+    return kind
+
+
+def append_chunk(folder, metadata, offset, stream, max_other_size=None):
+    """Append the body of one chunk request at offset, hashing it as it is received.
+
+    Raises UploadError if offset isn't where the upload left off or the
+    upload would exceed its declared size, and, as soon as the first bytes
+    show it isn't a statement, if it is larger than max_other_size.
+    Returns the updated metadata.
+    """
+    if offset != metadata['offset']:
+        raise UploadError(f"Expected a chunk at offset {metadata['offset']}.")
+    part_path, metadata_path = _chunked_paths(folder, metadata['id'])
+    hasher = _get_hasher(part_path, metadata['id'], offset)
+
+    received = offset
+    header = b''
+    sniffed = offset != 0
+    with open(part_path, 'r+b') as f:
+        # Drop anything a previously interrupted chunk left behind
+        f.truncate(offset)
+        f.seek(offset)
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+            if received > metadata['size']:
+                raise UploadError('Upload is larger than its declared size.')
+            if not sniffed:
+                header += chunk[:SNIFF_BYTES - len(header)]
+                if len(header) == SNIFF_BYTES:
+                    metadata['kind'] = _sniff_chunked_upload(folder, metadata, header, max_other_size)
+                    sniffed = True
+            hasher.update(chunk)
+            f.write(chunk)
+
+    if not sniffed:
+        # A first chunk shorter than SNIFF_BYTES is sniffed from what there is
+        metadata['kind'] = _sniff_chunked_upload(folder, metadata, header, max_other_size)
+    metadata['offset'] = received
+    _write_metadata(metadata_path, metadata)
+    _hashers[metadata['id']] = (received, hasher)
+
+    if received == metadata['size']:
+        metadata['received_sha256'] = hasher.hexdigest()
+        if metadata['sha256'] and metadata['sha256'] != metadata['received_sha256']:
+            discard_chunked_upload(folder, metadata['id'])
+            raise UploadError('Checksum mismatch; the upload has been discarded.')
+    return metadata
+
+
+def open_chunked_upload(folder, upload_id):
+    part_path, _ = _chunked_paths(folder, upload_id)
+    return open(part_path, 'rb')
+
+
+def discard_chunked_upload(folder, upload_id):
+    _hashers.pop(upload_id, None)
+    for path in _chunked_paths(folder, upload_id):
+        if os.path.exists(path):
+            os.remove(path)
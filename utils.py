@@ -1,6 +1,12 @@
 import os
 import json
+import tempfile
+from contextlib import contextmanager
 from models import db, Category
+from normalizer import normalize_description
+
+# User corrections, {normalized description: category name}
+LEARNED_ITEMS_PATH = os.environ.get("LEARNED_ITEMS_PATH", "user_learned_items.json")
 
 def allowed_file(filename, allowed_extensions):
     """Check if the uploaded file has an allowed extension."""
@@ -9,14 +15,14 @@ def allowed_file(filename, allowed_extensions):
 def create_default_categories():
     """Create default categories from categories.json if they don't exist."""
     # Check if categories already exist
-    if Category.query.first() is not None:
+    if Category.query.filter(Category.user_id.is_(None)).first() is not None:
         return
     
     # Load categories from JSON file
     with open('categories.json', 'r') as f:
         categories_data = json.load(f)
     
-    # Create category entries in the database
+    # Create the shared category entries in the database
     for category_name, keywords in categories_data.items():
         category = Category(name=category_name, keywords=json.dumps(keywords))
         db.session.add(category)
@@ -25,53 +31,33 @@ def create_default_categories():
 
 def save_learned_item(user_id, item_description, category_id):
     """Save a user-corrected item to the learned items JSON."""
-    # Make sure the file exists
-    if not os.path.exists('user_learned_items.json'):
-        with open('user_learned_items.json', 'w') as f:
-            json.dump({}, f)
-    
     # Get the category name from ID
     from models import Category
     category = Category.query.get(category_id)
     if not category:
         return False
-    
-    # Load existing learned items
-    with open('user_learned_items.json', 'r+') as f:
-        try:
-            learned_items = json.load(f)
-        except json.JSONDecodeError:
-            learned_items = {}
-        
-        # Store the item with its category name for easier readability
-        # Use the item description in lowercase for case-insensitive matching
-        learned_items[item_description.lower()] = category.name
-        
-        # Write back to file
-        f.seek(0)
-        json.dump(learned_items, f, indent=4)
-        f.truncate()
-    
+
+    # Store the item with its category name for easier readability
+    # Key by the normalized description so codes and quantities don't matter
+    _update_learned_items({normalize_description(item_description): category.name})
     return True
 
 def get_learned_category(user_id, item_description):
     """Get the category ID for an item based on learned items.
     Returns the category ID or None if not found."""
-    if not os.path.exists('user_learned_items.json'):
+    if not os.path.exists(LEARNED_ITEMS_PATH):
         return None
     
-    with open('user_learned_items.json', 'r') as f:
+    with open(LEARNED_ITEMS_PATH, 'r') as f:
         try:
             learned_items = json.load(f)
         except json.JSONDecodeError:
             return None
         
-        # Check if the item exists in learned items (case-insensitive)
-        item_key = item_description.lower()
-        if item_key in learned_items:
-            # Get the category name
-            category_name = learned_items[item_key]
-            
+        # Check if the item exists in learned items (older entries are keyed by the lowercase text)
+        category_name = (learned_items.get(normalize_description(item_description))
+                         or learned_items.get(item_description.lower()))
+        if category_name:
             # Find the category ID from the name
             from models import Category
             category = Category.query.filter_by(name=category_name).first()
@@ -80,40 +66,64 @@ def get_learned_category(user_id, item_description):
     
     return None
 
+@contextmanager
+def _learned_items_lock():
+    """Hold an exclusive lock on the learned items' .lock file, so concurrent corrections aren't lost."""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(f"{LEARNED_ITEMS_PATH}.lock", 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def _update_learned_items(new_items):
+    """Merge {normalized description: category name} into the learned items JSON.
+
+    The read, merge and replace happen under a file lock, so two workers
+    saving corrections at once both keep theirs, and the file is replaced
+    through a uniquely named temporary file, so a concurrent reader never
+    sees it half-written.
+    """
+    with _learned_items_lock():
+        try:
+            with open(LEARNED_ITEMS_PATH, 'r') as f:
+                learned_items = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            learned_items = {}
+        learned_items.update(new_items)
+
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(LEARNED_ITEMS_PATH)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(learned_items, f, indent=4)
+            os.replace(temp_path, LEARNED_ITEMS_PATH)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
 def save_batch_learned_items(corrections):
     """Save multiple corrected items to the learned items JSON.
     
+    The file is read and replaced once for the whole batch.
+
     Args:
         corrections: List of dictionaries with 'description' and 'category_name' keys
     
     Returns:
         bool: Success status
     """
-    # Make sure the file exists
-    if not os.path.exists('user_learned_items.json'):
-        with open('user_learned_items.json', 'w') as f:
-            json.dump({}, f)
-    
-    # Load existing learned items
-    with open('user_learned_items.json', 'r+') as f:
-        try:
-            learned_items = json.load(f)
-        except json.JSONDecodeError:
-            learned_items = {}
-        
-        # Add each correction to the learned items
-        for correction in corrections:
-            description = correction.get('description', '').lower()
-            category_name = correction.get('category_name', '')
-            
-            if description and category_name:
-                learned_items[description] = category_name
-        
-        # Write back to file
-        f.seek(0)
-        json.dump(learned_items, f, indent=4)
-        f.truncate()
-    
+    # Add each correction to the learned items
+    learned_items = {}
+    for correction in corrections:
+        description = correction.get('description', '')
+        category_name = correction.get('category_name', '')
+
+        if description and category_name:
+            learned_items[normalize_description(description)] = category_name
+
+    _update_learned_items(learned_items)
     return True
 
 def find_duplicates(expenses, new_expenses):